@@ -9,7 +9,7 @@ from datetime import datetime
 from expert.rules_manager import RulesManager
 from expert.rules_preview import RulesPreview
 from expert.rules_monitoring import RulesMonitoring
-from security.auth_system import SecurityManager, require_api_key
+from security.auth_system import get_security_manager, require_api_key
 
 class RulesAPI:
     """API para gestión de reglas del sistema experto"""
@@ -18,7 +18,7 @@ class RulesAPI:
         self.rules_manager = RulesManager()
         self.rules_preview = RulesPreview()
         self.rules_monitoring = RulesMonitoring()
-        self.security_manager = SecurityManager()
+        self.security_manager = get_security_manager()
         
     def setup_routes(self, app):
         """Configura las rutas en la aplicación FastAPI"""
@@ -164,7 +164,7 @@ class RulesAPI:
         """Obtiene sugerencias para crear reglas"""
         try:
             suggestions = self.rules_manager.get_rule_suggestions()
-            return JSONResponse(suggestions)
+            return JSONResponse(dict(suggestions))
             
         except Exception as e:
             return JSONResponse({"error": f"Error obteniendo sugerencias: {str(e)}"}, status_code=500)
@@ -172,34 +172,18 @@ class RulesAPI:
     async def validate_rule_data(self, rule_data: Dict[str, Any]) -> JSONResponse:
         """Valida datos de una regla sin guardarla"""
         try:
-            # Validar cada campo individualmente
-            rules_json = self.rules_manager.load_rules()
-            existing_rules = rules_json.get("rules", [])
-            
-            results = {}
-            
+            # Validar los campos presentes en una sola pasada sobre las reglas existentes
+            fields = {key: rule_data[key] for key in ('condition', 'action', 'priority', 'severity')
+                      if key in rule_data}
             if 'rule_id' in rule_data:
-                valid, message = self.rules_manager.validate_rule_id(
-                    rule_data['rule_id'], existing_rules
-                )
-                results['rule_id'] = {"valid": valid, "message": message}
-            
-            if 'condition' in rule_data:
-                valid, message = self.rules_manager.validate_condition(rule_data['condition'])
-                results['condition'] = {"valid": valid, "message": message}
-            
-            if 'action' in rule_data:
-                valid, message = self.rules_manager.validate_action(rule_data['action'])
-                results['action'] = {"valid": valid, "message": message}
-            
-            if 'priority' in rule_data:
-                priority = int(rule_data['priority']) if isinstance(rule_data['priority'], str) else rule_data['priority']
-                valid, message = self.rules_manager.validate_priority(priority, existing_rules)
-                results['priority'] = {"valid": valid, "message": message}
+                fields['id'] = rule_data['rule_id']
+            if isinstance(fields.get('priority'), str):
+                fields['priority'] = int(fields['priority'])
             
-            if 'severity' in rule_data:
-                valid, message = self.rules_manager.validate_severity(rule_data['severity'])
-                results['severity'] = {"valid": valid, "message": message}
+            results = {
+                ('rule_id' if field == 'id' else field): {"valid": valid, "message": message}
+                for field, (valid, message) in self.rules_manager.validate_rule(fields).items()
+            }
             
             # Determinar si todos son válidos
             all_valid = all(result['valid'] for result in results.values())
@@ -18,18 +18,18 @@ class ExpertSystem:
             print(f"Error cargando reglas: {e}")
             return {'rules': [], 'motivo_rules': {}}
     
-    def evaluate_absence(self, absence):
+    def evaluate_absence(self, absence, session=None):
         """Evalúa una ausencia contra todas las reglas del sistema experto"""
         findings = []
         
         for rule in sorted(self.rules, key=lambda x: x['priority']):
-            result = self._check_rule(rule, absence)
+            result = self._check_rule(rule, absence, session)
             if result:
                 findings.append(result)
         
         return findings
     
-    def _check_rule(self, rule, absence):
+    def _check_rule(self, rule, absence, session=None):
         """Verifica si una regla específica aplica a una ausencia"""
         condition = rule['condition']
         
@@ -83,7 +83,7 @@ class ExpertSystem:
         
         # Regla: Ausencias frecuentes
         elif rule['id'] == 'frequent_absences':
-            count = self._count_recent_absences(absence.chat_id)
+            count = self._count_recent_absences(absence.chat_id, session)
             if count > 3:
                 return {
                     'rule_id': rule['id'],
@@ -95,9 +95,9 @@ class ExpertSystem:
         
         return None
     
-    def _count_recent_absences(self, chat_id):
+    def _count_recent_absences(self, chat_id, session=None):
         """Cuenta ausencias recientes de un usuario"""
-        db = SessionLocal()
+        db = session or SessionLocal()
         try:
             fecha_limite = datetime.now() - timedelta(days=30)
             return db.query(Absence).filter(
@@ -105,17 +105,21 @@ class ExpertSystem:
                 Absence.created_at >= fecha_limite
             ).count()
         finally:
-            db.close()
+            if session is None:
+                db.close()
     
-    def apply_expert_rules(self, absence_id):
-        """Aplica las reglas del sistema experto a una ausencia y actualiza observaciones"""
-        db = SessionLocal()
+    def apply_expert_rules(self, absence_id, session=None):
+        """Aplica las reglas del sistema experto a una ausencia y actualiza observaciones
+        
+        Con session se trabaja dentro de la transacción del llamador (que hace el commit)
+        """
+        db = session or SessionLocal()
         try:
             absence = db.query(Absence).filter(Absence.id == absence_id).first()
             if not absence:
                 return []
             
-            findings = self.evaluate_absence(absence)
+            findings = self.evaluate_absence(absence, db)
             
             # Actualizar observaciones en la base de datos
             observations = []
@@ -130,7 +134,10 @@ class ExpertSystem:
             if observations:
                 absence.observaciones = " | ".join(observations)
                 absence.sancion_aplicada = sanctions
-                db.commit()
+                if session is None:
+                    db.commit()
+                else:
+                    db.flush()
                 
                 print(f"[EXPERT] Reglas aplicadas a ausencia {absence_id}:")
                 for obs in observations:
@@ -142,7 +149,8 @@ class ExpertSystem:
             print(f"Error aplicando reglas: {e}")
             return []
         finally:
-            db.close()
+            if session is None:
+                db.close()
     
     def validate_motivo_rules(self, motivo, duracion):
         """Valida una ausencia contra las reglas de motivo"""
@@ -1,11 +1,19 @@
 # expert/inference_engine.py - Motor de inferencia avanzado
 import ast
+import logging
 import operator
 import json
 from datetime import datetime, timedelta
-from typing import Dict, List, Any, Optional
+from types import CodeType
+from typing import Dict, List, Any, Optional, Set
 from dataclasses import dataclass, field
 
+logger = logging.getLogger(__name__)
+
+def _priority_key(rule: Dict) -> Any:
+    """Clave de orden de las reglas (menor prioridad numérica primero)"""
+    return rule.get('priority', 999)
+
 @dataclass
 class InferenceStep:
     """Representa un paso en el razonamiento del sistema experto"""
@@ -25,6 +33,13 @@ class InferenceResult:
     steps: List[InferenceStep] = field(default_factory=list)
     final_facts: Dict[str, Any] = field(default_factory=dict)
     execution_time: float = 0.0
+    fired_ids: Set[str] = field(default_factory=set)
+
+class _FactsScope(dict):
+    """Ámbito para eval: los nombres que no son hechos valen None (igual que _eval_node)"""
+    
+    def __missing__(self, key):
+        return None
 
 class SafeExpressionEvaluator:
     """Evaluador seguro de expresiones lógicas"""
@@ -62,9 +77,40 @@ class SafeExpressionEvaluator:
         'max': max,
     }
     
+    # Nodos AST que acepta compile_expression (los mismos que resuelve _eval_node)
+    ALLOWED_NODES = (
+        ast.Expression, ast.Constant, ast.Name, ast.Load, ast.List,
+        ast.Compare, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq, ast.In, ast.NotIn,
+        ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.Call,
+    )
+    
     def __init__(self, facts: Dict[str, Any]):
         self.facts = facts
+    
+    @classmethod
+    def compile_expression(cls, expression: str) -> CodeType:
+        """Valida la expresión contra la lista blanca de nodos y la compila una sola vez"""
+        tree = ast.parse(expression, mode='eval')
+        
+        for node in ast.walk(tree):
+            if not isinstance(node, cls.ALLOWED_NODES):
+                raise ValueError(f"Nodo AST no permitido: {type(node)}")
+            if isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name) or node.keywords):
+                raise ValueError(f"Función no permitida: {ast.dump(node.func)}")
         
+        return compile(tree, '<rule>', 'eval')
+    
+    def evaluate_compiled(self, code: CodeType) -> Any:
+        """Evalúa una expresión ya validada y compilada con compile_expression"""
+        try:
+            # Las funciones permitidas tienen precedencia sobre los hechos
+            scope = _FactsScope(self.facts)
+            scope.update(self.ALLOWED_FUNCTIONS)
+            return eval(code, {"__builtins__": {}}, scope)
+        except Exception as e:
+            logger.debug("Error evaluando expresión compilada: %s", e)
+            return False
+    
     def evaluate(self, expression: str) -> Any:
         """Evalúa una expresión de forma segura"""
         try:
@@ -72,7 +118,7 @@ class SafeExpressionEvaluator:
             tree = ast.parse(expression, mode='eval')
             return self._eval_node(tree.body)
         except Exception as e:
-            print(f"Error evaluando expresión '{expression}': {e}")
+            logger.debug("Error evaluando expresión '%s': %s", expression, e)
             return False
     
     def _eval_node(self, node) -> Any:
@@ -151,14 +197,23 @@ class InferenceEngine:
         self.facts = {}
         self.inference_steps = []
     
+    @classmethod
+    def fresh(cls, rules: List[Dict], pre_sorted: bool = False) -> 'InferenceEngine':
+        """Crea un motor con las reglas dadas, sin leer el archivo de reglas"""
+        engine = cls.__new__(cls)
+        engine.rules = list(rules) if pre_sorted else sorted(rules, key=_priority_key)
+        engine.facts = {}
+        engine.inference_steps = []
+        return engine
+    
     def _load_rules(self, rules_file: str) -> List[Dict]:
         """Carga las reglas desde archivo JSON"""
         try:
             with open(rules_file, 'r', encoding='utf-8') as f:
                 data = json.load(f)
-                return sorted(data.get('rules', []), key=lambda x: x.get('priority', 999))
+                return sorted(data.get('rules', []), key=_priority_key)
         except Exception as e:
-            print(f"Error cargando reglas: {e}")
+            logger.error("Error cargando reglas: %s", e)
             return []
     
     def forward_chaining(self, initial_facts: Dict[str, Any], max_iterations: int = 100) -> InferenceResult:
@@ -172,6 +227,7 @@ class InferenceEngine:
         
         conclusions = []
         actions_taken = []
+        fired_ids = set()
         
         # Agregar funciones especiales a los hechos
         self._add_special_functions()
@@ -188,6 +244,7 @@ class InferenceEngine:
                     if step and step.condition_result:
                         # Regla disparada
                         self.inference_steps.append(step)
+                        fired_ids.add(step.rule_id)
                         
                         # Ejecutar acción
                         action_result = self._execute_action(rule['action'], rule)
@@ -213,15 +270,19 @@ class InferenceEngine:
             actions_taken=actions_taken,
             steps=self.inference_steps,
             final_facts=self.facts.copy(),
-            execution_time=execution_time
+            execution_time=execution_time,
+            fired_ids=fired_ids
         )
     
     def _add_special_functions(self):
         """Agregar funciones especiales disponibles en las reglas"""
-        self.facts['days_since'] = lambda date: (datetime.now() - date).days if date else 999
-        self.facts['hours_since'] = lambda date: (datetime.now() - date).total_seconds() / 3600 if date else 999
-        self.facts['is_weekend'] = lambda: datetime.now().weekday() >= 5
-        self.facts['current_hour'] = datetime.now().hour
+        # Un único "ahora" para toda la inferencia
+        now = datetime.now()
+        weekend = now.weekday() >= 5
+        self.facts['days_since'] = lambda date: (now - date).days if date else 999
+        self.facts['hours_since'] = lambda date: (now - date).total_seconds() / 3600 if date else 999
+        self.facts['is_weekend'] = lambda: weekend
+        self.facts['current_hour'] = now.hour
     
     def _should_evaluate_rule(self, rule: Dict) -> bool:
         """Determina si una regla debe ser evaluada"""
@@ -257,7 +318,7 @@ class InferenceEngine:
             )
             
         except Exception as e:
-            print(f"Error evaluando regla {rule['id']}: {e}")
+            logger.warning("Error evaluando regla %s: %s", rule['id'], e)
             return None
     
     def _execute_action(self, action: str, rule: Dict) -> Optional[str]:
@@ -292,11 +353,11 @@ class InferenceEngine:
                     return "Requiere aprobación supervisor"
                 
                 else:
-                    print(f"Acción no reconocida: {func_name}")
+                    logger.warning("Acción no reconocida: %s", func_name)
                     return None
             
         except Exception as e:
-            print(f"Error ejecutando acción '{action}': {e}")
+            logger.warning("Error ejecutando acción '%s': %s", action, e)
             return None
     
     def _extract_string_arg(self, arg_str: str) -> str:
@@ -1,17 +1,190 @@
 # expert/rules_manager.py - Gestor de reglas con validaciones
+import bisect
+import functools
 import json
+import logging
 import os
 import shutil
+import threading
+import zipfile
 from datetime import datetime
-from typing import Dict, List, Any, Optional, Tuple
+from types import MappingProxyType
+from typing import Dict, List, Any, Mapping, Optional, Tuple
 from expert.inference_engine import SafeExpressionEvaluator
 
+logger = logging.getLogger(__name__)
+
+# orjson es opcional: si no está instalado se usa json de la stdlib
+try:
+    import orjson
+    _loads = orjson.loads
+    
+    def _dumps_rules(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:
+    _loads = json.loads
+    
+    def _dumps_rules(obj: Any) -> bytes:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+
+def _priority_key(rule: Dict[str, Any]) -> int:
+    """Clave de orden de las reglas por prioridad"""
+    return rule.get("priority", 999)
+
+# Validadores puros (solo dependen del texto): resultados cacheados por entrada
+@functools.lru_cache(maxsize=512)
+def _validate_condition(condition: str) -> Tuple[bool, str]:
+    """Valida la sintaxis y seguridad de una condición"""
+    if not condition or not condition.strip():
+        return False, "Condición no puede estar vacía"
+    
+    # Test facts para validación
+    test_facts = {
+        'motivo': 'ART',
+        'duracion': 5,
+        'ausencias_ultimo_mes': 2,
+        'certificate_uploaded': False,
+        'certificate_deadline': datetime.now(),
+        'validation_status': 'validated',
+        'sector': 'linea1',
+        'current_hour': 14
+    }
+    
+    # Agregar funciones especiales para testing
+    test_facts['hours_since'] = lambda x: 24
+    test_facts['days_since'] = lambda x: 1
+    test_facts['is_weekend'] = lambda: False
+    
+    try:
+        # Intentar evaluar la condición
+        evaluator = SafeExpressionEvaluator(test_facts)
+        result = evaluator.evaluate(condition)
+        
+        if result is False:  # False es un resultado válido
+            return True, "Condición válida (evalúa a False)"
+        elif result is True:  # True es un resultado válido
+            return True, "Condición válida (evalúa a True)"
+        elif isinstance(result, bool):  # Cualquier otro booleano
+            return True, "Condición válida"
+        else:
+            return False, "La condición debe evaluar a True/False"
+        
+    except Exception as e:
+        return False, f"Error en condición: {str(e)[:100]}"
+
+@functools.lru_cache(maxsize=512)
+def _validate_action(action: str, allowed_actions: Tuple[str, ...]) -> Tuple[bool, str]:
+    """Valida que la acción sea segura y permitida"""
+    if not action or not action.strip():
+        return False, "Acción no puede estar vacía"
+    
+    # Verificar formato función(argumentos)
+    if '(' not in action or ')' not in action:
+        return False, "Acción debe tener formato: función('argumentos')"
+    
+    # Extraer nombre de función
+    func_name = action.split('(')[0].strip()
+    
+    if func_name not in allowed_actions:
+        return False, f"Acción '{func_name}' no permitida. Permitidas: {', '.join(allowed_actions)}"
+    
+    # Validaciones específicas por acción
+    if func_name == 'add_observacion':
+        if not ("'" in action or '"' in action):
+            return False, "add_observacion requiere un mensaje entre comillas"
+    
+    elif func_name == 'set_fact':
+        # set_fact('nombre_hecho', 'valor')
+        if action.count(',') != 1:
+            return False, "set_fact requiere exactamente 2 argumentos: nombre y valor"
+    
+    return True, "Acción válida"
+
+@functools.lru_cache(maxsize=512)
+def _validate_severity(severity: str) -> Tuple[bool, str]:
+    """Valida el nivel de severidad"""
+    valid_severities = ['info', 'warning', 'error']
+    
+    if severity not in valid_severities:
+        return False, f"Severidad debe ser una de: {', '.join(valid_severities)}"
+    
+    return True, "Severidad válida"
+
+def _rule_index(existing_rules: List[Dict]) -> Tuple[set, set]:
+    """IDs y prioridades de las reglas existentes, en una sola pasada"""
+    ids = set()
+    priorities = set()
+    for rule in existing_rules:
+        ids.add(rule.get("id"))
+        priorities.add(rule.get("priority", 999))
+    return ids, priorities
+
+def _check_rule_id(rule_id: str, existing_ids: set) -> Tuple[bool, str]:
+    """Valida formato y unicidad de un ID contra los IDs existentes"""
+    if not rule_id or not rule_id.strip():
+        return False, "ID de regla no puede estar vacío"
+    
+    if not rule_id.replace('_', '').replace('-', '').isalnum():
+        return False, "ID debe contener solo letras, números, guiones y guiones bajos"
+    
+    if len(rule_id) > 50:
+        return False, "ID no puede exceder 50 caracteres"
+    
+    # Verificar unicidad
+    if rule_id in existing_ids:
+        return False, f"Ya existe una regla con ID '{rule_id}'"
+    
+    return True, "ID válido"
+
+def _check_priority(priority: int, existing_priorities: set) -> Tuple[bool, str]:
+    """Valida rango de una prioridad y advierte si ya está en uso"""
+    if not isinstance(priority, int):
+        return False, "Prioridad debe ser un número entero"
+    
+    if priority < 1 or priority > 100:
+        return False, "Prioridad debe estar entre 1 y 100"
+    
+    # Advertir si hay conflicto de prioridades
+    if priority in existing_priorities:
+        return True, f"Advertencia: Ya existe una regla con prioridad {priority}"
+    
+    return True, "Prioridad válida"
+
 class RulesManager:
     """Gestor para crear, editar y validar reglas del sistema experto"""
     
-    def __init__(self, rules_file: str = 'expert/advanced_rules.json'):
+    # Ejemplos mostrados a usuarios no técnicos
+    EXAMPLE_CONDITIONS = (
+        "motivo == 'ART'",
+        "duracion > 5",
+        "ausencias_ultimo_mes >= 3",
+        "not certificate_uploaded",
+        "motivo in ['ART', 'Licencia Enfermedad Personal']",
+        "duracion > 3 and not certificate_uploaded",
+        "hours_since(certificate_deadline) > 0"
+    )
+    
+    EXAMPLE_ACTIONS = (
+        "add_observacion('Certificado requerido')",
+        "mark_sanction()",
+        "require_approval()",
+        "set_fact('riesgo_empleado', 'alto')"
+    )
+    
+    # Serializa las escrituras del zip de backups entre instancias e hilos
+    _backup_lock = threading.Lock()
+    
+    # Reglas por archivo, compartidas entre instancias: ruta -> ((mtime_ns, tamaño), bytes, reglas parseadas)
+    _rules_cache: Dict[str, Tuple[Tuple[int, int], bytes, Dict[str, Any]]] = {}
+    
+    def __init__(self, rules_file: str = 'expert/advanced_rules.json', backup: bool = True):
         self.rules_file = rules_file
+        self.backup = backup  # False en scripts de prueba: no se generan backups al guardar
         self.backup_dir = 'expert/backups'
+        self.backup_archive = os.path.join(self.backup_dir, 'rules_backups.zip')
+        
+        # Backups listados: ((mtime_ns del directorio, (mtime_ns, tamaño) del zip), nombres)
+        self._backups_cache: Optional[Tuple[tuple, Tuple[str, ...]]] = None
         self._ensure_backup_dir()
         
         # Acciones permitidas para usuarios no técnicos
@@ -35,183 +208,249 @@ class RulesManager:
             'Licencia por Fallecimiento Familiar', 'Licencia por Matrimonio',
             'Licencia por Nacimiento', 'Licencia por Paternidad', 'Permiso Gremial'
         ]
+        
+        # Sugerencias para usuarios: se arman una sola vez y se comparten
+        self._suggestions = MappingProxyType({
+            "motivos_validos": self.valid_motivos,
+            "variables_disponibles": self.allowed_variables,
+            "acciones_permitidas": self.allowed_actions,
+            "ejemplos_condiciones": self.EXAMPLE_CONDITIONS,
+            "ejemplos_acciones": self.EXAMPLE_ACTIONS
+        })
     
     def _ensure_backup_dir(self):
         """Asegura que el directorio de backups existe"""
         if not os.path.exists(self.backup_dir):
             os.makedirs(self.backup_dir)
     
+    def _legacy_backups(self) -> List[str]:
+        """Backups sueltos (un .json por backup) de versiones anteriores"""
+        return sorted(entry.name for entry in os.scandir(self.backup_dir)
+                      if entry.name.startswith("rules_backup_") and entry.name.endswith(".json"))
+    
+    def _append_to_archive(self, members: List[Tuple[str, str]]):
+        """Agrega (ruta, nombre) al zip de backups sin modificar el original en el lugar.
+        
+        Se escribe una copia temporal que reemplaza al zip con os.replace: un corte a mitad
+        de camino deja intacto el archivo anterior. El lock serializa los guardados concurrentes.
+        """
+        tmp_path = f"{self.backup_archive}.{os.getpid()}.tmp"
+        with self._backup_lock:
+            try:
+                mode = 'w'
+                if os.path.exists(self.backup_archive):
+                    shutil.copyfile(self.backup_archive, tmp_path)
+                    mode = 'a'
+                    # En modo 'a' zipfile no valida el archivo (lo agregaría al final de la basura)
+                    try:
+                        zipfile.ZipFile(tmp_path).close()
+                    except zipfile.BadZipFile:
+                        # Zip dañado: se aparta para revisarlo y se empieza uno nuevo
+                        logger.error("[RULES] Archivo de backups dañado, se aparta como %s.bad", self.backup_archive)
+                        os.replace(self.backup_archive, f"{self.backup_archive}.bad")
+                        mode = 'w'
+                with zipfile.ZipFile(tmp_path, mode, compression=zipfile.ZIP_DEFLATED) as zf:
+                    existing = set(zf.namelist())
+                    for path, name in members:
+                        if name not in existing:
+                            zf.write(path, name)
+                os.replace(tmp_path, self.backup_archive)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    
+    def migrate_legacy_backups(self) -> int:
+        """Pasa los backups sueltos de versiones anteriores al zip y los borra.
+        
+        Paso de migración explícito (migrate_database.py); devuelve cuántos se movieron.
+        """
+        legacy = self._legacy_backups()
+        if not legacy:
+            return 0
+        
+        self._append_to_archive([(os.path.join(self.backup_dir, name), name) for name in legacy])
+        for name in legacy:
+            os.remove(os.path.join(self.backup_dir, name))
+        return len(legacy)
+    
     def _create_backup(self) -> str:
-        """Crea backup del archivo de reglas actual"""
+        """Agrega el archivo de reglas actual al zip de backups"""
         if not os.path.exists(self.rules_file):
             return None
-            
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
         backup_filename = f"rules_backup_{timestamp}.json"
-        backup_path = os.path.join(self.backup_dir, backup_filename)
         
-        shutil.copy2(self.rules_file, backup_path)
-        return backup_path
+        # Un solo archivo para todos los backups
+        self._append_to_archive([(self.rules_file, backup_filename)])
+        return f"{self.backup_archive}/{backup_filename}"
+    
+    def list_backups(self) -> Tuple[str, ...]:
+        """Nombres de los backups guardados (zip y sueltos sin migrar), del más antiguo al más reciente"""
+        try:
+            dir_mtime = os.stat(self.backup_dir).st_mtime_ns
+        except FileNotFoundError:
+            return ()
+        try:
+            st = os.stat(self.backup_archive)
+            archive_key = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            archive_key = None
+        
+        # Solo se vuelve a leer si cambió el directorio (altas/bajas/reemplazo del zip) o el zip
+        key = (dir_mtime, archive_key)
+        if self._backups_cache is None or self._backups_cache[0] != key:
+            names = set(self._legacy_backups())
+            if archive_key is not None:
+                try:
+                    # Solo se lee el directorio central del zip
+                    with zipfile.ZipFile(self.backup_archive) as zf:
+                        names.update(name for name in zf.namelist() if name.startswith("rules_backup_"))
+                except zipfile.BadZipFile as e:
+                    logger.error("[RULES] No se pudo leer el archivo de backups: %s", e)
+            self._backups_cache = (key, tuple(sorted(names)))
+        return self._backups_cache[1]
+    
+    def _cached_entry(self) -> Tuple[Tuple[int, int], bytes, Dict[str, Any]]:
+        """Contenido del archivo de reglas; solo se relee del disco si cambió"""
+        st = os.stat(self.rules_file)
+        key = (st.st_mtime_ns, st.st_size)
+        cached = self._rules_cache.get(self.rules_file)
+        if cached is None or cached[0] != key:
+            with open(self.rules_file, 'rb') as f:
+                raw = f.read()
+            cached = (key, raw, _loads(raw))
+            self._rules_cache[self.rules_file] = cached
+        return cached
+    
+    def _cached_rules(self) -> Dict[str, Any]:
+        """Reglas parseadas compartidas (solo lectura, no modificar)"""
+        try:
+            return self._cached_entry()[2]
+        except Exception as e:
+            logger.error("Error cargando reglas: %s", e)
+            return {"rules": [], "metadata": {}}
     
     def load_rules(self) -> Dict[str, Any]:
-        """Carga las reglas desde el archivo JSON"""
+        """Carga las reglas desde el archivo JSON (copia propia, el llamador puede modificarla)"""
         try:
-            with open(self.rules_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            # Volver a parsear los bytes cacheados es más barato que un deepcopy
+            return _loads(self._cached_entry()[1])
         except Exception as e:
-            print(f"Error cargando reglas: {e}")
+            logger.error("Error cargando reglas: %s", e)
             return {"rules": [], "metadata": {}}
     
     def save_rules(self, rules_data: Dict[str, Any]) -> bool:
         """Guarda las reglas al archivo JSON con backup"""
         try:
             # Crear backup antes de guardar
-            backup_path = self._create_backup()
-            if backup_path:
-                print(f"[RULES] Backup creado: {backup_path}")
+            if self.backup:
+                backup_path = self._create_backup()
+                if backup_path:
+                    logger.debug("[RULES] Backup creado: %s", backup_path)
             
             # Actualizar metadata
             rules_data["metadata"]["last_updated"] = datetime.now().strftime('%Y-%m-%d')
             rules_data["metadata"]["total_rules"] = len(rules_data.get("rules", []))
             
-            # Guardar archivo
-            with open(self.rules_file, 'w', encoding='utf-8') as f:
-                json.dump(rules_data, f, indent=2, ensure_ascii=False)
+            # Serializar completo en memoria y escribir de una sola vez
+            payload = _dumps_rules(rules_data)
+            with open(self.rules_file, 'wb') as f:
+                f.write(payload)
             
-            print(f"[RULES] Reglas guardadas exitosamente")
+            # La próxima lectura vuelve a parsear el archivo recién escrito
+            self._rules_cache.pop(self.rules_file, None)
+            
+            logger.debug("[RULES] Reglas guardadas exitosamente")
             return True
         
         except Exception as e:
-            print(f"[RULES] Error guardando reglas: {e}")
+            logger.error("[RULES] Error guardando reglas: %s", e)
             return False
     
     def validate_rule_id(self, rule_id: str, existing_rules: List[Dict]) -> Tuple[bool, str]:
         """Valida que el ID de regla sea único y válido"""
-        if not rule_id or not rule_id.strip():
-            return False, "ID de regla no puede estar vacío"
-        
-        if not rule_id.replace('_', '').replace('-', '').isalnum():
-            return False, "ID debe contener solo letras, números, guiones y guiones bajos"
-        
-        if len(rule_id) > 50:
-            return False, "ID no puede exceder 50 caracteres"
-        
-        # Verificar unicidad
-        if any(rule.get("id") == rule_id for rule in existing_rules):
-            return False, f"Ya existe una regla con ID '{rule_id}'"
-        
-        return True, "ID válido"
+        return _check_rule_id(rule_id, {rule.get("id") for rule in existing_rules})
     
     def validate_condition(self, condition: str) -> Tuple[bool, str]:
         """Valida la sintaxis y seguridad de una condición"""
-        if not condition or not condition.strip():
-            return False, "Condición no puede estar vacía"
-        
-        # Test facts para validación
-        test_facts = {
-            'motivo': 'ART',
-            'duracion': 5,
-            'ausencias_ultimo_mes': 2,
-            'certificate_uploaded': False,
-            'certificate_deadline': datetime.now(),
-            'validation_status': 'validated',
-            'sector': 'linea1',
-            'current_hour': 14
-        }
-        
-        # Agregar funciones especiales para testing
-        test_facts['hours_since'] = lambda x: 24
-        test_facts['days_since'] = lambda x: 1
-        test_facts['is_weekend'] = lambda: False
-        
-        try:
-            # Intentar evaluar la condición
-            evaluator = SafeExpressionEvaluator(test_facts)
-            result = evaluator.evaluate(condition)
-            
-            if result is False:  # False es un resultado válido
-                return True, "Condición válida (evalúa a False)"
-            elif result is True:  # True es un resultado válido
-                return True, "Condición válida (evalúa a True)"
-            elif isinstance(result, bool):  # Cualquier otro booleano
-                return True, "Condición válida"
-            else:
-                return False, "La condición debe evaluar a True/False"
-            
-        except Exception as e:
-            return False, f"Error en condición: {str(e)[:100]}"
+        # El cache exige texto: listas/dicts del JSON se rechazan antes
+        if not isinstance(condition, str):
+            return False, "Condición debe ser un texto" if condition else "Condición no puede estar vacía"
+        return _validate_condition(condition)
     
     def validate_action(self, action: str) -> Tuple[bool, str]:
         """Valida que la acción sea segura y permitida"""
-        if not action or not action.strip():
-            return False, "Acción no puede estar vacía"
-        
-        # Verificar formato función(argumentos)
-        if '(' not in action or ')' not in action:
-            return False, "Acción debe tener formato: función('argumentos')"
-        
-        # Extraer nombre de función
-        func_name = action.split('(')[0].strip()
-        
-        if func_name not in self.allowed_actions:
-            return False, f"Acción '{func_name}' no permitida. Permitidas: {', '.join(self.allowed_actions)}"
-        
-        # Validaciones específicas por acción
-        if func_name == 'add_observacion':
-            if not ("'" in action or '"' in action):
-                return False, "add_observacion requiere un mensaje entre comillas"
-        
-        elif func_name == 'set_fact':
-            # set_fact('nombre_hecho', 'valor')
-            if action.count(',') != 1:
-                return False, "set_fact requiere exactamente 2 argumentos: nombre y valor"
-        
-        return True, "Acción válida"
+        if not isinstance(action, str):
+            return False, "Acción debe ser un texto" if action else "Acción no puede estar vacía"
+        return _validate_action(action, tuple(self.allowed_actions))
     
-    def validate_priority(self, priority: int, existing_rules: List[Dict]) -> Tuple[bool, str]:
-        """Valida la prioridad de la regla"""
-        if not isinstance(priority, int):
-            return False, "Prioridad debe ser un número entero"
-        
-        if priority < 1 or priority > 100:
-            return False, "Prioridad debe estar entre 1 y 100"
-        
-        # Advertir si hay conflicto de prioridades
-        existing_priorities = [rule.get("priority", 999) for rule in existing_rules]
-        if priority in existing_priorities:
-            return True, f"Advertencia: Ya existe una regla con prioridad {priority}"
-        
-        return True, "Prioridad válida"
+    def validate_priority(self, priority: int, existing_rules: List[Dict],
+                          exclude_id: Optional[str] = None) -> Tuple[bool, str]:
+        """Valida la prioridad de la regla (ignorando la regla exclude_id)"""
+        if exclude_id is None:
+            priorities = {rule.get("priority", 999) for rule in existing_rules}
+        else:
+            priorities = {rule.get("priority", 999) for rule in existing_rules
+                          if rule.get("id") != exclude_id}
+        return _check_priority(priority, priorities)
+    
+    def validate_rule(self, rule: Dict[str, Any],
+                      existing_rules: Optional[List[Dict]] = None) -> Dict[str, Tuple[bool, str]]:
+        """Valida los campos presentes de una regla (id, condition, action, priority, severity).
+        
+        Las reglas existentes se recorren una sola vez; sin existing_rules se usan las cacheadas.
+        """
+        if existing_rules is None:
+            existing_rules = self._cached_rules().get("rules", [])
+        ids, priorities = _rule_index(existing_rules)
+        
+        results = {}
+        if "id" in rule:
+            results["id"] = _check_rule_id(rule["id"], ids)
+        if "condition" in rule:
+            results["condition"] = self.validate_condition(rule["condition"])
+        if "action" in rule:
+            results["action"] = self.validate_action(rule["action"])
+        if "priority" in rule:
+            results["priority"] = _check_priority(rule["priority"], priorities)
+        if "severity" in rule:
+            results["severity"] = self.validate_severity(rule["severity"])
+        return results
     
     def validate_severity(self, severity: str) -> Tuple[bool, str]:
         """Valida el nivel de severidad"""
-        valid_severities = ['info', 'warning', 'error']
-        
-        if severity not in valid_severities:
-            return False, f"Severidad debe ser una de: {', '.join(valid_severities)}"
-        
-        return True, "Severidad válida"
+        # Cualquier valor que no sea texto es una severidad inválida
+        return _validate_severity(severity if isinstance(severity, str) else "")
     
     def add_rule(self, rule_data: Dict[str, Any]) -> Tuple[bool, str]:
         """Agrega una nueva regla con validaciones completas"""
         
         # Cargar reglas existentes
         rules_json = self.load_rules()
-        existing_rules = rules_json.get("rules", [])
-        
-        # Validar todos los campos
-        validations = [
-            self.validate_rule_id(rule_data.get("id", ""), existing_rules),
-            self.validate_condition(rule_data.get("condition", "")),
-            self.validate_action(rule_data.get("action", "")),
-            self.validate_priority(rule_data.get("priority", 0), existing_rules),
-            self.validate_severity(rule_data.get("severity", ""))
-        ]
+        ids, priorities = _rule_index(rules_json.get("rules", []))
         
-        # Verificar si hay errores
-        for valid, message in validations:
-            if not valid:
-                return False, message
+        # Validar campos de menor a mayor costo; la condición (que se evalúa)
+        # va al final para rechazar errores simples sin tocar el evaluador
+        valid, message = self.validate_severity(rule_data.get("severity", ""))
+        if not valid:
+            return False, message
+
+        valid, message = _check_rule_id(rule_data.get("id", ""), ids)
+        if not valid:
+            return False, message
+
+        valid, message = _check_priority(rule_data.get("priority", 0), priorities)
+        if not valid:
+            return False, message
+
+        valid, message = self.validate_action(rule_data.get("action", ""))
+        if not valid:
+            return False, message
+
+        valid, message = self.validate_condition(rule_data.get("condition", ""))
+        if not valid:
+            return False, message
         
         # Crear nueva regla
         new_rule = {
@@ -226,11 +465,8 @@ class RulesManager:
             "created_at": datetime.now().isoformat()
         }
         
-        # Agregar a la lista
-        rules_json["rules"].append(new_rule)
-        
-        # Ordenar por prioridad
-        rules_json["rules"].sort(key=lambda x: x.get("priority", 999))
+        # Insertar manteniendo el orden por prioridad
+        bisect.insort_right(rules_json["rules"], new_rule, key=_priority_key)
         
         # Guardar
         if self.save_rules(rules_json):
@@ -255,16 +491,15 @@ class RulesManager:
         if rule_index is None:
             return False, f"Regla con ID '{rule_id}' no encontrada"
         
-        # Validar cambios (excluyendo ID actual de validación de unicidad)
-        other_rules = rules[:rule_index] + rules[rule_index + 1:]
-        
+        # Validar cambios (excluyendo la regla actual de la validación de prioridad)
         validations = []
         if "condition" in updated_data:
             validations.append(self.validate_condition(updated_data["condition"]))
         if "action" in updated_data:
             validations.append(self.validate_action(updated_data["action"]))
         if "priority" in updated_data:
-            validations.append(self.validate_priority(updated_data["priority"], other_rules))
+            validations.append(self.validate_priority(updated_data["priority"], rules,
+                                                      exclude_id=rule_id))
         if "severity" in updated_data:
             validations.append(self.validate_severity(updated_data["severity"]))
         
@@ -274,12 +509,15 @@ class RulesManager:
                 return False, message
         
         # Actualizar regla
-        rules[rule_index].update(updated_data)
-        rules[rule_index]["updated_at"] = datetime.now().isoformat()
+        rule = rules[rule_index]
+        old_priority = _priority_key(rule)
+        rule.update(updated_data)
+        rule["updated_at"] = datetime.now().isoformat()
         
-        # Reordenar por prioridad si cambió
-        if "priority" in updated_data:
-            rules.sort(key=lambda x: x.get("priority", 999))
+        # Reubicar por prioridad solo si cambió
+        if _priority_key(rule) != old_priority:
+            rules.pop(rule_index)
+            bisect.insort_right(rules, rule, key=_priority_key)
         
         # Guardar
         if self.save_rules(rules_json):
@@ -307,32 +545,14 @@ class RulesManager:
         else:
             return False, "Error al guardar cambios"
     
-    def get_rule_suggestions(self) -> Dict[str, Any]:
-        """Proporciona sugerencias para crear reglas"""
-        return {
-            "motivos_validos": self.valid_motivos,
-            "variables_disponibles": self.allowed_variables,
-            "acciones_permitidas": self.allowed_actions,
-            "ejemplos_condiciones": [
-                "motivo == 'ART'",
-                "duracion > 5",
-                "ausencias_ultimo_mes >= 3",
-                "not certificate_uploaded",
-                "motivo in ['ART', 'Licencia Enfermedad Personal']",
-                "duracion > 3 and not certificate_uploaded",
-                "hours_since(certificate_deadline) > 0"
-            ],
-            "ejemplos_acciones": [
-                "add_observacion('Certificado requerido')",
-                "mark_sanction()",
-                "require_approval()",
-                "set_fact('riesgo_empleado', 'alto')"
-            ]
-        }
+    def get_rule_suggestions(self) -> Mapping[str, Any]:
+        """Proporciona sugerencias para crear reglas (vista de solo lectura)"""
+        return self._suggestions
     
     def get_rules_stats(self) -> Dict[str, Any]:
         """Obtiene estadísticas de las reglas"""
-        rules_json = self.load_rules()
+        # Solo lectura: usa las reglas cacheadas sin copiarlas ni releer el archivo
+        rules_json = self._cached_rules()
         rules = rules_json.get("rules", [])
         
         if not rules:
@@ -354,8 +574,7 @@ class RulesManager:
                 "max": max(priority_range) if priority_range else 0
             },
             "last_updated": rules_json.get("metadata", {}).get("last_updated", "unknown"),
-            "backups_available": len([f for f in os.listdir(self.backup_dir) 
-                                    if f.startswith("rules_backup_")])
+            "backups_available": len(self.list_backups())
         }
 
 def test_rules_manager():
@@ -1,23 +1,176 @@
 # expert/rules_monitoring.py - Sistema de monitoreo de reglas
+import atexit
+import functools
+import os
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Dict, List, Any, Optional
+from typing import Dict, Iterable, List, Any, Optional, Tuple
 from collections import defaultdict, Counter
 import json
+from operator import itemgetter
 from expert.rules_manager import RulesManager
 
+# orjson es opcional: si no está instalado se usa json de la stdlib
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    def _dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+# PRAGMAs aplicados a cada conexión de monitoreo
+_CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA wal_autocheckpoint=0",    # los checkpoints los hace el hilo de fondo
+)
+
+# Orden de las alertas por severidad (menor = más urgente)
+_SEV_RANK = {"critical": 0, "warning": 1, "info": 2}
+
+# Segundos entre checkpoints del WAL en segundo plano
+_CHECKPOINT_INTERVAL = 30
+
+# Conexiones de solo lectura que se mantienen abiertas para el dashboard
+_READ_POOL_SIZE = 4
+
+@functools.lru_cache(maxsize=1)
+def _now_iso(sec: int) -> str:
+    """Timestamp ISO del segundo dado (se reutiliza mientras no cambie el segundo)"""
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(sec))
+
 class RulesMonitoring:
     """Sistema de monitoreo y análisis de reglas activas"""
     
     def __init__(self, database_path: str = 'test.db'):
         self.database_path = database_path
         self.rules_manager = RulesManager()
+        self._wal_enabled = False
+        
+        # Buffer de ejecuciones pendientes de persistir
+        self._buffer: List[tuple] = []
+        self._buffer_limit = 200
+        self._buffer_lock = threading.Lock()
+        
+        # Cache de dashboards: (days,) -> (instante monotónico, dashboard)
+        self._dash_cache: Dict[tuple, Tuple[float, Dict[str, Any]]] = {}
+        self._dashboard_ttl = 60
+        
+        # Cache de reglas: (mtime del archivo, reglas cargadas)
+        self._rules_cache: Optional[Tuple[float, Dict[str, Any]]] = None
+        
+        # Cache de salud del sistema: (mtime del archivo de reglas,) -> estado
+        self._health_cache: Dict[tuple, Dict[str, Any]] = {}
+        
+        # Una única conexión de escritura y un pool de lectores de solo lectura
+        self._writer_lock = threading.RLock()
+        self._writer = self._connect()
+        self._read_pool: queue.Queue = queue.Queue(maxsize=_READ_POOL_SIZE)
+        
         self._ensure_monitoring_tables()
+        atexit.register(self.close)
+        
+        # Checkpoint periódico del WAL fuera de los métodos de escritura/lectura
+        self._checkpoint_stop = threading.Event()
+        if self.database_path != ':memory:':
+            threading.Thread(target=self._checkpoint_loop, daemon=True).start()
+    
+    def _connect(self, mode: str = 'rwc') -> sqlite3.Connection:
+        """Abre una conexión en modo autocommit con los PRAGMAs de rendimiento"""
+        # cached_statements amplio: el dashboard reutiliza las mismas consultas preparadas
+        if self.database_path == ':memory:':
+            conn = sqlite3.connect(':memory:', isolation_level=None, cached_statements=256,
+                                   check_same_thread=False)
+        else:
+            conn = sqlite3.connect(f"file:{self.database_path}?mode={mode}", uri=True,
+                                   isolation_level=None, cached_statements=256,
+                                   check_same_thread=False)
+        
+        # journal_mode=WAL persiste en el archivo: alcanza con fijarlo una vez
+        if not self._wal_enabled and mode != 'ro' and self.database_path != ':memory:':
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._wal_enabled = True
+        
+        for pragma in _CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
+    def _checkpoint_loop(self):
+        """Vuelca y trunca el WAL cada _CHECKPOINT_INTERVAL segundos"""
+        while not self._checkpoint_stop.wait(_CHECKPOINT_INTERVAL):
+            try:
+                with self._writer_lock:
+                    if self._writer is None:
+                        return
+                    self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.Error as e:
+                print(f"[MONITORING] Error en checkpoint del WAL: {e}")
+    
+    @contextmanager
+    def _connect_read(self):
+        """Toma una conexión de solo lectura del pool y la devuelve al salir"""
+        if self.database_path == ':memory:':
+            # Una base en memoria solo existe dentro de la conexión de escritura
+            with self._writer_lock:
+                yield self._writer
+            return
+        
+        try:
+            conn = self._read_pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect('ro')
+        
+        try:
+            yield conn
+        finally:
+            try:
+                self._read_pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+    
+    def close(self):
+        """Persiste las ejecuciones pendientes y cierra todas las conexiones"""
+        if self._writer is None:
+            return
+        
+        self._checkpoint_stop.set()
+        self.flush()
+        
+        with self._writer_lock:
+            # Refresca solo las estadísticas del planificador que quedaron viejas
+            try:
+                self._writer.execute("PRAGMA optimize")
+            except sqlite3.Error:
+                pass
+            self._writer.close()
+            self._writer = None
+        
+        while True:
+            try:
+                self._read_pool.get_nowait().close()
+            except queue.Empty:
+                break
+    
+    def _rules(self) -> Dict[str, Any]:
+        """Reglas actuales; solo se vuelven a leer si cambió el archivo"""
+        try:
+            mtime = os.stat(self.rules_manager.rules_file).st_mtime
+        except OSError:
+            return self.rules_manager.load_rules()
+        
+        if self._rules_cache is None or self._rules_cache[0] != mtime:
+            self._rules_cache = (mtime, self.rules_manager.load_rules())
+        return self._rules_cache[1]
     
     def _ensure_monitoring_tables(self):
         """Crea tablas de monitoreo si no existen"""
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+        cursor = self._writer.cursor()
         
         # Tabla de ejecuciones de reglas
         cursor.execute("""
@@ -26,15 +179,26 @@ class RulesMonitoring:
                 rule_id TEXT NOT NULL,
                 rule_name TEXT NOT NULL,
                 executed_at DATETIME NOT NULL,
-                case_facts TEXT NOT NULL,              -- JSON con los hechos del caso
+                case_facts BLOB NOT NULL,              -- JSON (UTF-8) con los hechos del caso
                 condition_result BOOLEAN NOT NULL,
                 action_executed TEXT,
                 execution_time_ms REAL NOT NULL,
                 absence_id INTEGER,                    -- FK a tabla absences si existe
+                hour_bucket INTEGER GENERATED ALWAYS AS (CAST(strftime('%H', executed_at) AS INTEGER)) VIRTUAL,
+                dow_bucket INTEGER GENERATED ALWAYS AS (CAST(strftime('%w', executed_at) AS INTEGER)) VIRTUAL,
                 FOREIGN KEY (absence_id) REFERENCES absences (id)
             )
         """)
         
+        # Agregar buckets de hora/día de la semana a tablas rule_executions anteriores
+        existing_columns = {row[1] for row in cursor.execute("PRAGMA table_xinfo(rule_executions)")}
+        for column_name, bucket_format in (('hour_bucket', '%H'), ('dow_bucket', '%w')):
+            if column_name not in existing_columns:
+                cursor.execute(f"""
+                    ALTER TABLE rule_executions ADD COLUMN {column_name} INTEGER
+                    GENERATED ALWAYS AS (CAST(strftime('{bucket_format}', executed_at) AS INTEGER)) VIRTUAL
+                """)
+        
         # Tabla de estadísticas agregadas de reglas
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS rule_stats (
@@ -44,102 +208,240 @@ class RulesMonitoring:
                 executions_count INTEGER DEFAULT 0,
                 successful_executions INTEGER DEFAULT 0,
                 avg_execution_time_ms REAL DEFAULT 0,
+                min_execution_time_ms REAL,
+                max_execution_time_ms REAL,
+                slow_executions INTEGER DEFAULT 0,     -- ejecuciones > 100ms
                 last_updated DATETIME DEFAULT CURRENT_TIMESTAMP,
                 UNIQUE(rule_id, date)
             )
         """)
         
-        conn.commit()
-        conn.close()
+        # Agregar columnas de performance a tablas rule_stats anteriores
+        existing_columns = {row[1] for row in cursor.execute("PRAGMA table_info(rule_stats)")}
+        added_columns = False
+        for column_name, column_type in (
+            ('min_execution_time_ms', 'REAL'),
+            ('max_execution_time_ms', 'REAL'),
+            ('slow_executions', 'INTEGER DEFAULT 0')
+        ):
+            if column_name not in existing_columns:
+                cursor.execute(f"ALTER TABLE rule_stats ADD COLUMN {column_name} {column_type}")
+                added_columns = True
+        
+        # Rellenar las columnas nuevas con el historial ya registrado
+        if added_columns:
+            cursor.execute("""
+                UPDATE rule_stats
+                SET min_execution_time_ms = agg.min_ms,
+                    max_execution_time_ms = agg.max_ms,
+                    slow_executions = agg.slow
+                FROM (
+                    SELECT rule_id,
+                           substr(executed_at, 1, 10) AS day,
+                           MIN(execution_time_ms) AS min_ms,
+                           MAX(execution_time_ms) AS max_ms,
+                           SUM(execution_time_ms > 100) AS slow
+                    FROM rule_executions
+                    GROUP BY rule_id, day
+                ) AS agg
+                WHERE rule_stats.rule_id = agg.rule_id AND rule_stats.date = agg.day
+            """)
+
+        # Índice cubriente para las consultas del dashboard por ventana de tiempo
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_rx_exec_time
+            ON rule_executions(executed_at, rule_id, condition_result, execution_time_ms)
+        """)
+        
+        # Índice para las alertas agrupadas por regla
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_rx_rule_time
+            ON rule_executions(rule_id, executed_at)
+        """)
+        
+        # Índice para los patrones por hora
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_rx_hour
+            ON rule_executions(hour_bucket)
+        """)
+        
+        # Estadísticas del planificador solo si la tabla todavía no tiene (ANALYZE recorre
+        # toda la tabla; después las mantiene al día PRAGMA optimize)
+        has_stat = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+        ).fetchone()
+        if not has_stat or not cursor.execute(
+            "SELECT 1 FROM sqlite_stat1 WHERE tbl = 'rule_executions' LIMIT 1"
+        ).fetchone():
+            cursor.execute("ANALYZE rule_executions")
+        
         print("[MONITORING] Tablas de monitoreo inicializadas")
     
     def log_rule_execution(self, rule_id: str, rule_name: str, 
                           case_facts: Dict[str, Any], condition_result: bool,
                           action_executed: str, execution_time_ms: float,
                           absence_id: Optional[int] = None):
-        """Registra la ejecución de una regla"""
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute("""
-                INSERT INTO rule_executions 
-                (rule_id, rule_name, executed_at, case_facts, condition_result, 
-                 action_executed, execution_time_ms, absence_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                rule_id, rule_name, datetime.now().isoformat(),
-                json.dumps(case_facts), condition_result, action_executed,
-                execution_time_ms, absence_id
-            ))
+        """Registra la ejecución de una regla (se persiste en lotes)"""
+        row = self._make_execution_row(rule_id, rule_name, case_facts, condition_result,
+                                       action_executed, execution_time_ms, absence_id)
+        with self._buffer_lock:
+            self._buffer.append(row)
+            buffer_full = len(self._buffer) >= self._buffer_limit
+        
+        if buffer_full:
+            self.flush()
+    
+    def log_rule_execution_many(self, executions: Iterable[Dict[str, Any]]):
+        """Registra varias ejecuciones y las persiste en una sola transacción"""
+        rows = [self._make_execution_row(**execution) for execution in executions]
+        with self._buffer_lock:
+            self._buffer.extend(rows)
+        self.flush()
+    
+    def _make_execution_row(self, rule_id: str, rule_name: str,
+                            case_facts: Dict[str, Any], condition_result: bool,
+                            action_executed: str, execution_time_ms: float,
+                            absence_id: Optional[int] = None) -> tuple:
+        """Arma la fila de rule_executions para una ejecución"""
+        return (
+            rule_id, rule_name, _now_iso(int(time.time())),
+            _dumps(case_facts), condition_result, action_executed,
+            execution_time_ms, absence_id
+        )
+    
+    def flush(self):
+        """Persiste las ejecuciones pendientes en una única transacción"""
+        with self._buffer_lock:
+            rows, self._buffer = self._buffer, []
+        
+        if not rows:
+            return
+        
+        # Estadísticas agregadas: (rule_id, fecha, éxito, tiempo, mín, máx, lenta, timestamp)
+        # La fecha sale del mismo timestamp ISO (YYYY-MM-DD) que executed_at
+        stats_rows = [
+            (row[0], row[2][:10], 1 if row[4] else 0, row[6], row[6], row[6],
+             1 if row[6] > 100 else 0, row[2])
+            for row in rows
+        ]
+        
+        with self._writer_lock:
+            conn = self._writer
+            cursor = conn.cursor()
             
-            # Actualizar estadísticas agregadas
-            today = datetime.now().date().isoformat()
-            cursor.execute("""
-                INSERT OR REPLACE INTO rule_stats 
-                (rule_id, date, executions_count, successful_executions, avg_execution_time_ms, last_updated)
-                VALUES (
-                    ?, ?, 
-                    COALESCE((SELECT executions_count FROM rule_stats WHERE rule_id = ? AND date = ?), 0) + 1,
-                    COALESCE((SELECT successful_executions FROM rule_stats WHERE rule_id = ? AND date = ?), 0) + ?,
-                    (COALESCE((SELECT avg_execution_time_ms * executions_count FROM rule_stats WHERE rule_id = ? AND date = ?), 0) + ?) / 
-                     (COALESCE((SELECT executions_count FROM rule_stats WHERE rule_id = ? AND date = ?), 0) + 1),
-                    ?
-                )
-            """, (
-                rule_id, today, rule_id, today, rule_id, today,
-                1 if condition_result else 0, rule_id, today,
-                execution_time_ms, rule_id, today, datetime.now().isoformat()
-            ))
+            try:
+                # IMMEDIATE toma el lock de escritura al inicio y evita SQLITE_BUSY
+                cursor.execute("BEGIN IMMEDIATE")
+                cursor.executemany("""
+                    INSERT INTO rule_executions 
+                    (rule_id, rule_name, executed_at, case_facts, condition_result, 
+                     action_executed, execution_time_ms, absence_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, rows)
+                
+                cursor.executemany("""
+                    INSERT INTO rule_stats 
+                    (rule_id, date, executions_count, successful_executions, avg_execution_time_ms,
+                     min_execution_time_ms, max_execution_time_ms, slow_executions, last_updated)
+                    VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(rule_id, date) DO UPDATE SET
+                        executions_count = executions_count + 1,
+                        successful_executions = successful_executions + excluded.successful_executions,
+                        avg_execution_time_ms = (avg_execution_time_ms * executions_count + excluded.avg_execution_time_ms)
+                                                / (executions_count + 1),
+                        min_execution_time_ms = MIN(COALESCE(min_execution_time_ms, excluded.min_execution_time_ms),
+                                                    excluded.min_execution_time_ms),
+                        max_execution_time_ms = MAX(COALESCE(max_execution_time_ms, excluded.max_execution_time_ms),
+                                                    excluded.max_execution_time_ms),
+                        slow_executions = slow_executions + excluded.slow_executions,
+                        last_updated = excluded.last_updated
+                """, stats_rows)
+                
+                cursor.execute("COMMIT")
+                
+                # Los dashboards cacheados ya no reflejan los datos
+                self._dash_cache.clear()
             
-            conn.commit()
-        
-        except Exception as e:
-            print(f"[MONITORING] Error registrando ejecución: {e}")
-        finally:
-            conn.close()
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                print(f"[MONITORING] Error registrando {len(rows)} ejecuciones: {e}")
     
     def get_rules_dashboard(self, days: int = 7) -> Dict[str, Any]:
         """Obtiene dashboard completo de reglas"""
+        # Incluir ejecuciones todavía en el buffer (si las hay, invalida el cache)
+        self.flush()
+        
+        key = (days,)
+        now = time.monotonic()
+        cached = self._dash_cache.get(key)
+        if cached and now - cached[0] < self._dashboard_ttl_for(days):
+            return cached[1]
+        
         end_date = datetime.now()
         start_date = end_date - timedelta(days=days)
         
-        return {
+        dashboard = {
             "period": {
                 "start_date": start_date.isoformat(),
                 "end_date": end_date.isoformat(),
                 "days": days
             },
-            "overview": self._get_overview_stats(start_date, end_date),
-            "top_rules": self._get_top_firing_rules(start_date, end_date),
-            "performance": self._get_performance_stats(start_date, end_date),
-            "patterns": self._get_execution_patterns(start_date, end_date),
-            "alerts": self._get_system_alerts(start_date, end_date),
+            **self._dashboard_query(start_date, end_date),
             "rule_health": self._get_rule_health_status()
         }
+        
+        self._dash_cache[key] = (now, dashboard)
+        return dashboard
+    
+    def _dashboard_ttl_for(self, days: int) -> int:
+        """Segundos que un dashboard cacheado sigue vigente según su ventana"""
+        if days <= 1:
+            return 30
+        if days >= 7:
+            return 300
+        return self._dashboard_ttl
+    
+    def _dashboard_query(self, start_date: datetime, end_date: datetime) -> Dict[str, Any]:
+        """Calcula todas las secciones del dashboard sobre una única conexión"""
+        with self._connect_read() as conn:
+            return {
+                "overview": self._get_overview_stats(start_date, end_date, conn),
+                "top_rules": self._get_top_firing_rules(start_date, end_date, conn=conn),
+                "performance": self._get_performance_stats(start_date, end_date, conn),
+                "patterns": self._get_execution_patterns(start_date, end_date, conn),
+                "alerts": self._get_system_alerts(start_date, end_date, conn)
+            }
     
-    def _get_overview_stats(self, start_date: datetime, end_date: datetime) -> Dict[str, Any]:
+    @contextmanager
+    def _reader(self, conn: Optional[sqlite3.Connection] = None):
+        """Reutiliza la conexión recibida o toma una del pool de lectura"""
+        if conn is not None:
+            yield conn
+            return
+        
+        with self._connect_read() as conn:
+            yield conn
+    
+    def _get_overview_stats(self, start_date: datetime, end_date: datetime,
+                            conn: Optional[sqlite3.Connection] = None) -> Dict[str, Any]:
         """Obtiene estadísticas generales"""
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-        
         # Total reglas activas
-        rules_data = self.rules_manager.load_rules()
+        rules_data = self._rules()
         total_rules = len(rules_data.get("rules", []))
         
-        # Execuciones en el período
-        cursor.execute("""
-            SELECT 
-                COUNT(*) as total_executions,
-                SUM(CASE WHEN condition_result = 1 THEN 1 ELSE 0 END) as successful_executions,
-                COUNT(DISTINCT rule_id) as active_rules,
-                AVG(execution_time_ms) as avg_execution_time
-            FROM rule_executions 
-            WHERE executed_at BETWEEN ? AND ?
-        """, (start_date.isoformat(), end_date.isoformat()))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self._reader(conn) as conn:
+            # Execuciones en el período (desde los agregados diarios de rule_stats)
+            result = conn.execute("""
+                SELECT 
+                    SUM(executions_count) as total_executions,
+                    SUM(successful_executions) as successful_executions,
+                    COUNT(DISTINCT rule_id) as active_rules,
+                    SUM(avg_execution_time_ms * executions_count) / NULLIF(SUM(executions_count), 0)
+                        as avg_execution_time
+                FROM rule_stats 
+                WHERE date BETWEEN ? AND ?
+            """, (start_date.date().isoformat(), end_date.date().isoformat())).fetchone()
         
         if result and result[0]:
             return {
@@ -162,75 +464,67 @@ class RulesMonitoring:
             "avg_execution_time": 0
         }
     
-    def _get_top_firing_rules(self, start_date: datetime, end_date: datetime, limit: int = 10) -> List[Dict[str, Any]]:
+    def _get_top_firing_rules(self, start_date: datetime, end_date: datetime, limit: int = 10,
+                              conn: Optional[sqlite3.Connection] = None) -> List[Dict[str, Any]]:
         """Obtiene las reglas que más se ejecutan"""
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT 
-                rule_id,
-                rule_name,
-                COUNT(*) as total_executions,
-                SUM(CASE WHEN condition_result = 1 THEN 1 ELSE 0 END) as successful_executions,
-                AVG(execution_time_ms) as avg_execution_time,
-                MAX(executed_at) as last_execution
-            FROM rule_executions 
-            WHERE executed_at BETWEEN ? AND ?
-            GROUP BY rule_id, rule_name
-            ORDER BY total_executions DESC
-            LIMIT ?
-        """, (start_date.isoformat(), end_date.isoformat(), limit))
-        
-        results = []
-        for row in cursor.fetchall():
-            results.append({
-                "rule_id": row[0],
-                "rule_name": row[1],
-                "total_executions": row[2],
-                "successful_executions": row[3],
-                "success_rate": (row[3] / row[2] * 100) if row[2] > 0 else 0,
-                "avg_execution_time": round(row[4], 2),
-                "last_execution": row[5]
-            })
+        with self._reader(conn) as conn:
+            # arraysize = limit: el top-N se trae en un único fetch a nivel C
+            cursor = conn.cursor()
+            cursor.arraysize = limit
+            cursor.execute("""
+                SELECT 
+                    rule_id,
+                    rule_name,
+                    COUNT(*) as total_executions,
+                    SUM(CASE WHEN condition_result = 1 THEN 1 ELSE 0 END) as successful_executions,
+                    AVG(execution_time_ms) as avg_execution_time,
+                    MAX(executed_at) as last_execution
+                FROM rule_executions 
+                WHERE executed_at BETWEEN ? AND ?
+                GROUP BY rule_id, rule_name
+                ORDER BY total_executions DESC
+                LIMIT ?
+            """, (start_date.isoformat(), end_date.isoformat(), limit))
+            
+            results = []
+            for row in cursor:
+                results.append({
+                    "rule_id": row[0],
+                    "rule_name": row[1],
+                    "total_executions": row[2],
+                    "successful_executions": row[3],
+                    "success_rate": (row[3] / row[2] * 100) if row[2] > 0 else 0,
+                    "avg_execution_time": round(row[4], 2),
+                    "last_execution": row[5]
+                })
         
-        conn.close()
         return results
     
-    def _get_performance_stats(self, start_date: datetime, end_date: datetime) -> Dict[str, Any]:
+    def _get_performance_stats(self, start_date: datetime, end_date: datetime,
+                               conn: Optional[sqlite3.Connection] = None) -> Dict[str, Any]:
         """Obtiene estadísticas de performance"""
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT 
-                MIN(execution_time_ms) as min_time,
-                MAX(execution_time_ms) as max_time,
-                AVG(execution_time_ms) as avg_time,
-                COUNT(CASE WHEN execution_time_ms > 100 THEN 1 END) as slow_executions
-            FROM rule_executions 
-            WHERE executed_at BETWEEN ? AND ?
-        """, (start_date.isoformat(), end_date.isoformat()))
-        
-        result = cursor.fetchone()
-        
-        if result and result[0] is not None:
-            total_executions = cursor.execute("""
-                SELECT COUNT(*) FROM rule_executions 
-                WHERE executed_at BETWEEN ? AND ?
-            """, (start_date.isoformat(), end_date.isoformat())).fetchone()[0]
-            
-            conn.close()
-            
+        with self._reader(conn) as conn:
+            result = conn.execute("""
+                SELECT 
+                    MIN(min_execution_time_ms) as min_time,
+                    MAX(max_execution_time_ms) as max_time,
+                    SUM(avg_execution_time_ms * executions_count) / NULLIF(SUM(executions_count), 0)
+                        as avg_time,
+                    SUM(slow_executions) as slow_executions,
+                    SUM(executions_count) as total_executions
+                FROM rule_stats 
+                WHERE date BETWEEN ? AND ?
+            """, (start_date.date().isoformat(), end_date.date().isoformat())).fetchone()
+        
+        if result and result[4]:
             return {
-                "min_execution_time": round(result[0], 2),
-                "max_execution_time": round(result[1], 2),
-                "avg_execution_time": round(result[2], 2),
+                "min_execution_time": round(result[0] or 0, 2),
+                "max_execution_time": round(result[1] or 0, 2),
+                "avg_execution_time": round(result[2] or 0, 2),
                 "slow_executions": result[3] or 0,
-                "slow_execution_rate": ((result[3] or 0) / (total_executions or 1)) * 100
+                "slow_execution_rate": ((result[3] or 0) / (result[4] or 1)) * 100
             }
         
-        conn.close()
         return {
             "min_execution_time": 0,
             "max_execution_time": 0,
@@ -239,130 +533,149 @@ class RulesMonitoring:
             "slow_execution_rate": 0
         }
     
-    def _get_execution_patterns(self, start_date: datetime, end_date: datetime) -> Dict[str, Any]:
+    def _get_execution_patterns(self, start_date: datetime, end_date: datetime,
+                                conn: Optional[sqlite3.Connection] = None) -> Dict[str, Any]:
         """Analiza patrones de ejecución"""
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-        
-        # Execuciones por hora del día
-        cursor.execute("""
-            SELECT 
-                strftime('%H', executed_at) as hour,
-                COUNT(*) as executions
-            FROM rule_executions 
-            WHERE executed_at BETWEEN ? AND ?
-            GROUP BY hour
-            ORDER BY hour
-        """, (start_date.isoformat(), end_date.isoformat()))
-        
-        hourly_pattern = {str(i).zfill(2): 0 for i in range(24)}
-        for hour, count in cursor.fetchall():
-            hourly_pattern[hour] = count
-        
-        # Execuciones por día de la semana
-        cursor.execute("""
-            SELECT 
-                strftime('%w', executed_at) as day_of_week,
-                COUNT(*) as executions
-            FROM rule_executions 
-            WHERE executed_at BETWEEN ? AND ?
-            GROUP BY day_of_week
-        """, (start_date.isoformat(), end_date.isoformat()))
-        
-        days_names = ['Domingo', 'Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado']
-        weekly_pattern = {day: 0 for day in days_names}
-        
-        for day_num, count in cursor.fetchall():
-            day_name = days_names[int(day_num)]
-            weekly_pattern[day_name] = count
-        
-        conn.close()
+        with self._reader(conn) as conn:
+            cursor = conn.cursor()
+            
+            # Una sola pasada por (hora, día de la semana) alimenta ambos histogramas
+            cursor.execute("""
+                SELECT 
+                    hour_bucket,
+                    dow_bucket,
+                    COUNT(*) as executions
+                FROM rule_executions 
+                WHERE executed_at BETWEEN ? AND ?
+                GROUP BY hour_bucket, dow_bucket
+            """, (start_date.isoformat(), end_date.isoformat()))
+            
+            days_names = ['Domingo', 'Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado']
+            hourly = Counter()
+            weekly = Counter()
+            
+            # Picos calculados durante la misma pasada: (ejecuciones, clave)
+            best_hour = (0, None)
+            best_day = (0, None)
+            
+            for hour, day_num, count in cursor.fetchall():
+                hour_key = f"{hour:02d}"
+                day_name = days_names[day_num]
+                hourly[hour_key] += count
+                weekly[day_name] += count
+                
+                if hourly[hour_key] > best_hour[0]:
+                    best_hour = (hourly[hour_key], hour_key)
+                if weekly[day_name] > best_day[0]:
+                    best_day = (weekly[day_name], day_name)
+        
+        # Completar con ceros solo al armar la respuesta
+        hourly_pattern = {f"{i:02d}": hourly.get(f"{i:02d}", 0) for i in range(24)}
+        weekly_pattern = {day: weekly.get(day, 0) for day in days_names}
         
         return {
             "hourly_distribution": hourly_pattern,
             "weekly_distribution": weekly_pattern,
-            "peak_hour": max(hourly_pattern.items(), key=lambda x: x[1])[0] if any(hourly_pattern.values()) else "00",
-            "peak_day": max(weekly_pattern.items(), key=lambda x: x[1])[0] if any(weekly_pattern.values()) else "N/A"
+            "peak_hour": best_hour[1] or "00",
+            "peak_day": best_day[1] or "N/A"
         }
     
-    def _get_system_alerts(self, start_date: datetime, end_date: datetime) -> List[Dict[str, Any]]:
+    def _get_system_alerts(self, start_date: datetime, end_date: datetime,
+                           conn: Optional[sqlite3.Connection] = None) -> List[Dict[str, Any]]:
         """Genera alertas del sistema"""
         alerts = []
         
-        # Alertas de performance
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-        
-        # Reglas muy lentas
-        cursor.execute("""
-            SELECT rule_id, rule_name, AVG(execution_time_ms) as avg_time
-            FROM rule_executions 
-            WHERE executed_at BETWEEN ? AND ?
-            GROUP BY rule_id, rule_name
-            HAVING AVG(execution_time_ms) > 50
-        """, (start_date.isoformat(), end_date.isoformat()))
-        
-        for rule_id, rule_name, avg_time in cursor.fetchall():
-            alerts.append({
-                "type": "performance",
-                "severity": "warning",
-                "message": f"Regla '{rule_name}' ejecutándose lentamente ({avg_time:.1f}ms promedio)",
-                "rule_id": rule_id,
-                "timestamp": datetime.now().isoformat()
-            })
-        
-        # Reglas que nunca se ejecutan
-        rules_data = self.rules_manager.load_rules()
-        active_rule_ids = set()
-        
-        cursor.execute("""
-            SELECT DISTINCT rule_id FROM rule_executions 
-            WHERE executed_at BETWEEN ? AND ?
-        """, (start_date.isoformat(), end_date.isoformat()))
-        
-        active_rule_ids = {row[0] for row in cursor.fetchall()}
+        rules_data = self._rules()
+        window = (start_date.isoformat(), end_date.isoformat())
+        
+        # Un único GROUP BY sobre la ventana alimenta las verificaciones de performance y éxito
+        with self._reader(conn) as conn:
+            rule_rows = conn.execute("""
+                SELECT 
+                    rule_id, rule_name,
+                    COUNT(*) as total,
+                    SUM(CASE WHEN condition_result = 1 THEN 1 ELSE 0 END) as successful,
+                    AVG(execution_time_ms) as avg_time
+                FROM rule_executions 
+                WHERE executed_at BETWEEN ? AND ?
+                GROUP BY rule_id, rule_name
+            """, window).fetchall()
+            
+            # Reglas definidas sin ejecuciones en la ventana (diferencia calculada en SQLite)
+            unused_rows = conn.execute("""
+                SELECT 
+                    json_extract(value, '$.id') as rule_id,
+                    json_extract(value, '$.name') as rule_name
+                FROM json_each(?)
+                WHERE json_extract(value, '$.id') NOT IN (
+                    SELECT rule_id FROM rule_executions 
+                    WHERE executed_at BETWEEN ? AND ?
+                )
+                ORDER BY key
+            """, (json.dumps(rules_data.get("rules", [])), *window)).fetchall()
         
-        for rule in rules_data.get("rules", []):
-            if rule.get("id") not in active_rule_ids:
+        # Alertas de performance: reglas muy lentas
+        for rule_id, rule_name, total, successful, avg_time in rule_rows:
+            if avg_time > 50:
                 alerts.append({
-                    "type": "unused_rule",
-                    "severity": "info",
-                    "message": f"Regla '{rule.get('name')}' no se ha ejecutado en {(end_date - start_date).days} días",
-                    "rule_id": rule.get("id"),
+                    "type": "performance",
+                    "severity": "warning",
+                    "severity_rank": _SEV_RANK["warning"],
+                    "message": f"Regla '{rule_name}' ejecutándose lentamente ({avg_time:.1f}ms promedio)",
+                    "rule_id": rule_id,
                     "timestamp": datetime.now().isoformat()
                 })
         
-        # Reglas con baja tasa de éxito
-        cursor.execute("""
-            SELECT 
-                rule_id, rule_name,
-                COUNT(*) as total,
-                SUM(CASE WHEN condition_result = 1 THEN 1 ELSE 0 END) as successful
-            FROM rule_executions 
-            WHERE executed_at BETWEEN ? AND ?
-            GROUP BY rule_id, rule_name
-            HAVING COUNT(*) > 10 AND 
-                   (SUM(CASE WHEN condition_result = 1 THEN 1 ELSE 0 END) * 1.0 / COUNT(*)) < 0.1
-        """, (start_date.isoformat(), end_date.isoformat()))
-        
-        for rule_id, rule_name, total, successful in cursor.fetchall():
-            success_rate = (successful / total) * 100
+        # Reglas que nunca se ejecutan
+        for rule_id, rule_name in unused_rows:
             alerts.append({
-                "type": "low_success_rate",
-                "severity": "warning",
-                "message": f"Regla '{rule_name}' con baja tasa de éxito ({success_rate:.1f}%)",
+                "type": "unused_rule",
+                "severity": "info",
+                "severity_rank": _SEV_RANK["info"],
+                "message": f"Regla '{rule_name}' no se ha ejecutado en {(end_date - start_date).days} días",
                 "rule_id": rule_id,
                 "timestamp": datetime.now().isoformat()
             })
         
-        conn.close()
-        return sorted(alerts, key=lambda x: x["severity"] == "warning", reverse=True)
+        # Reglas con baja tasa de éxito
+        for rule_id, rule_name, total, successful, avg_time in rule_rows:
+            if total > 10 and successful * 1.0 / total < 0.1:
+                success_rate = (successful / total) * 100
+                alerts.append({
+                    "type": "low_success_rate",
+                    "severity": "warning",
+                    "severity_rank": _SEV_RANK["warning"],
+                    "message": f"Regla '{rule_name}' con baja tasa de éxito ({success_rate:.1f}%)",
+                    "rule_id": rule_id,
+                    "timestamp": datetime.now().isoformat()
+                })
+        
+        return sorted(alerts, key=itemgetter("severity_rank"))
     
     def _get_rule_health_status(self) -> Dict[str, Any]:
         """Obtiene estado de salud general del sistema de reglas"""
-        rules_data = self.rules_manager.load_rules()
+        rules_data = self._rules()
         total_rules = len(rules_data.get("rules", []))
         
+        # El estado solo cambia si cambia el archivo (los backups se crean al guardarlo)
+        key = (self._rules_cache[0],) if self._rules_cache else None
+        if key is not None and key in self._health_cache:
+            return self._health_cache[key]
+        
+        last_backup = self._get_last_backup_date()
+        
+        # Sin reglas no hay conflictos ni sintaxis que analizar
+        if total_rules == 0:
+            return {
+                "overall_health_score": 100,
+                "status": "excellent",
+                "total_rules": 0,
+                "priority_conflicts": 0,
+                "syntax_issues": 0,
+                "last_backup": last_backup,
+                "recommendations": self._generate_health_recommendations(last_backup, [], [])
+            }
+        
         # Análisis de configuración
         priority_conflicts = self._check_priority_conflicts()
         syntax_issues = self._check_syntax_issues()
@@ -388,40 +701,47 @@ class RulesMonitoring:
         else:
             status = "critical"
         
-        return {
+        health = {
             "overall_health_score": health_score,
             "status": status,
             "total_rules": total_rules,
             "priority_conflicts": len(priority_conflicts),
             "syntax_issues": len(syntax_issues),
-            "last_backup": self._get_last_backup_date(),
-            "recommendations": self._generate_health_recommendations()
+            "last_backup": last_backup,
+            "recommendations": self._generate_health_recommendations(
+                last_backup, priority_conflicts, syntax_issues
+            )
         }
+        
+        if key is not None:
+            self._health_cache = {key: health}
+        return health
     
     def _check_priority_conflicts(self) -> List[Dict[str, Any]]:
         """Verifica conflictos de prioridad"""
-        rules_data = self.rules_manager.load_rules()
+        rules_data = self._rules()
         rules = rules_data.get("rules", [])
         
+        # Una pasada para contar; los ids solo se juntan para prioridades repetidas
+        priority_counts = Counter(rule.get("priority", 999) for rule in rules)
+        duplicated = {priority for priority, count in priority_counts.items() if count > 1}
+        if not duplicated:
+            return []
+        
         priority_map = defaultdict(list)
         for rule in rules:
             priority = rule.get("priority", 999)
-            priority_map[priority].append(rule.get("id", "unknown"))
-        
-        conflicts = []
-        for priority, rule_ids in priority_map.items():
-            if len(rule_ids) > 1:
-                conflicts.append({
-                    "priority": priority,
-                    "rule_ids": rule_ids,
-                    "count": len(rule_ids)
-                })
+            if priority in duplicated:
+                priority_map[priority].append(rule.get("id", "unknown"))
         
-        return conflicts
+        return [
+            {"priority": priority, "rule_ids": rule_ids, "count": len(rule_ids)}
+            for priority, rule_ids in priority_map.items()
+        ]
     
     def _check_syntax_issues(self) -> List[Dict[str, Any]]:
         """Verifica problemas de sintaxis en reglas"""
-        rules_data = self.rules_manager.load_rules()
+        rules_data = self._rules()
         issues = []
         
         for rule in rules_data.get("rules", []):
@@ -438,41 +758,40 @@ class RulesMonitoring:
     
     def _get_last_backup_date(self) -> str:
         """Obtiene fecha del último backup"""
-        import os
-        backup_dir = "expert/backups"
-        
-        if not os.path.exists(backup_dir):
-            return "never"
-        
-        backup_files = [f for f in os.listdir(backup_dir) if f.startswith("rules_backup_")]
+        backup_files = self.rules_manager.list_backups()
         
         if not backup_files:
             return "never"
         
-        latest_backup = max(backup_files)
-        # Extraer fecha del nombre del archivo
+        latest_backup = backup_files[-1]
+        # Extraer fecha del nombre del archivo (los nuevos agregan microsegundos)
         try:
             date_part = latest_backup.replace("rules_backup_", "").replace(".json", "")
-            return datetime.strptime(date_part, "%Y%m%d_%H%M%S").isoformat()
+            return datetime.strptime(date_part[:15], "%Y%m%d_%H%M%S").isoformat()
         except:
             return "unknown"
     
-    def _generate_health_recommendations(self) -> List[str]:
-        """Genera recomendaciones para mejorar la salud del sistema"""
+    def _generate_health_recommendations(self, last_backup: Optional[str] = None,
+                                         conflicts: Optional[List[Dict[str, Any]]] = None,
+                                         syntax_issues: Optional[List[Dict[str, Any]]] = None) -> List[str]:
+        """Genera recomendaciones para mejorar la salud del sistema (reutiliza los análisis recibidos)"""
         recommendations = []
         
         # Verificar backups recientes
-        last_backup = self._get_last_backup_date()
+        if last_backup is None:
+            last_backup = self._get_last_backup_date()
         if last_backup == "never":
             recommendations.append("Realizar backup del sistema de reglas")
         
         # Verificar conflictos de prioridad
-        conflicts = self._check_priority_conflicts()
+        if conflicts is None:
+            conflicts = self._check_priority_conflicts()
         if conflicts:
             recommendations.append(f"Resolver {len(conflicts)} conflictos de prioridad")
         
         # Verificar sintaxis
-        syntax_issues = self._check_syntax_issues()
+        if syntax_issues is None:
+            syntax_issues = self._check_syntax_issues()
         if syntax_issues:
             recommendations.append(f"Corregir {len(syntax_issues)} problemas de sintaxis")
         
@@ -496,16 +815,20 @@ def test_rules_monitoring():
     rules_data = monitoring.rules_manager.load_rules()
     rules = rules_data.get("rules", [])[:5]  # Tomar 5 reglas
     
+    executions = []
     for i in range(20):  # Simular 20 ejecuciones
         rule = random.choice(rules)
-        monitoring.log_rule_execution(
-            rule_id=rule.get("id"),
-            rule_name=rule.get("name"),
-            case_facts={"motivo": "ART", "duracion": random.randint(1, 10)},
-            condition_result=random.choice([True, False]),
-            action_executed=rule.get("action", ""),
-            execution_time_ms=random.uniform(1, 50)
-        )
+        executions.append({
+            "rule_id": rule.get("id"),
+            "rule_name": rule.get("name"),
+            "case_facts": {"motivo": "ART", "duracion": random.randint(1, 10)},
+            "condition_result": random.choice([True, False]),
+            "action_executed": rule.get("action", ""),
+            "execution_time_ms": random.uniform(1, 50)
+        })
+    
+    # Una sola transacción para todo el lote
+    monitoring.log_rule_execution_many(executions)
     
     print("  20 ejecuciones simuladas")
     
@@ -1,19 +1,164 @@
 # expert/rules_preview.py - Sistema de preview de reglas
-from typing import Dict, List, Any, Tuple
+import bisect
+import functools
+import os
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Any, Mapping, Optional, Tuple, Union
 from datetime import datetime, timedelta
+from types import CodeType, MappingProxyType
 from expert.inference_engine import InferenceEngine, SafeExpressionEvaluator
 
+@dataclass(slots=True)
+class ScenarioPreview:
+    """Resumen de la inferencia de un escenario de prueba"""
+    description: str
+    total_rules_fired: int
+    our_rule_fired: bool
+    final_outcome: str
+    conclusions: List[str]
+    execution_time: float
+
+# Patrones precompilados para el análisis de condiciones
+_VARS_RE = re.compile(r'\b(motivo|duracion|ausencias_ultimo_mes|certificate_uploaded|validation_status)\b')
+_MOTIVO_RE = re.compile(r"motivo\s*==\s*['\"]([^'\"]+)['\"]")
+_IMPORTANT_VARS_RE = re.compile(r'motivo|duracion|certificate_uploaded')
+
+# Estimación de frecuencia de disparo: primer patrón que coincide con la condición
+_FREQ_RULES = (
+    (re.compile(r"^(?=.*motivo)(?=.*ART)", re.S), "Media (ART representa ~20% de ausencias)"),
+    (re.compile(r"ausencias_ultimo_mes\s*>=\s*4"), "Baja (pocos empleados con 4+ ausencias)"),
+    (re.compile(r"certificate_uploaded"), "Alta (muchas ausencias requieren certificado)"),
+    (re.compile(r"validation_status\s*==\s*['\"]provisional['\"]"), "Muy baja (pocos empleados no validados)"),
+)
+
+# Un bit por cada variable del vocabulario de _VARS_RE
+_VAR_BITS = {
+    'motivo': 1,
+    'duracion': 2,
+    'ausencias_ultimo_mes': 4,
+    'certificate_uploaded': 8,
+    'validation_status': 16
+}
+
+@functools.lru_cache(maxsize=1024)
+def _fingerprint(condition: str) -> Tuple[int, frozenset]:
+    """Huella de una condición: (máscara de variables conocidas, motivos comparados)"""
+    mask = 0
+    for var in _VARS_RE.findall(condition):
+        mask |= _VAR_BITS[var]
+    return mask, frozenset(_MOTIVO_RE.findall(condition))
+
+# Nombres cuyo valor depende del momento en que se evalúa la condición
+_TIME_NAMES = frozenset({'hours_since', 'days_since', 'is_weekend', 'current_hour', 'certificate_deadline'})
+
+# Funciones especiales de las condiciones, con "ahora" fijado por cada preview
+def _hours_since(date, _now: datetime):
+    return (_now - date).total_seconds() / 3600 if date else 999
+
+def _days_since(date, _now: datetime):
+    return (_now - date).days if date else 999
+
+# Resultados de inferencia por escenario que se conservan entre previews
+_FC_CACHE_SIZE = 256
+
+# A partir de esta cantidad de reglas los escenarios se evalúan en procesos separados
+_PARALLEL_MIN_RULES = 200
+_preview_pool: Optional[ProcessPoolExecutor] = None
+
+def _get_preview_pool() -> ProcessPoolExecutor:
+    """Pool de procesos compartido por todos los previews (se crea al primer uso)"""
+    global _preview_pool
+    if _preview_pool is None:
+        _preview_pool = ProcessPoolExecutor(max_workers=min(6, os.cpu_count() or 1))
+    return _preview_pool
+
+def _determine_outcome(final_facts: Dict[str, Any]) -> str:
+    """Determina outcome para preview"""
+    if final_facts.get('sancion_aplicada', False):
+        return 'sanctioned'
+    elif final_facts.get('requiere_aprobacion', False):
+        return 'requires_approval'
+    elif final_facts.get('observaciones', []):
+        return 'approved_with_conditions'
+    else:
+        return 'auto_approved'
+
+def _run_scenario(engine: InferenceEngine, facts: Mapping[str, Any], temp_rule_id: str,
+                  description: str) -> Union[ScenarioPreview, Dict[str, str]]:
+    """Ejecuta la inferencia completa de un escenario y resume el resultado"""
+    try:
+        result = engine.forward_chaining(facts)
+    except Exception as e:
+        return {"description": description, "error": str(e)[:100]}
+    
+    return ScenarioPreview(
+        description=description,
+        total_rules_fired=len(result.steps),
+        # Verificar si nuestra regla se disparó
+        our_rule_fired=temp_rule_id in result.fired_ids,
+        final_outcome=_determine_outcome(result.final_facts),
+        conclusions=result.conclusions[:3],  # Top 3
+        execution_time=result.execution_time
+    )
+
+def _run_scenario_in_worker(args: Tuple[List[Dict], Dict[str, Any], str, str]) -> Union[ScenarioPreview, Dict[str, str]]:
+    """Versión de _run_scenario para el pool de procesos (recibe solo datos serializables)"""
+    rules, facts, temp_rule_id, description = args
+    return _run_scenario(InferenceEngine.fresh(rules, pre_sorted=True), facts, temp_rule_id, description)
+
 class RulesPreview:
     """Sistema para probar reglas antes de guardarlas"""
     
+    RULES_FILE = 'expert/advanced_rules.json'
+    
     def __init__(self):
-        self.test_scenarios = self._generate_test_scenarios()
+        # Motor con las reglas existentes, reutilizado mientras no cambie el archivo
+        self._engine: Optional[InferenceEngine] = None
+        self._engine_mtime: Optional[float] = None
+        
+        # Resumen de inferencia por (firma de reglas, regla temporal, hechos del escenario), LRU
+        self._fc_cache: "OrderedDict[tuple, ScenarioPreview]" = OrderedDict()
+        
+        # Condiciones ya validadas y compiladas: texto -> (code object, nombres referenciados)
+        self._cond_cache: Dict[str, Tuple[CodeType, Tuple[str, ...]]] = {}
     
-    def _generate_test_scenarios(self) -> List[Dict[str, Any]]:
-        """Genera escenarios de prueba típicos"""
+    def _get_engine(self) -> InferenceEngine:
+        """Motor de inferencia con las reglas actuales (se recarga si cambió el archivo)"""
+        try:
+            mtime = os.stat(self.RULES_FILE).st_mtime
+        except OSError:
+            return InferenceEngine(self.RULES_FILE)
+        
+        if self._engine is None or self._engine_mtime != mtime:
+            self._engine = InferenceEngine(self.RULES_FILE)
+            self._engine_mtime = mtime
+        return self._engine
+    
+    def _compile_condition(self, condition: str) -> Tuple[CodeType, Tuple[str, ...]]:
+        """Compila (una sola vez por texto) la condición de una regla y los nombres que usa"""
+        compiled = self._cond_cache.get(condition)
+        if compiled is None:
+            code = SafeExpressionEvaluator.compile_expression(condition)
+            compiled = (code, tuple(sorted(code.co_names)))
+            self._cond_cache[condition] = compiled
+        return compiled
+    
+    @property
+    def test_scenarios(self) -> Tuple[Mapping[str, Any], ...]:
+        """Escenarios vigentes (se regeneran una vez por minuto)"""
+        return self._generate_test_scenarios(int(time.time() // 60))
+    
+    @classmethod
+    @functools.lru_cache(maxsize=1)
+    def _generate_test_scenarios(cls, time_bucket: int) -> Tuple[Mapping[str, Any], ...]:
+        """Genera escenarios de prueba típicos (de solo lectura, compartidos entre instancias)"""
         base_date = datetime.now()
         
-        return [
+        scenarios = [
             {
                 "name": "ART Normal",
                 "description": "Ausencia ART típica con certificado",
@@ -99,22 +244,54 @@ class RulesPreview:
                 }
             }
         ]
+        
+        return tuple(
+            MappingProxyType({**scenario, "facts": MappingProxyType(scenario["facts"])})
+            for scenario in scenarios
+        )
     
     def preview_single_rule(self, rule_data: Dict[str, Any]) -> Dict[str, Any]:
         """Prueba una regla individual contra escenarios"""
         results = {}
         
+        # Compilar la condición una vez para todos los escenarios
+        try:
+            code, names = self._compile_condition(rule_data["condition"])
+        except Exception:
+            code, names = None, ()  # Se evalúa por el camino normal, que reporta el error
+        
+        # Las funciones especiales solo hacen falta si la condición depende del tiempo
+        helpers = {}
+        if code is None or not _TIME_NAMES.isdisjoint(names):
+            now = datetime.now()
+            weekend = now.weekday() >= 5
+            helpers = {
+                'hours_since': functools.partial(_hours_since, _now=now),
+                'days_since': functools.partial(_days_since, _now=now),
+                'is_weekend': lambda: weekend
+            }
+        
+        # Resultado por proyección de los hechos sobre los nombres que usa la condición
+        evaluated: Dict[tuple, Any] = {}
+        
         for scenario in self.test_scenarios:
             # Crear facts con funciones especiales
-            test_facts = scenario["facts"].copy()
-            test_facts['hours_since'] = lambda date: (datetime.now() - date).total_seconds() / 3600 if date else 999
-            test_facts['days_since'] = lambda date: (datetime.now() - date).days if date else 999
-            test_facts['is_weekend'] = lambda: datetime.now().weekday() >= 5
+            test_facts = dict(scenario["facts"])
+            test_facts.update(helpers)
             
             try:
                 # Evaluar solo la condición de esta regla
                 evaluator = SafeExpressionEvaluator(test_facts)
-                condition_result = evaluator.evaluate(rule_data["condition"])
+                if code is not None:
+                    projection = tuple(test_facts.get(name) for name in names)
+                    try:
+                        condition_result = evaluated[projection]
+                    except KeyError:
+                        condition_result = evaluated[projection] = evaluator.evaluate_compiled(code)
+                    except TypeError:  # Hechos no hashables: evaluar sin deduplicar
+                        condition_result = evaluator.evaluate_compiled(code)
+                else:
+                    condition_result = evaluator.evaluate(rule_data["condition"])
                 
                 results[scenario["name"]] = {
                     "description": scenario["description"],
@@ -138,10 +315,10 @@ class RulesPreview:
         """Prueba una regla nueva junto con las existentes"""
         
         # Crear un motor temporal con todas las reglas incluyendo la nueva
-        engine = InferenceEngine()
+        engine = self._get_engine()
         
-        # Cargar reglas existentes
-        existing_rules = engine.rules.copy()
+        # Cargar reglas existentes (el motor ya las tiene ordenadas por prioridad)
+        sorted_rules = engine.rules.copy()
         
         # Agregar regla temporal
         temp_rule = {
@@ -154,68 +331,79 @@ class RulesPreview:
             "explanation": rule_data.get("explanation", "")
         }
         
-        # Agregar a la lista
-        all_rules = existing_rules + [temp_rule]
-        
-        # Simular motor temporal
-        class TempEngine(InferenceEngine):
-            def __init__(self, temp_rules):
-                self.rules = sorted(temp_rules, key=lambda x: x.get('priority', 999))
-                self.facts = {}
-                self.inference_steps = []
-        
-        temp_engine = TempEngine(all_rules)
-        
-        scenario_results = {}
-        
-        for scenario in self.test_scenarios:
-            try:
-                # Ejecutar inferencia completa
-                result = temp_engine.forward_chaining(scenario["facts"])
-                
-                # Verificar si nuestra regla se disparó
-                our_rule_fired = any(
-                    step.rule_id == temp_rule["id"] for step in result.steps
+        # Insertar en su posición: equivale a ordenar la lista completa, sin reordenarla
+        bisect.insort_right(sorted_rules, temp_rule, key=lambda rule: rule.get("priority", 999))
+        temp_rule_id = temp_rule["id"]
+        
+        scenarios = self.test_scenarios
+        
+        # Solo los campos que afectan la inferencia o su resumen; editar la explicación
+        # de la regla temporal reutiliza los resultados ya calculados
+        rules_sig = tuple(
+            (rule.get("id"), rule.get("name"), rule.get("condition"), rule.get("action"),
+             rule.get("priority", 999), rule.get("activation_condition"))
+            for rule in sorted_rules
+        )
+        keys = [(rules_sig, temp_rule_id, tuple(sorted(scenario["facts"].items()))) for scenario in scenarios]
+        
+        outcomes = {}
+        for index, key in enumerate(keys):
+            cached = self._fc_cache.get(key)
+            if cached is not None:
+                self._fc_cache.move_to_end(key)
+                outcomes[index] = cached
+        
+        missing = [index for index in range(len(scenarios)) if index not in outcomes]
+        if missing:
+            if len(sorted_rules) >= _PARALLEL_MIN_RULES:
+                # Escenarios independientes: uno por proceso
+                computed = _get_preview_pool().map(
+                    _run_scenario_in_worker,
+                    [(sorted_rules, dict(scenarios[index]["facts"]), temp_rule_id, scenarios[index]["description"])
+                     for index in missing]
                 )
-                
-                scenario_results[scenario["name"]] = {
-                    "description": scenario["description"],
-                    "total_rules_fired": len(result.steps),
-                    "our_rule_fired": our_rule_fired,
-                    "final_outcome": self._determine_outcome_preview(result.final_facts),
-                    "conclusions": result.conclusions[:3],  # Top 3
-                    "execution_time": result.execution_time
-                }
-                
-            except Exception as e:
-                scenario_results[scenario["name"]] = {
-                    "description": scenario["description"],
-                    "error": str(e)[:100]
-                }
+            else:
+                # Simular motor temporal
+                temp_engine = InferenceEngine.fresh(sorted_rules, pre_sorted=True)
+                computed = (
+                    _run_scenario(temp_engine, scenarios[index]["facts"], temp_rule_id, scenarios[index]["description"])
+                    for index in missing
+                )
+            
+            for index, outcome in zip(missing, computed):
+                outcomes[index] = outcome
+                if isinstance(outcome, ScenarioPreview):
+                    self._fc_cache[keys[index]] = outcome
+                    if len(self._fc_cache) > _FC_CACHE_SIZE:
+                        self._fc_cache.popitem(last=False)
+        
+        # Salida en dicts planos (la API los serializa tal cual)
+        scenario_results = {}
+        for index, scenario in enumerate(scenarios):
+            outcome = outcomes[index]
+            if isinstance(outcome, ScenarioPreview):
+                outcome = asdict(outcome)
+                outcome["description"] = scenario["description"]
+            scenario_results[scenario["name"]] = outcome
         
         return scenario_results
     
     def _determine_outcome_preview(self, final_facts: Dict[str, Any]) -> str:
         """Determina outcome para preview"""
-        if final_facts.get('sancion_aplicada', False):
-            return 'sanctioned'
-        elif final_facts.get('requiere_aprobacion', False):
-            return 'requires_approval'
-        elif final_facts.get('observaciones', []):
-            return 'approved_with_conditions'
-        else:
-            return 'auto_approved'
+        return _determine_outcome(final_facts)
     
     def analyze_rule_conflicts(self, rule_data: Dict[str, Any]) -> List[Dict[str, Any]]:
         """Analiza posibles conflictos con reglas existentes"""
-        engine = InferenceEngine()
+        engine = self._get_engine()
         conflicts = []
         
         new_priority = rule_data.get("priority", 999)
         new_severity = rule_data.get("severity", "info")
-        new_condition = rule_data.get("condition", "")
+        new_fp = _fingerprint(rule_data.get("condition", ""))
         
         for existing_rule in engine.rules:
+            existing_fp = _fingerprint(existing_rule.get("condition", ""))
+            
             # Conflicto de prioridad
             if existing_rule.get("priority") == new_priority:
                 conflicts.append({
@@ -226,7 +414,7 @@ class RulesPreview:
                 })
             
             # Condiciones muy similares
-            if self._conditions_similar(new_condition, existing_rule.get("condition", "")):
+            if self._conditions_similar(new_fp, existing_fp):
                 conflicts.append({
                     "type": "similar_condition",
                     "message": f"Condición similar a regla '{existing_rule.get('name')}'",
@@ -235,7 +423,7 @@ class RulesPreview:
                 })
             
             # Severidad inconsistente para condiciones similares
-            if (self._conditions_overlap(new_condition, existing_rule.get("condition", "")) and
+            if (self._conditions_overlap(new_fp, existing_fp) and
                 new_severity != existing_rule.get("severity")):
                 conflicts.append({
                     "type": "severity_inconsistency",
@@ -246,34 +434,23 @@ class RulesPreview:
         
         return conflicts
     
-    def _conditions_similar(self, cond1: str, cond2: str) -> bool:
-        """Verifica si dos condiciones son similares"""
-        # Análisis básico de similitud
-        if not cond1 or not cond2:
-            return False
-        
-        # Extraer variables de ambas condiciones
-        import re
-        vars1 = set(re.findall(r'\b(motivo|duracion|ausencias_ultimo_mes|certificate_uploaded|validation_status)\b', cond1))
-        vars2 = set(re.findall(r'\b(motivo|duracion|ausencias_ultimo_mes|certificate_uploaded|validation_status)\b', cond2))
+    def _conditions_similar(self, fp1: Tuple[int, frozenset], fp2: Tuple[int, frozenset]) -> bool:
+        """Verifica si dos condiciones (por su huella) son similares"""
+        mask1, mask2 = fp1[0], fp2[0]
         
         # Si comparten más del 70% de las variables, son similares
-        if len(vars1.union(vars2)) > 0:
-            similarity = len(vars1.intersection(vars2)) / len(vars1.union(vars2))
+        # (una condición vacía tiene máscara 0 y nunca alcanza el umbral)
+        union = mask1 | mask2
+        if union:
+            similarity = (mask1 & mask2).bit_count() / union.bit_count()
             return similarity > 0.7
         
         return False
     
-    def _conditions_overlap(self, cond1: str, cond2: str) -> bool:
-        """Verifica si dos condiciones podrían solaparse"""
-        # Análisis básico de solapamiento
+    def _conditions_overlap(self, fp1: Tuple[int, frozenset], fp2: Tuple[int, frozenset]) -> bool:
+        """Verifica si dos condiciones (por su huella) podrían solaparse"""
         # Por ejemplo, si ambas mencionan el mismo motivo
-        import re
-        
-        motivos1 = re.findall(r"motivo\s*==\s*['\"]([^'\"]+)['\"]", cond1)
-        motivos2 = re.findall(r"motivo\s*==\s*['\"]([^'\"]+)['\"]", cond2)
-        
-        return bool(set(motivos1).intersection(set(motivos2)))
+        return not fp1[1].isdisjoint(fp2[1])
     
     def get_recommendation(self, rule_data: Dict[str, Any]) -> Dict[str, Any]:
         """Genera recomendaciones para mejorar la regla"""
@@ -336,11 +513,8 @@ class RulesPreview:
         if "and" in condition or "or" in condition:
             score += 0.1
         
-        # Bonus por incluir variables importantes
-        important_vars = ["motivo", "duracion", "certificate_uploaded"]
-        for var in important_vars:
-            if var in condition:
-                score += 0.1
+        # Bonus por incluir variables importantes (motivo, duracion, certificate_uploaded)
+        score += 0.1 * len(set(_IMPORTANT_VARS_RE.findall(condition)))
         
         # Bonus por tener explicación
         if rule_data.get("explanation", "").strip():
@@ -358,16 +532,10 @@ class RulesPreview:
         condition = rule_data.get("condition", "")
         
         # Análisis heurístico básico
-        if "motivo" in condition and "ART" in condition:
-            return "Media (ART representa ~20% de ausencias)"
-        elif "ausencias_ultimo_mes >= 4" in condition:
-            return "Baja (pocos empleados con 4+ ausencias)"
-        elif "certificate_uploaded" in condition:
-            return "Alta (muchas ausencias requieren certificado)"
-        elif "validation_status == 'provisional'" in condition:
-            return "Muy baja (pocos empleados no validados)"
-        else:
-            return "Desconocida (requiere más análisis)"
+        for pattern, message in _FREQ_RULES:
+            if pattern.search(condition):
+                return message
+        return "Desconocida (requiere más análisis)"
 
 def test_rules_preview():
     """Función de prueba del sistema de preview"""
@@ -1,54 +1,105 @@
 # load_employees.py - Carga empleados desde CSV
+import codecs
+import itertools
+import logging
+import operator
 import pandas as pd
-from models.database import SessionLocal, Employee, Base, engine
+from sqlalchemy import func
+from models.database import SessionLocal, Employee, create_tables, EMPLOYEE_INSERT
+
+logger = logging.getLogger(__name__)
+
+# Columnas usadas del CSV y filas leídas por bloque
+CSV_COLUMNS = ['legajo', 'nombre', 'sector']
+CHUNK_SIZE = 10_000
+
+def detect_encoding(csv_path):
+    """Detecta la codificación del CSV sin cargarlo completo en memoria"""
+    try:
+        from charset_normalizer import from_path
+        best = from_path(csv_path).best()
+        if best is not None:
+            return best.encoding
+    except ImportError:
+        pass
+    
+    # Sin charset_normalizer: UTF-8 si todo el archivo decodifica, si no latin1
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with open(csv_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                decoder.decode(block)
+            decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return 'latin1'
+    return 'utf-8'
 
 def load_employees_from_csv(csv_path):
     """Carga empleados desde archivo CSV"""
     
     # Crear tablas si no existen
     print("Creando tablas en base de datos...")
-    Base.metadata.create_all(bind=engine)
+    create_tables()
     
-    print(f"Leyendo archivo CSV: {csv_path}")
-    try:
-        df = pd.read_csv(csv_path, encoding='utf-8')
-    except UnicodeDecodeError:
-        # Intentar con diferentes codificaciones
-        df = pd.read_csv(csv_path, encoding='latin1')
-    
-    print(f"Encontrados {len(df)} empleados en el CSV")
+    encoding = detect_encoding(csv_path)
+    print(f"Leyendo archivo CSV: {csv_path} ({encoding})")
     
     session = SessionLocal()
+    total_rows = 0
     added_count = 0
     skipped_count = 0
     
     try:
-        for index, row in df.iterrows():
-            legajo = str(row['legajo']).strip()
-            nombre = str(row['nombre']).strip()
-            sector = str(row['sector']).strip()
+        # Legajos ya vistos en bloques anteriores (existentes o agregados)
+        seen = set()
+        
+        # Leer por bloques: la memoria queda acotada a CHUNK_SIZE filas
+        for chunk in pd.read_csv(csv_path, encoding=encoding, chunksize=CHUNK_SIZE,
+                                 dtype=str, usecols=CSV_COLUMNS):
+            total_rows += len(chunk)
             
-            # Verificar si ya existe
-            existing = session.query(Employee).filter(Employee.legajo == legajo).first()
+            # Normalizar columnas una sola vez por bloque
+            chunk = chunk[CSV_COLUMNS].astype(str).apply(lambda column: column.str.strip())
             
-            if existing:
-                print(f"SKIP: Empleado {legajo} - {nombre} ya existe")
-                skipped_count += 1
-                continue
+            # Un único SELECT por bloque para saber qué legajos ya existen
+            legajos = [legajo for legajo in chunk['legajo'].tolist() if legajo not in seen]
+            existing = {
+                legajo for (legajo,) in
+                session.query(Employee.legajo).filter(Employee.legajo.in_(legajos)).all()
+            }
             
-            # Crear nuevo empleado
-            employee = Employee(
-                legajo=legajo,
-                nombre=nombre,
-                sector=sector,
-                activo=True
-            )
+            new_employees = []
+            for legajo, nombre, sector in chunk.itertuples(index=False, name=None):
+                # Verificar si ya existe (en la base o repetido en el CSV)
+                if legajo in existing or legajo in seen:
+                    logger.debug("SKIP: Empleado %s - %s ya existe", legajo, nombre)
+                    skipped_count += 1
+                    continue
+                seen.add(legajo)
+                
+                # Crear nuevo empleado
+                new_employees.append({
+                    "legajo": legajo,
+                    "nombre": nombre,
+                    "sector": sector,
+                    "activo": True
+                })
+                logger.debug("ADD: %s - %s (%s)", legajo, nombre, sector)
+                added_count += 1
             
-            session.add(employee)
-            print(f"ADD: {legajo} - {nombre} ({sector})")
-            added_count += 1
+            seen.update(existing)
+            
+            # Inserción en bloque sin hidratar objetos ORM; el índice único de legajo
+            # descarta cualquier legajo que otro proceso haya insertado mientras tanto
+            if new_employees:
+                session.execute(
+                    EMPLOYEE_INSERT.on_conflict_do_nothing(index_elements=['legajo']),
+                    new_employees
+                )
+        
+        print(f"Encontrados {total_rows} empleados en el CSV")
         
-        # Guardar cambios
+        # Guardar cambios: todos los bloques en una única transacción
         session.commit()
         print(f"\n[SUCCESS] RESUMEN:")
         print(f"- Empleados agregados: {added_count}")
@@ -66,23 +117,26 @@ def list_employees():
     """Lista todos los empleados en la base de datos"""
     session = SessionLocal()
     try:
-        employees = session.query(Employee).order_by(Employee.legajo).all()
+        # Cantidad por sector calculada en la base
+        sector_counts = dict(
+            session.query(Employee.sector, func.count()).group_by(Employee.sector).all()
+        )
         
-        print(f"\n[EMPLOYEES] BASE DE DATOS ({len(employees)} total):")
+        print(f"\n[EMPLOYEES] BASE DE DATOS ({sum(sector_counts.values())} total):")
         print("-" * 60)
         
-        sectores = {}
-        for emp in employees:
-            sector = emp.sector
-            if sector not in sectores:
-                sectores[sector] = []
-            sectores[sector].append(emp)
+        # Solo las columnas necesarias, ya ordenadas por sector y leídas por tandas
+        rows = (
+            session.query(Employee.sector, Employee.legajo, Employee.nombre, Employee.activo)
+            .order_by(Employee.sector, Employee.legajo)
+            .yield_per(1000)
+        )
         
-        for sector, empleados in sectores.items():
-            print(f"\n[SECTOR] {sector.upper()} ({len(empleados)} empleados):")
-            for emp in empleados:
-                status = "Activo" if emp.activo else "Inactivo"
-                print(f"  {emp.legajo} - {emp.nombre} ({status})")
+        for sector, empleados in itertools.groupby(rows, key=operator.itemgetter(0)):
+            print(f"\n[SECTOR] {sector.upper()} ({sector_counts[sector]} empleados):")
+            for _, legajo, nombre, activo in empleados:
+                status = "Activo" if activo else "Inactivo"
+                print(f"  {legajo} - {nombre} ({status})")
         
     finally:
         session.close()
@@ -112,11 +166,16 @@ def search_employee(legajo):
 if __name__ == "__main__":
     import sys
     
+    # --verbose muestra el detalle ADD/SKIP de cada fila
+    if "--verbose" in sys.argv:
+        sys.argv.remove("--verbose")
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+    
     if len(sys.argv) < 2:
         print("Uso del script:")
-        print("  python load_employees.py load <ruta_csv>     # Cargar empleados")
-        print("  python load_employees.py list               # Listar empleados")
-        print("  python load_employees.py search <legajo>    # Buscar empleado")
+        print("  python load_employees.py load <ruta_csv> [--verbose]      # Cargar empleados")
+        print("  python load_employees.py list                             # Listar empleados")
+        print("  python load_employees.py search <legajo>                  # Buscar empleado")
         sys.exit(1)
     
     command = sys.argv[1]
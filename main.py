@@ -1,30 +1,207 @@
 # main.py
 from models.database import Base 
 from fastapi import FastAPI, Request, Form
-from fastapi.responses import JSONResponse, HTMLResponse, FileResponse
+from fastapi.responses import JSONResponse, HTMLResponse, ORJSONResponse
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
 import uvicorn
+from aiolimiter import AsyncLimiter
 from pydantic import BaseModel
-import json
+import asyncio
+import logging
+import logging.handlers
 import os
-from datetime import datetime
+import queue
+import time
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Optional
 from telegram import Update, Bot
+from telegram.request import HTTPXRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import config
-from models.database import engine, SessionLocal, Absence, ConversationState, Employee
-from utils import generate_registration_code, get_sector_display_name
+from sqlalchemy import bindparam, delete, func, select
+from models.database import checkpoint, create_tables, AsyncSessionLocal, Absence, ConversationState, Employee, ABSENCE_INSERT, CONVERSATION_STATE_INSERT
+from utils import (
+    generate_registration_code, get_sector_display_name, validate_legajo_format,
+    LEGAJO_MIN_LEN, LEGAJO_MAX_LEN
+)
 
 # Importar módulos del sistema experto
 from api.rules_endpoints import RulesAPI
 
-app = FastAPI()
-bot = Bot(token=config.TELEGRAM_TOKEN)
+# Un único cliente HTTP con pool amplio para las llamadas a la API de Telegram
+bot = Bot(
+    token=config.TELEGRAM_TOKEN,
+    request=HTTPXRequest(connection_pool_size=64, connect_timeout=5, read_timeout=10)
+)
+
+# Logging: el event loop solo encola los registros; un hilo aparte los escribe
+logger = logging.getLogger("tecnomyl")
+
+def setup_logging():
+    """Configura el logging con QueueHandler/QueueListener y devuelve el listener iniciado"""
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+    
+    logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)], force=True)
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+    
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+# Intervalo entre checkpoints del WAL (segundos)
+CHECKPOINT_INTERVAL = 300
+
+# Espera máxima por las tareas en segundo plano al apagar (segundos)
+BACKGROUND_SHUTDOWN_TIMEOUT = 30
+
+async def checkpoint_loop():
+    """Trunca el WAL periódicamente fuera del event loop"""
+    while True:
+        await asyncio.sleep(CHECKPOINT_INTERVAL)
+        try:
+            await asyncio.to_thread(checkpoint)
+        except Exception:
+            logger.exception("Error en checkpoint del WAL")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Inicializa el bot (conexión lista antes del primer webhook) y lo cierra al apagar"""
+    log_listener = setup_logging()
+    await bot.initialize()
+    checkpoint_task = asyncio.create_task(checkpoint_loop())
+    yield
+    checkpoint_task.cancel()
+    # Dejar terminar las descargas de certificados en curso antes de cerrar el bot
+    if background_tasks:
+        await asyncio.wait(background_tasks, timeout=BACKGROUND_SHUTDOWN_TIMEOUT)
+    await bot.shutdown()
+    await asyncio.to_thread(checkpoint)
+    log_listener.stop()
+
+app = FastAPI(lifespan=lifespan)
+templates = Jinja2Templates(directory="templates")
+
+# Plantilla del dashboard compilada una sola vez al importar (sin búsqueda ni chequeo de mtime por request)
+DASHBOARD_TEMPLATE = templates.get_template("dashboard.html")
+
+# Límite global de Telegram: 30 mensajes por segundo por bot
+SEND_LIMITER = AsyncLimiter(30, 1)
+
+async def send_message(chat_id, text, **kwargs):
+    """Envía un mensaje de Telegram respetando el límite global de envíos"""
+    async with SEND_LIMITER:
+        return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
 
 # Inicializar la base de datos (crea tablas si no existen)
-Base.metadata.create_all(bind=engine)
+create_tables()
+
+# Motivos de ausencia (el orden define la numeración del menú)
+MOTIVOS = (
+    "ART",
+    "Licencia Enfermedad Familiar",
+    "Licencia Enfermedad Personal",
+    "Licencia por Fallecimiento Familiar",
+    "Licencia por Matrimonio",
+    "Licencia por Nacimiento",
+    "Licencia por Paternidad",
+    "Permiso Gremial"
+)
+MOTIVOS_REQUIRING_CERT = frozenset({"ART", "Licencia Enfermedad Familiar", "Licencia Enfermedad Personal"})
+MOTIVOS_MENU_TEXT = "\n".join(f"{i+1}. {motivo}" for i, motivo in enumerate(MOTIVOS))
+
+# Validaciones de las respuestas del usuario
+RESPUESTAS_SI = frozenset({"si", "sí", "s", "yes"})
+RESPUESTAS_NO = frozenset({"no", "n"})
+
+# Estado de las conversaciones persistido en la tabla conversation_states
+# (compartido entre workers y conservado entre reinicios)
+CONVERSATION_TTL = timedelta(hours=1)
+
+# Un lock por chat para procesar sus mensajes en orden: chat_id -> [lock, usuarios]
+# (la entrada se descarta cuando nadie lo tiene ni lo espera)
+chat_locks = {}
 
-# Diccionario para mantener el estado de las conversaciones en memoria
-conversation_states = {}
+@asynccontextmanager
+async def chat_lock(chat_id):
+    """Procesa en exclusiva dentro del chat; libera la entrada del dict al terminar el último"""
+    entry = chat_locks.get(chat_id)
+    if entry is None:
+        entry = chat_locks[chat_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del chat_locks[chat_id]
+
+# Referencias a las tareas en segundo plano (evita que se recolecten antes de terminar)
+background_tasks = set()
+
+# UPSERT sobre la clave primaria: lectura y escritura en una sola sentencia atómica
+STMT_UPSERT_STATE = CONVERSATION_STATE_INSERT.on_conflict_do_update(
+    index_elements=[ConversationState.chat_id],
+    set_={"state": CONVERSATION_STATE_INSERT.excluded.state, "last_updated": CONVERSATION_STATE_INSERT.excluded.last_updated}
+)
+
+async def load_conversation_state(chat_id):
+    """Obtiene el estado guardado de una conversación (None si no existe o expiró)"""
+    async with AsyncSessionLocal() as db:
+        row = await db.get(ConversationState, chat_id)
+        if row is None or row.last_updated is None or row.last_updated < datetime.now() - CONVERSATION_TTL:
+            return None
+        return row.state
+
+async def save_conversation_state(chat_id, state):
+    """Guarda (o reemplaza) el estado de una conversación"""
+    async with AsyncSessionLocal() as db:
+        await db.execute(STMT_UPSERT_STATE, {"chat_id": chat_id, "state": state, "last_updated": datetime.now()})
+        await db.commit()
+
+async def clear_conversation_state(chat_id):
+    """Elimina el estado de una conversación finalizada o cancelada"""
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(ConversationState).where(ConversationState.chat_id == chat_id))
+        await db.commit()
+
+
+# Sentencias construidas una sola vez (SQLAlchemy reutiliza su SQL compilado)
+STMT_EMPLOYEE = (
+    select(Employee.id, Employee.nombre, Employee.sector, Employee.activo)
+    .where(Employee.legajo == bindparam("legajo"))
+)
+STMT_INSERT_ABSENCE = ABSENCE_INSERT.returning(Absence.id)
 
+# Datos de empleados: cambian poco, se cachean por legajo (solo los encontrados:
+# un legajo recién cargado con load_employees.py se ve en la consulta siguiente)
+EMPLOYEE_CACHE_TTL = 300  # segundos
+EMPLOYEE_CACHE_MAX = 2048
+EmployeeInfo = namedtuple("EmployeeInfo", "id nombre sector activo")
+employee_cache = {}  # legajo -> (vencimiento monotónico, EmployeeInfo)
+
+async def lookup_employee(legajo):
+    """Busca un empleado por legajo (None si no existe)"""
+    cached = employee_cache.get(legajo)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    
+    async with AsyncSessionLocal() as db:
+        row = (await db.execute(STMT_EMPLOYEE, {"legajo": legajo})).first()
+    if row is None:
+        employee_cache.pop(legajo, None)
+        return None
+    
+    employee = EmployeeInfo(*row)
+    if len(employee_cache) >= EMPLOYEE_CACHE_MAX:
+        employee_cache.clear()
+    employee_cache[legajo] = (time.monotonic() + EMPLOYEE_CACHE_TTL, employee)
+    return employee
 
 async def handle_update(update: Update):
     if not update.message:
@@ -39,100 +216,96 @@ async def handle_update(update: Update):
         return
     
     # Obtener o inicializar el estado
-    if chat_id not in conversation_states:
-        conversation_states[chat_id] = {
+    state = await load_conversation_state(chat_id)
+    if state is None:
+        state = {
             "step": "start",
             "data": {}
         }
     
-    state = conversation_states[chat_id]
-    
     # Flujo de la conversación
     if state["step"] == "start":
-        await bot.send_message(chat_id=chat_id, text="Apellido y Nombre:")
+        await send_message(chat_id=chat_id, text="Apellido y Nombre:")
         state["step"] = "name"
     
     elif state["step"] == "name":
         # Guardar el nombre
         state["data"]["name"] = text
-        await bot.send_message(chat_id=chat_id, text="Legajo:")
+        await send_message(chat_id=chat_id, text="Legajo:")
         state["step"] = "legajo"
     
     elif state["step"] == "legajo":
         legajo = text.strip()
         
         # Validar formato de legajo
-        if not legajo.isdigit() or len(legajo) < 4:
-            await bot.send_message(
+        if not validate_legajo_format(legajo):
+            await send_message(
                 chat_id=chat_id,
-                text="❌ Formato de legajo inválido. Debe ser un número de al menos 4 dígitos.\n\nIntenta nuevamente:"
+                text=(f"❌ Formato de legajo inválido. Debe ser un número de {LEGAJO_MIN_LEN} a "
+                      f"{LEGAJO_MAX_LEN} dígitos, sin espacios ni otros caracteres.\n\nIntenta nuevamente:")
             )
             return
         
-        # Buscar empleado en base de datos
-        db = SessionLocal()
-        try:
-            employee = db.query(Employee).filter(Employee.legajo == legajo).first()
+        # Buscar empleado (cacheado por unos minutos)
+        employee = await lookup_employee(legajo)
+        
+        if employee and employee.activo:
+            # Empleado VALIDADO
+            state["data"]["legajo"] = legajo
+            state["data"]["employee_id"] = employee.id
+            state["data"]["validated"] = True
+            state["data"]["employee_name"] = employee.nombre
+            state["data"]["sector"] = employee.sector
+            
+            await send_message(
+                chat_id=chat_id,
+                text=f"✅ **Legajo validado**\n\n"
+                     f"👤 **Empleado:** {employee.nombre}\n"
+                     f"🏢 **Sector:** {get_sector_display_name(employee.sector)}\n"
+                     f"🆔 **Legajo:** {legajo}\n\n"
+                     f"¿El nombre es correcto? Responde **'si'** para continuar o **'no'** para corregir:"
+            )
+            state["step"] = "confirm_employee"
+            
+        elif employee and not employee.activo:
+            # Empleado INACTIVO
+            await send_message(
+                chat_id=chat_id,
+                text=f"⚠️ **Empleado inactivo**\n\n"
+                     f"El legajo {legajo} corresponde a {employee.nombre} pero está marcado como inactivo.\n\n"
+                     f"Contacta a Recursos Humanos para más información."
+            )
+            # Reiniciar conversación
+            await clear_conversation_state(chat_id)
+            return
+            
+        else:
+            # Empleado NO ENCONTRADO
+            state["data"]["legajo"] = legajo
+            state["data"]["validated"] = False
+            state["data"]["employee_id"] = None
+            
+            await send_message(
+                chat_id=chat_id,
+                text=f"⚠️ **Legajo no encontrado**\n\n"
+                     f"El legajo **{legajo}** no está registrado en el sistema.\n\n"
+                     f"¿Deseas continuar como **registro provisional**?\n"
+                     f"- **'si'** → Continuar (se requerirá validación posterior)\n"
+                     f"- **'no'** → Cancelar y verificar el legajo"
+            )
+            state["step"] = "confirm_provisional"
             
-            if employee and employee.activo:
-                # Empleado VALIDADO
-                state["data"]["legajo"] = legajo
-                state["data"]["employee_id"] = employee.id
-                state["data"]["validated"] = True
-                state["data"]["employee_name"] = employee.nombre
-                state["data"]["sector"] = employee.sector
-                
-                await bot.send_message(
-                    chat_id=chat_id,
-                    text=f"✅ **Legajo validado**\n\n"
-                         f"👤 **Empleado:** {employee.nombre}\n"
-                         f"🏢 **Sector:** {get_sector_display_name(employee.sector)}\n"
-                         f"🆔 **Legajo:** {employee.legajo}\n\n"
-                         f"¿El nombre es correcto? Responde **'si'** para continuar o **'no'** para corregir:"
-                )
-                state["step"] = "confirm_employee"
-                
-            elif employee and not employee.activo:
-                # Empleado INACTIVO
-                await bot.send_message(
-                    chat_id=chat_id,
-                    text=f"⚠️ **Empleado inactivo**\n\n"
-                         f"El legajo {legajo} corresponde a {employee.nombre} pero está marcado como inactivo.\n\n"
-                         f"Contacta a Recursos Humanos para más información."
-                )
-                # Reiniciar conversación
-                del conversation_states[chat_id]
-                return
-                
-            else:
-                # Empleado NO ENCONTRADO
-                state["data"]["legajo"] = legajo
-                state["data"]["validated"] = False
-                state["data"]["employee_id"] = None
-                
-                await bot.send_message(
-                    chat_id=chat_id,
-                    text=f"⚠️ **Legajo no encontrado**\n\n"
-                         f"El legajo **{legajo}** no está registrado en el sistema.\n\n"
-                         f"¿Deseas continuar como **registro provisional**?\n"
-                         f"- **'si'** → Continuar (se requerirá validación posterior)\n"
-                         f"- **'no'** → Cancelar y verificar el legajo"
-                )
-                state["step"] = "confirm_provisional"
-                
-        finally:
-            db.close()
     
     elif state["step"] == "confirm_employee":
         # Confirmar datos del empleado validado
-        if text.lower().strip() in ["si", "sí", "s", "yes"]:
-            await bot.send_message(
+        if text.lower().strip() in RESPUESTAS_SI:
+            await send_message(
                 chat_id=chat_id,
                 text="✅ Perfecto. Ahora selecciona el motivo de tu ausencia:"
             )
             state["step"] = "show_motivos"
         else:
-            await bot.send_message(
+            await send_message(
                 chat_id=chat_id,
                 text="❌ Datos incorrectos. Por favor, ingresa tu nombre completo manualmente:"
             )
@@ -140,8 +313,8 @@ async def handle_update(update: Update):
     
     elif state["step"] == "confirm_provisional":
         # Confirmar registro provisional
-        if text.lower().strip() in ["si", "sí", "s", "yes"]:
-            await bot.send_message(
+        if text.lower().strip() in RESPUESTAS_SI:
+            await send_message(
                 chat_id=chat_id,
                 text="⚠️ **Registro Provisional Activado**\n\n"
                      "Tu ausencia se registrará como **provisional** y requerirá validación posterior por RRHH.\n\n"
@@ -149,18 +322,19 @@ async def handle_update(update: Update):
             )
             state["step"] = "manual_name"
         else:
-            await bot.send_message(
+            await send_message(
                 chat_id=chat_id,
                 text="❌ Registro cancelado.\n\n"
                      "Verifica tu legajo con Recursos Humanos y vuelve a intentar.\n\n"
                      "Usa /start para comenzar nuevamente."
             )
-            del conversation_states[chat_id]
+            await clear_conversation_state(chat_id)
+            return
     
     elif state["step"] == "manual_name":
         # Guardar nombre ingresado manualmente
         state["data"]["name"] = text
-        await bot.send_message(
+        await send_message(
             chat_id=chat_id,
             text="✅ Nombre registrado. Ahora selecciona el motivo de tu ausencia:"
         )
@@ -168,21 +342,9 @@ async def handle_update(update: Update):
     
     elif state["step"] == "show_motivos":
         # Mostrar opciones de motivos
-        options = [
-            "ART",
-            "Licencia Enfermedad Familiar",
-            "Licencia Enfermedad Personal",
-            "Licencia por Fallecimiento Familiar",
-            "Licencia por Matrimonio",
-            "Licencia por Nacimiento",
-            "Licencia por Paternidad",
-            "Permiso Gremial"
-        ]
-        options_text = "\n".join([f"{i+1}. {opt}" for i, opt in enumerate(options)])
-        
-        await bot.send_message(
+        await send_message(
             chat_id=chat_id,
-            text=f"¿Cuál es el motivo de tu ausencia?\n{options_text}"
+            text=f"¿Cuál es el motivo de tu ausencia?\n{MOTIVOS_MENU_TEXT}"
         )
         state["step"] = "motivo"
     
@@ -190,31 +352,21 @@ async def handle_update(update: Update):
         # Procesar la selección del motivo
         try:
             choice_num = int(text) - 1
-            options = [
-                "ART",
-                "Licencia Enfermedad Familiar", 
-                "Licencia Enfermedad Personal",
-                "Licencia por Fallecimiento Familiar",
-                "Licencia por Matrimonio",
-                "Licencia por Nacimiento",
-                "Licencia por Paternidad",
-                "Permiso Gremial"
-            ]
             
-            if 0 <= choice_num < len(options):
-                state["data"]["motivo"] = options[choice_num]
-                await bot.send_message(
+            if 0 <= choice_num < len(MOTIVOS):
+                state["data"]["motivo"] = MOTIVOS[choice_num]
+                await send_message(
                     chat_id=chat_id,
-                    text=f"Motivo seleccionado: {options[choice_num]}\n\n¿Cuántos días durará la ausencia?"
+                    text=f"Motivo seleccionado: {MOTIVOS[choice_num]}\n\n¿Cuántos días durará la ausencia?"
                 )
                 state["step"] = "duracion"
             else:
-                await bot.send_message(
+                await send_message(
                     chat_id=chat_id,
                     text="Por favor, selecciona un número válido (1-8):"
                 )
         except ValueError:
-            await bot.send_message(
+            await send_message(
                 chat_id=chat_id,
                 text="Por favor, ingresa solo el número de la opción (1-8):"
             )
@@ -224,7 +376,7 @@ async def handle_update(update: Update):
         try:
             duracion = int(text)
             if duracion <= 0:
-                await bot.send_message(
+                await send_message(
                     chat_id=chat_id,
                     text="La duración debe ser mayor a 0 días. Intenta nuevamente:"
                 )
@@ -234,8 +386,8 @@ async def handle_update(update: Update):
             
             # Preguntar por certificado si es necesario
             motivo = state["data"]["motivo"]
-            if motivo in ["ART", "Licencia Enfermedad Familiar", "Licencia Enfermedad Personal"]:
-                await bot.send_message(
+            if motivo in MOTIVOS_REQUIRING_CERT:
+                await send_message(
                     chat_id=chat_id,
                     text="¿Tienes certificado médico? (Responde 'si' o 'no')"
                 )
@@ -244,10 +396,11 @@ async def handle_update(update: Update):
                 # Guardar directamente si no necesita certificado
                 await save_absence_data(chat_id, state["data"])
                 # Limpiar estado
-                del conversation_states[chat_id]
+                await clear_conversation_state(chat_id)
+                return
                 
         except ValueError:
-            await bot.send_message(
+            await send_message(
                 chat_id=chat_id,
                 text="Por favor, ingresa un número válido de días:"
             )
@@ -255,20 +408,21 @@ async def handle_update(update: Update):
     elif state["step"] == "certificado":
         # Manejar respuesta sobre certificado
         respuesta = text.lower().strip()
-        if respuesta in ["si", "sí", "s"]:
+        if respuesta in RESPUESTAS_SI:
             state["data"]["certificado"] = "Pendiente de envío"
-            await bot.send_message(
+            await send_message(
                 chat_id=chat_id,
                 text="📎 Por favor, envía una foto del certificado médico o escribe 'saltar' para continuar sin certificado."
             )
             state["step"] = "upload_certificado"
-        elif respuesta in ["no", "n"]:
+        elif respuesta in RESPUESTAS_NO:
             state["data"]["certificado"] = "No aplica"
             await save_absence_data(chat_id, state["data"])
             # Limpiar estado
-            del conversation_states[chat_id]
+            await clear_conversation_state(chat_id)
+            return
         else:
-            await bot.send_message(
+            await send_message(
                 chat_id=chat_id,
                 text="Por favor, responde 'si' o 'no':"
             )
@@ -283,61 +437,73 @@ async def handle_update(update: Update):
         
         await save_absence_data(chat_id, state["data"])
         # Limpiar estado
-        del conversation_states[chat_id]
+        await clear_conversation_state(chat_id)
+        return
+    
+    elif state["step"] == "procesando_certificado":
+        # El certificado todavía se está descargando
+        await send_message(
+            chat_id=chat_id,
+            text="⏳ Estamos procesando tu certificado, aguarda un momento..."
+        )
+        return
+    
+    # Persistir el avance de la conversación
+    await save_conversation_state(chat_id, state)
 
 async def save_absence_data(chat_id, data):
     """Guarda los datos de ausencia en la base de datos"""
-    from datetime import timedelta
+    # Todo lo que no usa la base de datos se prepara antes de abrir la transacción
+    # Generar código de registro
+    validated = data.get("validated", False)
+    registration_code = generate_registration_code(data["legajo"], validated)
+    
+    # Calcular deadline para certificado si es necesario
+    certificate_deadline = None
+    motivo = data["motivo"]
+    if motivo in MOTIVOS_REQUIRING_CERT:
+        certificate_deadline = datetime.now() + timedelta(hours=24)
+    
+    # Usar nombre del empleado validado si está disponible
+    final_name = data.get("employee_name", data.get("name", "Nombre no especificado"))
+    
+    fields = dict(
+        chat_id=chat_id,
+        name=final_name,
+        legajo=data["legajo"],
+        motivo=data["motivo"],
+        duracion=data["duracion"],
+        certificado=data.get("certificado", "No aplica"),
+        created_at=datetime.now(),
+        
+        # Nuevos campos del sistema experto
+        employee_id=data.get("employee_id"),
+        registration_code=registration_code,
+        validation_status="validated" if validated else "provisional",
+        certificate_deadline=certificate_deadline,
+        certificate_uploaded=("Archivo guardado:" in data.get("certificado", "")),
+        observaciones="",
+        sancion_aplicada=False
+    )
     
-    db = SessionLocal()
+    from expert.engine import ExpertSystem
+    expert = ExpertSystem()
+    
+    db = AsyncSessionLocal()
     try:
-        # Generar código de registro
-        validated = data.get("validated", False)
-        registration_code = generate_registration_code(data["legajo"], validated)
+        # Insertar y obtener el ID en un solo viaje (RETURNING)
+        absence_id = (await db.execute(STMT_INSERT_ABSENCE, fields)).scalar_one()
         
-        # Calcular deadline para certificado si es necesario
-        certificate_deadline = None
-        motivo = data["motivo"]
-        if motivo in ["ART", "Licencia Enfermedad Familiar", "Licencia Enfermedad Personal"]:
-            certificate_deadline = datetime.now() + timedelta(hours=24)
+        # Aplicar reglas del sistema experto dentro de la misma transacción
+        expert_findings = await db.run_sync(lambda session: expert.apply_expert_rules(absence_id, session=session))
+        await db.commit()
         
-        # Usar nombre del empleado validado si está disponible
-        final_name = data.get("employee_name", data.get("name", "Nombre no especificado"))
-        
-        absence = Absence(
-            chat_id=chat_id,
-            name=final_name,
-            legajo=data["legajo"],
-            motivo=data["motivo"],
-            duracion=data["duracion"],
-            certificado=data.get("certificado", "No aplica"),
-            created_at=datetime.now(),
-            
-            # Nuevos campos del sistema experto
-            employee_id=data.get("employee_id"),
-            registration_code=registration_code,
-            validation_status="validated" if validated else "provisional",
-            certificate_deadline=certificate_deadline,
-            certificate_uploaded=("Archivo guardado:" in data.get("certificado", "")),
-            observaciones="",
-            sancion_aplicada=False
-        )
-        
-        db.add(absence)
-        db.commit()
-        
-        # Obtener el ID de la ausencia recién creada
-        db.refresh(absence)
-        absence_id = absence.id
-        
-        # Aplicar reglas del sistema experto
-        from expert.engine import ExpertSystem
-        expert = ExpertSystem()
-        expert_findings = expert.apply_expert_rules(absence_id)
+        # La API de registros debe reflejar la nueva ausencia
+        records_cache.clear()
         
         # Mensaje mejorado con código de registro
         status = "VALIDADO" if validated else "PROVISIONAL"
-        print(f"✅ Ausencia guardada: {final_name} (Legajo: {data['legajo']}) - {status} - Código: {registration_code}")
+        logger.info("Ausencia guardada: %s (Legajo: %s) - %s - Código: %s", final_name, data['legajo'], status, registration_code)
         
         # Preparar mensaje con alertas del sistema experto
         base_message = (f"✅ **Ausencia registrada exitosamente**\n\n"
@@ -362,27 +528,32 @@ async def save_absence_data(chat_id, data):
         base_message += f"\nEscribe /start para registrar otra ausencia."
         
         # Enviar mensaje al usuario
-        await bot.send_message(chat_id=chat_id, text=base_message)
+        await send_message(chat_id=chat_id, text=base_message)
         
-    except Exception as e:
-        print(f"❌ Error guardando ausencia: {e}")
-        db.rollback()
-        await bot.send_message(
+    except Exception:
+        logger.exception("Error guardando ausencia")
+        await db.rollback()
+        await send_message(
             chat_id=chat_id,
             text="❌ Error al guardar la ausencia. Intenta nuevamente o contacta a soporte."
         )
     finally:
-        db.close()
+        await db.close()
 
 async def show_records(chat_id):
     """Muestra los registros de ausencias del usuario actual"""
-    db = SessionLocal()
     try:
-        # Buscar registros de este chat
-        absences = db.query(Absence).filter(Absence.chat_id == chat_id).order_by(Absence.created_at.desc()).limit(10).all()
+        # Buscar registros de este chat (la sesión se cierra antes de enviar los mensajes)
+        async with AsyncSessionLocal() as db:
+            absences = (await db.execute(
+                select(Absence)
+                .where(Absence.chat_id == chat_id)
+                .order_by(Absence.created_at.desc())
+                .limit(10)
+            )).scalars().all()
         
         if not absences:
-            await bot.send_message(
+            await send_message(
                 chat_id=chat_id,
                 text="📝 No tienes registros de ausencias aún.\n\nUsa /start para registrar tu primera ausencia."
             )
@@ -406,32 +577,29 @@ async def show_records(chat_id):
             # Enviar en partes
             parts = [records_text[i:i+4000] for i in range(0, len(records_text), 4000)]
             for part in parts:
-                await bot.send_message(chat_id=chat_id, text=part)
+                await send_message(chat_id=chat_id, text=part)
         else:
-            await bot.send_message(chat_id=chat_id, text=records_text)
+            await send_message(chat_id=chat_id, text=records_text)
             
-    except Exception as e:
-        print(f"❌ Error mostrando registros: {e}")
-        await bot.send_message(
+    except Exception:
+        logger.exception("Error mostrando registros")
+        await send_message(
             chat_id=chat_id,
             text="❌ Error al consultar registros. Intenta nuevamente."
         )
-    finally:
-        db.close()
 
 async def handle_certificate_photo(update: Update, chat_id):
     """Maneja la recepción de fotos de certificados"""
-    if chat_id not in conversation_states:
-        await bot.send_message(
+    state = await load_conversation_state(chat_id)
+    if state is None:
+        await send_message(
             chat_id=chat_id,
             text="❌ No hay una conversación activa. Usa /start para comenzar."
         )
         return
     
-    state = conversation_states[chat_id]
-    
     if state["step"] != "upload_certificado":
-        await bot.send_message(
+        await send_message(
             chat_id=chat_id,
             text="❌ No esperaba un certificado en este momento."
         )
@@ -445,156 +613,165 @@ async def handle_certificate_photo(update: Update, chat_id):
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         legajo = state["data"].get("legajo", "unknown")
         filename = f"cert_{legajo}_{timestamp}.jpg"
-        filepath = os.path.join("certificados", filename)
         
-        # Descargar la foto
-        file = await bot.get_file(photo.file_id)
-        await file.download_to_drive(filepath)
+        # La descarga sigue en segundo plano; el webhook responde de inmediato
+        state["step"] = "procesando_certificado"
+        await save_conversation_state(chat_id, state)
         
-        # Guardar la ruta en el estado
-        state["data"]["certificado"] = f"Archivo guardado: {filename}"
+        task = asyncio.create_task(download_certificate_and_save(chat_id, state, photo.file_id, filename))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
         
-        await bot.send_message(
+        await send_message(
             chat_id=chat_id,
-            text="✅ Certificado recibido y guardado.\n\nProcesando tu registro..."
+            text="✅ Certificado recibido.\n\nProcesando tu registro..."
         )
         
-        # Guardar y finalizar
-        await save_absence_data(chat_id, state["data"])
-        
-        # Limpiar estado
-        del conversation_states[chat_id]
+    except Exception:
+        logger.exception("Error guardando certificado")
+        await send_message(
+            chat_id=chat_id,
+            text="❌ Error al guardar el certificado. Escribe 'saltar' para continuar sin certificado."
+        )
+
+async def download_certificate_and_save(chat_id, state, file_id, filename):
+    """Descarga el certificado y finaliza el registro (tarea en segundo plano)"""
+    try:
+        file = await bot.get_file(file_id)
+        await file.download_to_drive(os.path.join("certificados", filename))
+        downloaded = True
+    except Exception:
+        logger.exception("Error guardando certificado")
+        downloaded = False
+    
+    # El estado se toca bajo el lock del chat y solo si la conversación sigue esperando
+    # este certificado (un /start durante la descarga inicia otra que no se debe pisar)
+    async with chat_lock(chat_id):
+        current = await load_conversation_state(chat_id)
+        if current is None or current["step"] != "procesando_certificado":
+            logger.info("Chat %s cambió de conversación durante la descarga; se descarta el certificado", chat_id)
+            return
         
-    except Exception as e:
-        print(f"❌ Error guardando certificado: {e}")
-        await bot.send_message(
+        if not downloaded:
+            # Volver a esperar el certificado
+            state["step"] = "upload_certificado"
+            await save_conversation_state(chat_id, state)
+        else:
+            # Guardar la ruta y finalizar
+            state["data"]["certificado"] = f"Archivo guardado: {filename}"
+            await save_absence_data(chat_id, state["data"])
+            
+            # Limpiar estado
+            await clear_conversation_state(chat_id)
+    
+    if not downloaded:
+        await send_message(
             chat_id=chat_id,
             text="❌ Error al guardar el certificado. Escribe 'saltar' para continuar sin certificado."
         )
 
+# Paginación por keyset (id descendente) para el dashboard y la API
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def absences_page_query(limit: int, before_id: Optional[int], columns=(Absence,)):
+    """Consulta de una página de ausencias anteriores a before_id (más recientes primero)"""
+    query = select(*columns).order_by(Absence.id.desc()).limit(limit)
+    if before_id is not None:
+        query = query.where(Absence.id < before_id)
+    return query
+
 @app.get("/", response_class=HTMLResponse)
-async def dashboard():
+async def dashboard(limit: int = PAGE_SIZE, before_id: Optional[int] = None):
     """Página web para ver todos los registros"""
-    db = SessionLocal()
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
     try:
-        absences = db.query(Absence).order_by(Absence.created_at.desc()).all()
-        
-        # Generar HTML
-        html_content = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>📋 Sistema de Ausencias - Dashboard</title>
-            <meta charset="UTF-8">
-            <style>
-                body { font-family: Arial, sans-serif; margin: 20px; background-color: #f5f5f5; }
-                .header { background-color: #2c3e50; color: white; padding: 20px; border-radius: 5px; margin-bottom: 20px; }
-                .record { background-color: white; padding: 15px; margin: 10px 0; border-radius: 5px; box-shadow: 0 2px 4px rgba(0,0,0,0.1); }
-                .record h3 { margin: 0 0 10px 0; color: #2c3e50; }
-                .field { margin: 5px 0; }
-                .label { font-weight: bold; color: #34495e; }
-                .no-records { text-align: center; color: #7f8c8d; font-style: italic; }
-                .stats { background-color: #3498db; color: white; padding: 15px; border-radius: 5px; margin-bottom: 20px; }
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <h1>🏢 Sistema de Registro de Ausencias</h1>
-                <p>Dashboard administrativo - Todos los registros</p>
-                <div style="margin-top: 15px;">
-                    <a href="/rules" style="background: #28a745; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; margin-right: 10px;">🧠 Gestionar Reglas</a>
-                    <a href="/rules/new" style="background: #007bff; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; margin-right: 10px;">➕ Nueva Regla</a>
-                    <a href="/api/registros" style="background: #6c757d; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px;">📊 API JSON</a>
-                </div>
-            </div>
-        """
-        
-        if absences:
-            # Estadísticas
-            total_registros = len(absences)
-            motivos = {}
-            for absence in absences:
-                motivos[absence.motivo] = motivos.get(absence.motivo, 0) + 1
-            
-            html_content += f"""
-            <div class="stats">
-                <h3>📊 Estadísticas</h3>
-                <p><strong>Total de registros:</strong> {total_registros}</p>
-                <p><strong>Motivos más comunes:</strong></p>
-                <ul>
-            """
+        async with AsyncSessionLocal() as db:
+            # Estadísticas calculadas en la base de datos
+            total_registros = (await db.execute(select(func.count()).select_from(Absence))).scalar_one()
+            top_motivos = (await db.execute(
+                select(Absence.motivo, func.count())
+                .group_by(Absence.motivo)
+                .order_by(func.count().desc())
+                .limit(5)
+            )).all()
             
-            for motivo, count in sorted(motivos.items(), key=lambda x: x[1], reverse=True)[:5]:
-                html_content += f"<li>{motivo}: {count} registros</li>"
-            
-            html_content += "</ul></div>"
-            
-            # Registros
-            for absence in absences:
-                date_str = absence.created_at.strftime('%d/%m/%Y a las %H:%M')
-                
-                # Verificar si hay certificado con archivo
-                certificado_html = absence.certificado
-                if "Archivo guardado:" in absence.certificado:
-                    filename = absence.certificado.replace("Archivo guardado: ", "")
-                    certificado_html = f'<a href="/certificados/{filename}" target="_blank">📎 Ver certificado</a>'
-                
-                html_content += f"""
-                <div class="record">
-                    <h3>👤 {absence.name}</h3>
-                    <div class="field"><span class="label">🆔 Legajo:</span> {absence.legajo}</div>
-                    <div class="field"><span class="label">📅 Motivo:</span> {absence.motivo}</div>
-                    <div class="field"><span class="label">⏰ Duración:</span> {absence.duracion} días</div>
-                    <div class="field"><span class="label">🏥 Certificado:</span> {certificado_html}</div>
-                    <div class="field"><span class="label">📆 Registrado:</span> {date_str}</div>
-                    <div class="field"><span class="label">💬 Chat ID:</span> {absence.chat_id}</div>
-                </div>
-                """
-        else:
-            html_content += '<div class="no-records">📝 No hay registros de ausencias aún.</div>'
-        
-        html_content += """
-            <br><br>
-            <div style="text-align: center; color: #7f8c8d; font-size: 12px;">
-                <p>🔄 Actualiza la página para ver los últimos registros</p>
-            </div>
-        </body>
-        </html>
-        """
-        
-        return HTMLResponse(content=html_content)
+            # Página de registros solicitada
+            result = await db.execute(absences_page_query(limit, before_id))
+            absences = result.scalars().all()
+        
+        # Renderizar plantilla (autoescape de los datos ingresados por los usuarios)
+        # dentro del try, para que los errores de la plantilla también se informen
+        return HTMLResponse(content=DASHBOARD_TEMPLATE.render({
+            "absences": absences,
+            "total": total_registros,
+            "motivos": top_motivos,
+            "limit": limit,
+            "before_id": before_id,
+            "next_before_id": absences[-1].id if len(absences) == limit else None
+        }))
         
     except Exception as e:
         return HTMLResponse(content=f"<h1>❌ Error</h1><p>{str(e)}</p>")
-    finally:
-        db.close()
 
-@app.get("/api/registros")
-async def get_records_api():
+# Cache corto de /api/registros por página; las peticiones simultáneas a la misma
+# página comparten una sola consulta en curso (sin bloquear a las demás páginas)
+RECORDS_CACHE_TTL = 5  # segundos
+RECORDS_CACHE_MAX_PAGES = 64
+records_cache = {}
+records_inflight = {}  # (limit, before_id) -> tarea con la consulta en curso
+
+async def load_records_page(key):
+    """Consulta una página y la guarda en el cache (si no hubo error)"""
+    payload = await fetch_records_page(*key)
+    if "error" not in payload:
+        if len(records_cache) >= RECORDS_CACHE_MAX_PAGES:
+            records_cache.clear()
+        records_cache[key] = (time.monotonic() + RECORDS_CACHE_TTL, payload)
+    return payload
+
+@app.get("/api/registros", response_class=ORJSONResponse)
+async def get_records_api(limit: int = PAGE_SIZE, before_id: Optional[int] = None):
     """API endpoint para obtener registros en formato JSON"""
-    db = SessionLocal()
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    key = (limit, before_id)
+    
+    cached = records_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return ORJSONResponse(cached[1])
+    
+    task = records_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(load_records_page(key))
+        records_inflight[key] = task
+        task.add_done_callback(lambda _: records_inflight.pop(key, None))
+    
+    # shield: si un cliente se desconecta no se cancela la consulta de los demás
+    return ORJSONResponse(await asyncio.shield(task))
+
+RECORD_COLUMNS = (
+    Absence.id, Absence.name, Absence.legajo, Absence.motivo,
+    Absence.duracion, Absence.certificado, Absence.created_at, Absence.chat_id
+)
+
+async def fetch_records_page(limit, before_id):
+    """Consulta una página de registros para la API"""
+    db = AsyncSessionLocal()
     try:
-        absences = db.query(Absence).order_by(Absence.created_at.desc()).all()
-        
-        records = []
-        for absence in absences:
-            records.append({
-                "id": absence.id,
-                "name": absence.name,
-                "legajo": absence.legajo,
-                "motivo": absence.motivo,
-                "duracion": absence.duracion,
-                "certificado": absence.certificado,
-                "created_at": absence.created_at.isoformat(),
-                "chat_id": absence.chat_id
-            })
-        
-        return {"total": len(records), "registros": records}
+        total = (await db.execute(select(func.count()).select_from(Absence))).scalar_one()
+        # Solo las columnas publicadas; orjson serializa los datetime directamente
+        result = await db.execute(absences_page_query(limit, before_id, RECORD_COLUMNS))
+        records = [dict(row) for row in result.mappings()]
+        
+        # Cursor para pedir la página siguiente (None si no hay más)
+        next_before_id = records[-1]["id"] if len(records) == limit else None
+        
+        return {"total": total, "registros": records, "next_before_id": next_before_id}
         
     except Exception as e:
         return {"error": str(e)}
     finally:
-        db.close()
+        await db.close()
 
 @app.get("/certificados")
 async def list_certificates():
@@ -603,42 +780,42 @@ async def list_certificates():
         if not os.path.exists("certificados"):
             return {"certificados": [], "total": 0}
         
-        files = os.listdir("certificados")
-        certificates = []
-        
-        for filename in files:
-            if filename.endswith(('.jpg', '.jpeg', '.png')):
-                filepath = os.path.join("certificados", filename)
-                stat = os.stat(filepath)
-                
-                certificates.append({
-                    "filename": filename,
-                    "size_kb": round(stat.st_size / 1024, 2),
-                    "created": datetime.fromtimestamp(stat.st_ctime).strftime('%d/%m/%Y %H:%M'),
-                    "url": f"/certificados/{filename}"
-                })
+        # scandir reutiliza los datos del directorio (menos llamadas al sistema)
+        entries = []
+        with os.scandir("certificados") as it:
+            for entry in it:
+                if entry.name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                    entries.append((entry.name, entry.stat()))
         
         # Ordenar por fecha de creación (más recientes primero)
-        certificates.sort(key=lambda x: x['created'], reverse=True)
+        entries.sort(key=lambda item: item[1].st_ctime, reverse=True)
+        
+        certificates = [
+            {
+                "filename": filename,
+                "size_kb": round(stat.st_size / 1024, 2),
+                "created": datetime.fromtimestamp(stat.st_ctime).strftime('%d/%m/%Y %H:%M'),
+                "url": f"/certificados/{filename}"
+            }
+            for filename, stat in entries
+        ]
         
         return {"certificados": certificates, "total": len(certificates)}
         
     except Exception as e:
         return {"error": str(e)}
 
-@app.get("/certificados/{filename}")
-async def get_certificate(filename: str):
-    """Devuelve un archivo de certificado específico"""
-    filepath = os.path.join("certificados", filename)
-    
-    if not os.path.exists(filepath):
-        return JSONResponse({"error": "Certificado no encontrado"}, status_code=404)
-    
-    return FileResponse(
-        filepath,
-        media_type='image/jpeg',
-        filename=filename
-    )
+# Archivos de certificados servidos por StaticFiles (sendfile, ETag, Range, 304)
+os.makedirs("certificados", exist_ok=True)
+app.mount("/certificados", StaticFiles(directory="certificados"), name="certificados")
+
+@app.middleware("http")
+async def cache_certificates(request: Request, call_next):
+    """Los certificados no cambian (el nombre incluye el timestamp): cache de larga duración"""
+    response = await call_next(request)
+    if request.url.path.startswith("/certificados/") and response.status_code == 200:
+        response.headers["Cache-Control"] = "public, max-age=86400, immutable"
+    return response
 
 # Manejar comando /start
 @app.post("/webhook")
@@ -651,11 +828,13 @@ async def webhook(request: Request):
         if update.message.text.startswith('/start'):
             chat_id = update.effective_chat.id
             # Reiniciar conversación - cambiar step a "name" para evitar duplicado
-            conversation_states[chat_id] = {
-                "step": "name",
-                "data": {}
-            }
-            await bot.send_message(
+            # (bajo el lock del chat, para no pisar un mensaje en curso ni ser pisado)
+            async with chat_lock(chat_id):
+                await save_conversation_state(chat_id, {
+                    "step": "name",
+                    "data": {}
+                })
+            await send_message(
                 chat_id=chat_id, 
                 text="🏢 **Sistema de Registro de Ausencias**\n\nApellido y Nombre:"
             )
@@ -677,11 +856,13 @@ async def webhook(request: Request):
 
 Para registrar una ausencia, usa /start y sigue las instrucciones.
             """
-            await bot.send_message(chat_id=chat_id, text=help_text)
+            await send_message(chat_id=chat_id, text=help_text)
             return JSONResponse({"status": "ok"})
     
-    # Procesar el mensaje normal
-    await handle_update(update)
+    # Procesar el mensaje normal (en orden dentro de cada chat)
+    if update.message:
+        async with chat_lock(update.effective_chat.id):
+            await handle_update(update)
     
     return JSONResponse({"status": "ok"})
 
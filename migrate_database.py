@@ -1,136 +1,247 @@
 # migrate_database.py - Migra la base de datos a la nueva estructura
 import sqlite3
 import os
+import shutil
 from datetime import datetime
 
-def backup_database():
-    """Crear backup de la base de datos actual"""
-    if os.path.exists('test.db'):
+# Mismo engine (URL, pool y PRAGMAs de conexión) que usa la aplicación
+from models.database import engine, ABSENCES_UPDATED_AT_TRIGGERS
+from expert.rules_manager import RulesManager
+
+DB_PATH = engine.url.database
+
+# Nuevas columnas de absences (las que la verificación exige)
+NEW_COLUMNS = [
+    ('employee_id', 'INTEGER'),
+    ('registration_code', 'TEXT'),
+    ('validation_status', 'TEXT DEFAULT "provisional"'),
+    ('certificate_deadline', 'DATETIME'),
+    ('certificate_uploaded', 'BOOLEAN DEFAULT 0'),
+    ('observaciones', 'TEXT DEFAULT ""'),
+    ('sancion_aplicada', 'BOOLEAN DEFAULT 0'),
+    ('updated_at', 'DATETIME')
+]
+REQUIRED_COLUMNS = frozenset(column_name for column_name, _ in NEW_COLUMNS)
+
+# Índices que agrega la migración (si falta alguno se vuelve a migrar aunque el esquema no haya cambiado)
+REQUIRED_INDEXES = frozenset([
+    'ix_absence_chat_created',
+    'ix_absence_legajo_created',
+    'ix_absences_employee',
+    'ix_absences_deadline',
+    'ix_state_step',
+])
+
+def backup_database(conn):
+    """Crear backup de la base de datos actual (usando la conexión de la migración)"""
+    if os.path.exists(DB_PATH):
         backup_name = f"test_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-        os.system(f'copy "test.db" "{backup_name}"')
+        # VACUUM INTO: copia compactada y consistente en una sola sentencia
+        try:
+            conn.cursor().execute("VACUUM INTO ?", (backup_name,))
+        except sqlite3.OperationalError:
+            shutil.copy2(DB_PATH, backup_name)
         print(f"[BACKUP] Base de datos respaldada como: {backup_name}")
         return backup_name
     return None
 
+def _schema_unchanged(cursor):
+    """True si el esquema no cambió (PRAGMA schema_version) desde la última migración exitosa"""
+    cursor.execute("PRAGMA schema_version;")
+    current_version = cursor.fetchone()[0]
+    try:
+        cursor.execute("SELECT value FROM _migration_meta WHERE key = 'schema_version_at_migrate';")
+    except sqlite3.OperationalError:
+        return False  # Nunca se migró
+    row = cursor.fetchone()
+    if row is None or row[0] != current_version:
+        return False
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index';")
+    return REQUIRED_INDEXES <= {name for name, in cursor.fetchall()}
+
+def _store_schema_version(conn):
+    """Guarda el schema_version resultante de una migración exitosa"""
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS _migration_meta (key TEXT PRIMARY KEY, value INTEGER);")
+    cursor.execute("PRAGMA schema_version;")
+    version = cursor.fetchone()[0]
+    cursor.execute("""
+        INSERT INTO _migration_meta (key, value) VALUES ('schema_version_at_migrate', ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value;
+    """, (version,))
+    conn.commit()
+
 def migrate_database():
-    """Migra la base de datos agregando las nuevas columnas"""
+    """Migra la base de datos agregando las nuevas columnas.
     
-    # Backup first
-    backup_file = backup_database()
+    Devuelve el conjunto de columnas finales de absences, o None si el esquema
+    no cambió desde la última migración exitosa (ya verificada).
+    """
     
-    conn = sqlite3.connect('test.db')
+    conn = engine.raw_connection()
     cursor = conn.cursor()
     
+    # Sin cambios de esquema desde la última migración: nada que hacer
+    if _schema_unchanged(cursor):
+        print("[MIGRATE] Esquema sin cambios desde la última migración")
+        conn.close()
+        return None
+    
+    # Backup first
+    backup_file = backup_database(conn)
+    existing_columns = set()
+    
     try:
         print("[MIGRATE] Iniciando migración de base de datos...")
         
+        # Lock exclusivo del archivo durante toda la migración (no se re-adquiere por sentencia)
+        cursor.execute("PRAGMA locking_mode=EXCLUSIVE;")
+        
+        # Durabilidad relajada solo durante la migración, que ya tiene backup
+        cursor.execute("PRAGMA synchronous=OFF;")
+        cursor.execute("PRAGMA journal_mode=MEMORY;")
+        
         # Verificar columnas existentes
         cursor.execute("PRAGMA table_info(absences);")
-        existing_columns = [column[1] for column in cursor.fetchall()]
-        print(f"[INFO] Columnas existentes: {existing_columns}")
-        
-        # Nuevas columnas a agregar
-        new_columns = [
-            ('employee_id', 'INTEGER'),
-            ('registration_code', 'TEXT'),
-            ('validation_status', 'TEXT DEFAULT "provisional"'),
-            ('certificate_deadline', 'DATETIME'),
-            ('certificate_uploaded', 'BOOLEAN DEFAULT 0'),
-            ('observaciones', 'TEXT DEFAULT ""'),
-            ('sancion_aplicada', 'BOOLEAN DEFAULT 0')
-        ]
+        column_names = [column[1] for column in cursor.fetchall()]
+        existing_columns = set(column_names)
+        print(f"[INFO] Columnas existentes: {column_names}")
         
         # Agregar columnas que no existen
-        added_columns = []
-        for column_name, column_type in new_columns:
-            if column_name not in existing_columns:
-                try:
-                    cursor.execute(f"ALTER TABLE absences ADD COLUMN {column_name} {column_type};")
-                    added_columns.append(column_name)
-                    print(f"[ADD] Columna agregada: {column_name}")
-                except Exception as e:
-                    print(f"[ERROR] No se pudo agregar {column_name}: {e}")
-        
-        # Crear tabla employees si no existe
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS employees (
+        added_columns = [column_name for column_name, _ in NEW_COLUMNS if column_name not in existing_columns]
+        ddl = [
+            f"ALTER TABLE absences ADD COLUMN {column_name} {column_type};"
+            for column_name, column_type in NEW_COLUMNS
+            if column_name not in existing_columns
+        ]
+        
+        # updated_at arranca en created_at para las filas existentes; luego lo mantienen los triggers
+        if 'updated_at' not in existing_columns:
+            ddl.append("UPDATE absences SET updated_at = created_at WHERE updated_at IS NULL;")
+        ddl += [trigger + ";" for trigger in ABSENCES_UPDATED_AT_TRIGGERS]
+        
+        ddl += [
+            # Tabla employees
+            """CREATE TABLE IF NOT EXISTS employees (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 legajo TEXT UNIQUE NOT NULL,
                 nombre TEXT NOT NULL,
                 sector TEXT NOT NULL,
                 activo BOOLEAN DEFAULT 1,
                 created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        print("[CREATE] Tabla employees verificada/creada")
+            );""",
+            # Historial por chat (employees.legajo ya tiene índice único)
+            "CREATE INDEX IF NOT EXISTS ix_absence_chat_created ON absences (chat_id, created_at DESC);",
+            # Búsqueda por legajo ordenada por fecha
+            "CREATE INDEX IF NOT EXISTS ix_absence_legajo_created ON absences (legajo, created_at DESC);",
+            # Búsquedas por empleado y control de deadlines de certificados pendientes
+            "CREATE INDEX IF NOT EXISTS ix_absences_employee ON absences (employee_id);",
+            """CREATE INDEX IF NOT EXISTS ix_absences_deadline ON absences (certificate_deadline)
+            WHERE certificate_uploaded = 0 AND sancion_aplicada = 0;""",
+        ]
+        
+        # conversation_states con JSON validado por JSON1 (se reconstruye si es la versión anterior)
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'conversation_states';")
+        row = cursor.fetchone()
+        if row is None or "json_valid" not in row[0]:
+            if row is not None:
+                ddl.append("ALTER TABLE conversation_states RENAME TO _conversation_states_old;")
+            ddl.append("""CREATE TABLE conversation_states (
+                chat_id INTEGER PRIMARY KEY,
+                state TEXT CHECK (json_valid(state)),
+                last_updated DATETIME DEFAULT CURRENT_TIMESTAMP
+            );""")
+            if row is not None:
+                ddl += [
+                    """INSERT INTO conversation_states (chat_id, state, last_updated)
+                    SELECT chat_id, state, last_updated FROM _conversation_states_old WHERE json_valid(state);""",
+                    "DROP TABLE _conversation_states_old;",
+                ]
+        ddl.append("CREATE INDEX IF NOT EXISTS ix_state_step ON conversation_states (json_extract(state, '$.step'));")
         
-        conn.commit()
+        # Todo el DDL en un solo script y una sola transacción (un solo fsync)
+        cursor.executescript("BEGIN EXCLUSIVE;\n" + "\n".join(ddl) + "\nCOMMIT;\n")
+        
+        for column_name in added_columns:
+            print(f"[ADD] Columna agregada: {column_name}")
+        print("[CREATE] Tablas employees/conversation_states e índices verificados/creados")
+        
+        # Restaurar los modos normales de la aplicación; el lock exclusivo se libera
+        # con la siguiente lectura y debe soltarse antes de volver a WAL
+        cursor.execute("PRAGMA locking_mode=NORMAL;")
+        cursor.execute("SELECT 1 FROM sqlite_master LIMIT 1;").fetchall()
+        cursor.execute("PRAGMA journal_mode=WAL;")
+        cursor.execute("PRAGMA synchronous=NORMAL;")
+        
+        # Estadísticas para el planificador con las columnas e índices nuevos
+        cursor.execute("ANALYZE;")
         
         # Verificar el resultado
         cursor.execute("PRAGMA table_info(absences);")
         final_columns = [column[1] for column in cursor.fetchall()]
+        existing_columns = set(final_columns)
         
         print(f"[SUCCESS] Migración completada!")
         print(f"[INFO] Columnas finales: {final_columns}")
         print(f"[INFO] Columnas agregadas: {added_columns}")
         
         # Contar registros
-        cursor.execute("SELECT COUNT(*) FROM absences;")
-        absence_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM employees;")
-        employee_count = cursor.fetchone()[0]
+        cursor.execute("SELECT (SELECT COUNT(*) FROM absences), (SELECT COUNT(*) FROM employees);")
+        absence_count, employee_count = cursor.fetchone()
         
         print(f"[INFO] Registros preservados:")
         print(f"  - Ausencias: {absence_count}")
         print(f"  - Empleados: {employee_count}")
         
+        cursor.execute("PRAGMA optimize;")
+        
+        # Registrar la versión del esquema (después de ANALYZE/optimize, que también la cambian)
+        _store_schema_version(conn)
+        
     except Exception as e:
         print(f"[ERROR] Error en migración: {e}")
+        conn.rollback()
+        # Descartar la conexión: conserva el lock exclusivo y el journal en memoria
+        conn.invalidate()
         if backup_file:
             print(f"[RESTORE] Puedes restaurar desde: {backup_file}")
     finally:
         conn.close()
+    
+    return existing_columns
 
-def verify_migration():
-    """Verifica que la migración fue exitosa"""
-    conn = sqlite3.connect('test.db')
-    cursor = conn.cursor()
+def _verify(final_columns):
+    """Verifica que la migración fue exitosa (columnas leídas por migrate_database)"""
+    missing = REQUIRED_COLUMNS - final_columns
     
-    try:
-        # Verificar estructura de absences
-        cursor.execute("PRAGMA table_info(absences);")
-        columns = cursor.fetchall()
-        
-        required_columns = [
-            'employee_id', 'registration_code', 'validation_status',
-            'certificate_deadline', 'certificate_uploaded', 
-            'observaciones', 'sancion_aplicada'
-        ]
-        
-        existing_columns = [col[1] for col in columns]
-        missing = [col for col in required_columns if col not in existing_columns]
-        
-        if missing:
-            print(f"[VERIFY] FALTAN COLUMNAS: {missing}")
-            return False
-        else:
-            print("[VERIFY] ✅ Todas las columnas requeridas están presentes")
-            return True
-            
-    finally:
-        conn.close()
+    if missing:
+        print(f"[VERIFY] FALTAN COLUMNAS: {sorted(missing)}")
+        return False
+    else:
+        print("[VERIFY] ✅ Todas las columnas requeridas están presentes")
+        return True
 
 if __name__ == "__main__":
     print("[DATABASE] MIGRADOR DE BASE DE DATOS")
     print("=" * 50)
     
-    migrate_database()
+    final_columns = migrate_database()
+    
+    # Backups de reglas sueltos (versiones anteriores) al archivo zip único
+    moved = RulesManager(backup=False).migrate_legacy_backups()
+    if moved:
+        print(f"[MIGRATE] Backups de reglas movidos a rules_backups.zip: {moved}")
     
     print("\n[VERIFY] VERIFICANDO MIGRACION...")
     print("=" * 50)
     
-    if verify_migration():
+    if final_columns is None:
+        print("[VERIFY] ✅ Esquema sin cambios desde la última migración")
+        verified = True
+    else:
+        verified = _verify(final_columns)
+    
+    if verified:
         print("\n[SUCCESS] MIGRACION EXITOSA")
         print("La base de datos esta lista para el sistema experto")
     else:
@@ -1,7 +1,11 @@
 # models/database.py
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean, func
+from typing import Optional
+
+from sqlalchemy import create_engine, event, text, DDL, BigInteger, Column, Index, Integer, JSON, String, Text, DateTime, Boolean, func
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 import config 
 
@@ -23,7 +27,7 @@ class Absence(Base):
     __tablename__ = "absences"
     
     id = Column(Integer, primary_key=True, index=True)
-    chat_id = Column(Integer)  # ID de Telegram del usuario
+    chat_id = Column(BigInteger)  # ID de Telegram del usuario (puede superar 2^31)
     name = Column(String)
     legajo = Column(String)
     motivo = Column(String)
@@ -39,18 +43,148 @@ class Absence(Base):
     certificate_uploaded = Column(Boolean, default=False)  # Si subió certificado
     observaciones = Column(Text, default="")  # Observaciones del sistema experto
     sancion_aplicada = Column(Boolean, default=False)  # Si tiene sanción por incumplimiento
+    updated_at = Column(DateTime, server_default=func.now())  # Mantenido por triggers de SQLite
+    
+    __table_args__ = (
+        # Historial por chat (/registros): filtro por chat_id ordenado por fecha
+        Index('ix_absence_chat_created', chat_id, created_at.desc()),
+        # Búsqueda por legajo ordenada por fecha (view_records.search_by_legajo)
+        Index('ix_absence_legajo_created', legajo, created_at.desc()),
+        Index('ix_absences_employee', employee_id),
+        # Solo ausencias con certificado pendiente y sin sanción (las que revisa el control de deadlines)
+        Index('ix_absences_deadline', certificate_deadline,
+              sqlite_where=text("certificate_uploaded = 0 AND sancion_aplicada = 0")),
+    )
+
+# updated_at lo mantiene SQLite: al insertar sin valor y en cada UPDATE que no lo fije
+ABSENCES_UPDATED_AT_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS absences_inserted AFTER INSERT ON absences
+    WHEN NEW.updated_at IS NULL
+    BEGIN UPDATE absences SET updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id; END""",
+    """CREATE TRIGGER IF NOT EXISTS absences_updated AFTER UPDATE ON absences
+    WHEN NEW.updated_at IS OLD.updated_at
+    BEGIN UPDATE absences SET updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id; END""",
+)
+
+for _trigger in ABSENCES_UPDATED_AT_TRIGGERS:
+    event.listen(Absence.__table__, "after_create", DDL(_trigger).execute_if(dialect="sqlite"))
 
 # Modelo para el estado de la conversación
 class ConversationState(Base):
     __tablename__ = "conversation_states"
     
-    chat_id = Column(Integer, primary_key=True)
-    state = Column(String)  # JSON con el estado actual
+    # En SQLite se mantiene INTEGER PRIMARY KEY (alias del rowid)
+    chat_id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    state = Column(JSON)  # Estado actual (JSON1 en SQLite)
     last_updated = Column(DateTime, server_default=func.now())
+    
+    __table_args__ = (
+        # Conversaciones por paso sin decodificar el JSON en Python
+        Index('ix_state_step', func.json_extract(state, '$.step')),
+    )
+
+# Sentencias INSERT construidas una sola vez: SQLAlchemy cachea su SQL compilado
+# y cada llamada solo enlaza parámetros (session.execute(ABSENCE_INSERT, fila))
+ABSENCE_INSERT = insert(Absence)
+EMPLOYEE_INSERT = insert(Employee)
+CONVERSATION_STATE_INSERT = insert(ConversationState)
+
+IS_SQLITE = config.DATABASE_URL.startswith("sqlite")
+
+# Pool dimensionado para ráfagas del webhook (SQLite es local: sin pre-ping)
+POOL_OPTIONS = dict(
+    pool_size=10,
+    max_overflow=20,
+    pool_timeout=5,
+    pool_pre_ping=not IS_SQLITE,
+    pool_recycle=1800
+)
+
+# Ajustes aplicados a cada conexión SQLite nueva
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",        # lectores concurrentes con un escritor
+    "PRAGMA synchronous=NORMAL",      # en WAL, un fsync por checkpoint y no por commit
+    "PRAGMA wal_autocheckpoint=200",  # checkpoint automático cada 200 páginas (WAL acotado)
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",       # ~20 MB de caché de páginas
+    "PRAGMA mmap_size=268435456",     # 256 MB
+    "PRAGMA foreign_keys=ON",
+)
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Aplica SQLITE_PRAGMAS al abrir una conexión"""
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+def _optimize_sqlite(dbapi_connection, connection_record):
+    """PRAGMA optimize al cerrar una conexión (ANALYZE solo de las tablas con estadísticas viejas)"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA optimize")
+    cursor.close()
 
 # Inicializar la base de datos
-engine = create_engine(config.DATABASE_URL)
+engine = create_engine(
+    config.DATABASE_URL,
+    connect_args={"check_same_thread": False} if IS_SQLITE else {},
+    **POOL_OPTIONS
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Una sesión por hilo para scripts de consulta que llaman varias veces (view_records)
+ScopedSession = scoped_session(SessionLocal)
+
+# Motor asíncrono para los endpoints de FastAPI (no bloquea el event loop)
+async_engine = create_async_engine(config.DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1), **POOL_OPTIONS)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+if IS_SQLITE:
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+    event.listen(engine, "close", _optimize_sqlite)
+    event.listen(async_engine.sync_engine, "close", _optimize_sqlite)
+
+def checkpoint():
+    """Vuelca el WAL a la base y lo trunca a cero bytes (PRAGMA wal_checkpoint(TRUNCATE))"""
+    if not IS_SQLITE:
+        return
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        cursor.close()
+    finally:
+        conn.close()
+
+# Inserciones masivas: un solo INSERT de varias filas y un commit por lote
+# (conviene agrupar de a 100 filas o más en lugar de hacer commit por fila)
+def bulk_insert_absences(rows):
+    """Inserta una lista de dicts como ausencias en una sola transacción"""
+    with SessionLocal() as session:
+        session.execute(ABSENCE_INSERT, rows)
+        session.commit()
+
+def bulk_insert_employees(rows):
+    """Inserta una lista de dicts como empleados en una sola transacción"""
+    with SessionLocal() as session:
+        session.execute(EMPLOYEE_INSERT, rows)
+        session.commit()
+
+# PRAGMA schema_version tras el create_all de este proceso (0 fuera de SQLite);
+# None mientras no se hayan creado las tablas
+_created_schema_version: Optional[int] = None
+
+def create_tables():
+    """Crea las tablas que falten; una sola vez por proceso"""
+    global _created_schema_version
+    if _created_schema_version is not None:
+        return
+    with engine.begin() as conn:
+        Base.metadata.create_all(bind=conn)
+        _created_schema_version = (
+            conn.exec_driver_sql("PRAGMA schema_version").scalar() if IS_SQLITE else 0
+        )
+
 # Crear tablas si no existen
-Base.metadata.create_all(bind=engine)
+create_tables()
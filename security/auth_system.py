@@ -1,13 +1,183 @@
 # security/auth_system.py - Sistema de autenticación y seguridad
+import atexit
+import base64
+import collections
 import hashlib
-import secrets
+import hmac
+import os
+import time
 import jwt
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple, Any
 from dataclasses import dataclass
 import sqlite3
 import json
+import queue
+import threading
+from contextlib import contextmanager
+import functools
+import operator
 from functools import wraps
+from pathlib import Path
+
+# Iteraciones de PBKDF2-HMAC-SHA256 de los hashes heredados (formato 'salt:hex')
+PBKDF2_ITERATIONS = 100000
+
+# Máximo de tokens JWT validados en caché (se descarta el más antiguo)
+JWT_CACHE_SIZE = 10000
+
+# Caché de API keys validadas: segundos de vigencia y cantidad máxima de entradas
+APIKEY_CACHE_TTL = 60
+APIKEY_CACHE_SIZE = 10000
+
+# Buffer de eventos de seguridad: tamaño máximo, filas por lote y período de escritura
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 500
+LOG_FLUSH_INTERVAL = 0.5  # segundos
+
+# Conexiones de solo lectura mantenidas abiertas por SecurityManager
+READ_POOL_SIZE = 4
+
+# Ajustes de cada conexión (WAL: los lectores no esperan al escritor)
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
+
+# Bytes aleatorios pedidos al sistema por cada recarga del pool de cada hilo
+RAND_POOL_SIZE = 4096
+
+class _RandPool(threading.local):
+    """Pool por hilo de bytes de os.urandom: una llamada al sistema cada RAND_POOL_SIZE bytes"""
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.buf = b''
+        self.pos = 0
+    
+    def token_urlsafe(self, nbytes: int) -> str:
+        """Equivalente a secrets.token_urlsafe(nbytes) tomando los bytes del pool"""
+        if self.pos + nbytes > len(self.buf):
+            self.buf = os.urandom(max(RAND_POOL_SIZE, nbytes))
+            self.pos = 0
+        out = self.buf[self.pos:self.pos + nbytes]
+        self.pos += nbytes
+        return base64.urlsafe_b64encode(out).rstrip(b'=').decode('ascii')
+
+_rand = _RandPool()
+# Un proceso hijo no debe reutilizar los bytes que heredó del padre
+os.register_at_fork(after_in_child=_rand.reset)
+
+# Etapas de inicialización guardadas en PRAGMA user_version
+SECURITY_SCHEMA_VERSION = 1  # tablas e índices creados
+DEFAULT_USERS_VERSION = 2    # usuarios por defecto creados
+UNIX_TIMESTAMPS_VERSION = 3  # fechas ISO heredadas convertidas a segundos Unix
+LOG_DATABASE_VERSION = 4     # security_logs movida de la base principal a logdb
+
+# Columnas de fecha (segundos Unix en INTEGER)
+TIMESTAMP_COLUMNS = {
+    'users': ('created_at', 'last_login'),
+    'api_keys': ('created_at', 'expires_at', 'last_used'),
+    'sessions': ('created_at', 'expires_at'),
+    'security_logs': ('timestamp',),
+}
+
+# Tablas e índices de seguridad (se aplican con un solo executescript)
+SECURITY_DDL = """
+-- Tabla de usuarios
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    username TEXT UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    role TEXT NOT NULL,
+    permissions TEXT NOT NULL,
+    permissions_mask INTEGER,
+    is_active BOOLEAN DEFAULT 1,
+    created_at INTEGER NOT NULL,
+    last_login INTEGER,
+    failed_attempts INTEGER DEFAULT 0
+);
+
+-- Tabla de claves API
+CREATE TABLE IF NOT EXISTS api_keys (
+    key_id TEXT PRIMARY KEY,
+    key_hash TEXT UNIQUE NOT NULL,
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    permissions TEXT NOT NULL,
+    permissions_mask INTEGER,
+    created_at INTEGER NOT NULL,
+    expires_at INTEGER,
+    is_active BOOLEAN DEFAULT 1,
+    usage_count INTEGER DEFAULT 0,
+    last_used INTEGER,
+    FOREIGN KEY (user_id) REFERENCES users (user_id)
+);
+
+-- Tabla de sesiones
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    expires_at INTEGER NOT NULL,
+    is_active BOOLEAN DEFAULT 1,
+    ip_address TEXT,
+    user_agent TEXT,
+    FOREIGN KEY (user_id) REFERENCES users (user_id)
+);
+
+-- username y key_hash ya tienen índice por UNIQUE
+CREATE INDEX IF NOT EXISTS idx_apikeys_user ON api_keys (user_id);
+"""
+
+# Logs de seguridad en un archivo aparte (adjuntado como logdb) sin fsync:
+# son telemetría de solo inserción y perder los últimos eventos no es grave
+LOG_DATABASE_NAME = 'security_logs.db'
+LOG_DB_PRAGMAS = (
+    "PRAGMA logdb.journal_mode=MEMORY",
+    "PRAGMA logdb.synchronous=OFF",
+)
+LOG_DDL = """
+CREATE TABLE IF NOT EXISTS logdb.security_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp INTEGER NOT NULL,
+    user_id TEXT,
+    action TEXT NOT NULL,
+    ip_address TEXT,
+    user_agent TEXT,
+    success BOOLEAN NOT NULL,
+    details TEXT
+);
+
+-- Cubre el filtro por fecha y el GROUP BY de get_security_stats
+CREATE INDEX IF NOT EXISTS logdb.idx_seclog_ts_action_success
+    ON security_logs (timestamp, action, success);
+"""
+
+# Bit de cada permiso conocido ('all' los incluye a todos)
+PERM_BITS = {
+    'view_absences': 1 << 0,
+    'manage_employees': 1 << 1,
+    'generate_reports': 1 << 2,
+    'all': ~0,
+}
+PERM_ALL = PERM_BITS['all']
+
+def permissions_mask(permissions: List[str]) -> int:
+    """Combina una lista de permisos en su máscara de bits (los desconocidos no suman)"""
+    return functools.reduce(operator.or_, (PERM_BITS.get(p, 0) for p in permissions), 0)
+
+def _to_datetime(value) -> datetime:
+    """Convierte una fecha guardada (segundos Unix, o ISO de versiones anteriores)"""
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return datetime.fromtimestamp(value)
 
 @dataclass
 class User:
@@ -20,6 +190,7 @@ class User:
     created_at: datetime
     last_login: Optional[datetime] = None
     failed_attempts: int = 0
+    permissions_mask: int = 0  # PERM_BITS combinados
 
 @dataclass
 class APIKey:
@@ -34,94 +205,151 @@ class APIKey:
     is_active: bool
     usage_count: int = 0
     last_used: Optional[datetime] = None
+    permissions_mask: int = 0  # PERM_BITS combinados
 
 class SecurityManager:
     """Gestor de seguridad y autenticación"""
     
+    _initialized_paths = set()
+    
     def __init__(self, database_path: str = 'test.db', 
                  jwt_secret: str = None):
         self.database_path = database_path
         self.jwt_secret = jwt_secret or self._generate_jwt_secret()
+        # Clave y codificador JWT preparados una vez (sin encode ni búsqueda por llamada)
+        self._jwt_secret_b = self.jwt_secret.encode('utf-8')
+        self._jwt = jwt.PyJWT()
+        self._jwt_algos = ['HS256']
+        self._ph = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=1)
         self.session_timeout = timedelta(hours=8)
         self.max_failed_attempts = 5
+        self._jwt_cache: Dict[bytes, Dict[str, Any]] = {}  # sha256(token) -> payload validado
         self.rate_limits = {
             'login': {'max_requests': 5, 'window': 300},  # 5 requests per 5 minutes
             'api': {'max_requests': 100, 'window': 3600}  # 100 requests per hour
         }
-        self._init_security_tables()
-        self._create_default_users()
+        # SQL de las consultas frecuentes: el mismo texto en cada llamada reutiliza
+        # la sentencia ya preparada en el caché de cada conexión
+        self._stmts = {
+            'auth_select': """
+                SELECT user_id, username, password_hash, role, permissions, 
+                       permissions_mask, is_active, created_at, failed_attempts
+                FROM users WHERE username = ?
+            """,
+            'apikey_select': """
+                SELECT ak.user_id, ak.permissions, ak.permissions_mask,
+                       ak.expires_at, ak.is_active,
+                       u.username, u.role, u.is_active as user_active
+                FROM api_keys ak
+                JOIN users u ON ak.user_id = u.user_id
+                WHERE ak.key_hash = ?
+            """,
+            'stats_counts': """
+                SELECT (SELECT COUNT(*) FROM users WHERE is_active = 1),
+                       (SELECT COUNT(*) FROM api_keys WHERE is_active = 1),
+                       (SELECT COUNT(*) FROM sessions WHERE is_active = 1)
+            """,
+            'stats_events': """
+                SELECT action, success, COUNT(*) 
+                FROM logdb.security_logs 
+                WHERE timestamp > ?
+                GROUP BY action, success
+            """,
+            'log_insert': """
+                INSERT INTO logdb.security_logs (timestamp, user_id, action, ip_address,
+                                               success, details)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """,
+        }
+        # Una conexión de escritura compartida (serializada por lock) y un pool de lectura
+        self._rw = sqlite3.connect(database_path, check_same_thread=False)
+        self._rw_lock = threading.RLock()
+        for pragma in SQLITE_PRAGMAS:
+            self._rw.execute(pragma)
+        self._log_database = str(Path(database_path).with_name(LOG_DATABASE_NAME))
+        self._rw.execute("ATTACH DATABASE ? AS logdb", (self._log_database,))
+        for pragma in LOG_DB_PRAGMAS:
+            self._rw.execute(pragma)
+        self._rw.executescript(LOG_DDL)
+        # Eventos de seguridad pendientes de escribir (los vuelca un hilo en lotes)
+        self._log_q = collections.deque(maxlen=LOG_QUEUE_SIZE)
+        # Intentos fallidos por user_id aún no sumados en la base
+        self._fail_counter = collections.Counter()
+        self._fail_lock = threading.Lock()
+        # API keys: filas validadas recientes y usos aún no escritos, por key_hash
+        self._apikey_cache: Dict[str, Tuple[float, tuple]] = {}
+        self._usage_counter = collections.Counter()
+        self._last_used: Dict[str, int] = {}
+        self._usage_lock = threading.Lock()
+        # Tablas y usuarios por defecto: una sola vez por base de datos y proceso
+        if database_path not in SecurityManager._initialized_paths:
+            self._init_security_tables()
+            self._create_default_users()
+            self._migrate_timestamps()
+            self._move_security_logs()
+            SecurityManager._initialized_paths.add(database_path)
+        self._readers = queue.Queue()
+        for _ in range(READ_POOL_SIZE):
+            self._readers.put(self._connect_readonly())
+        threading.Thread(target=self._log_flusher, daemon=True).start()
+        atexit.register(self._flush_pending)
     
     def _generate_jwt_secret(self) -> str:
         """Genera una clave secreta para JWT"""
-        return secrets.token_urlsafe(64)
+        return _rand.token_urlsafe(64)
+    
+    def _connect_readonly(self) -> sqlite3.Connection:
+        """Abre una conexión de solo lectura para el pool"""
+        uri = Path(self.database_path).resolve().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        for pragma in SQLITE_PRAGMAS[2:]:  # journal_mode/synchronous los fija el escritor
+            conn.execute(pragma)
+        conn.execute("ATTACH DATABASE ? AS logdb", (Path(self._log_database).resolve().as_uri() + "?mode=ro",))
+        return conn
+    
+    @contextmanager
+    def _borrow(self, readonly: bool = False):
+        """Presta una conexión del pool de lectura o la de escritura (con su lock)"""
+        if readonly:
+            conn = self._readers.get()
+            try:
+                yield conn
+            finally:
+                self._readers.put(conn)
+        else:
+            with self._rw_lock:
+                try:
+                    yield self._rw
+                except Exception:
+                    self._rw.rollback()
+                    raise
     
     def _init_security_tables(self):
         """Inicializa las tablas de seguridad"""
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-        
-        # Tabla de usuarios
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id TEXT PRIMARY KEY,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                role TEXT NOT NULL,
-                permissions TEXT NOT NULL,
-                is_active BOOLEAN DEFAULT 1,
-                created_at DATETIME NOT NULL,
-                last_login DATETIME,
-                failed_attempts INTEGER DEFAULT 0
-            )
-        """)
-        
-        # Tabla de claves API
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS api_keys (
-                key_id TEXT PRIMARY KEY,
-                key_hash TEXT UNIQUE NOT NULL,
-                user_id TEXT NOT NULL,
-                name TEXT NOT NULL,
-                permissions TEXT NOT NULL,
-                created_at DATETIME NOT NULL,
-                expires_at DATETIME,
-                is_active BOOLEAN DEFAULT 1,
-                usage_count INTEGER DEFAULT 0,
-                last_used DATETIME,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
-        
-        # Tabla de sesiones
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS sessions (
-                session_id TEXT PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                created_at DATETIME NOT NULL,
-                expires_at DATETIME NOT NULL,
-                is_active BOOLEAN DEFAULT 1,
-                ip_address TEXT,
-                user_agent TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
-        
-        # Tabla de logs de seguridad
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS security_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp DATETIME NOT NULL,
-                user_id TEXT,
-                action TEXT NOT NULL,
-                ip_address TEXT,
-                user_agent TEXT,
-                success BOOLEAN NOT NULL,
-                details TEXT
-            )
-        """)
-        
-        conn.commit()
-        conn.close()
+        with self._borrow() as conn:
+            cursor = conn.cursor()
+            
+            # Esquema ya al día: nada que crear ni migrar
+            cursor.execute("PRAGMA user_version")
+            if cursor.fetchone()[0] >= SECURITY_SCHEMA_VERSION:
+                return
+            
+            cursor.executescript(SECURITY_DDL)
+            
+            # Máscara de permisos: columna nueva en bases existentes, calculada desde el JSON
+            for table in ('users', 'api_keys'):
+                cursor.execute(f"PRAGMA table_info({table})")
+                if 'permissions_mask' not in {column[1] for column in cursor.fetchall()}:
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN permissions_mask INTEGER")
+                cursor.execute(f"SELECT rowid, permissions FROM {table} WHERE permissions_mask IS NULL")
+                cursor.executemany(
+                    f"UPDATE {table} SET permissions_mask = ? WHERE rowid = ?",
+                    [(permissions_mask(json.loads(perms)), rowid) for rowid, perms in cursor.fetchall()]
+                )
+            cursor.execute("ANALYZE")
+            cursor.execute(f"PRAGMA user_version = {SECURITY_SCHEMA_VERSION}")
+            
+            conn.commit()
         print("[SECURITY] Tablas de seguridad inicializadas")
     
     def _create_default_users(self):
@@ -141,66 +369,123 @@ class SecurityManager:
             }
         ]
         
-        for user_data in default_users:
-            if not self._user_exists(user_data['username']):
-                self.create_user(
-                    username=user_data['username'],
-                    password=user_data['password'],
-                    role=user_data['role'],
-                    permissions=user_data['permissions']
-                )
-                print(f"[SECURITY] Usuario por defecto creado: {user_data['username']}")
+        with self._borrow() as conn:
+            cursor = conn.cursor()
+            
+            # Usuarios por defecto ya creados en esta base: ni una consulta más
+            cursor.execute("PRAGMA user_version")
+            if cursor.fetchone()[0] >= DEFAULT_USERS_VERSION:
+                return
+            
+            # Los existentes en una sola consulta
+            usernames = [user_data['username'] for user_data in default_users]
+            cursor.execute(
+                f"SELECT username FROM users WHERE username IN ({', '.join('?' * len(usernames))})",
+                usernames
+            )
+            existing = {row[0] for row in cursor.fetchall()}
+            
+            for user_data in default_users:
+                if user_data['username'] not in existing:
+                    self.create_user(
+                        username=user_data['username'],
+                        password=user_data['password'],
+                        role=user_data['role'],
+                        permissions=user_data['permissions']
+                    )
+                    print(f"[SECURITY] Usuario por defecto creado: {user_data['username']}")
+            
+            cursor.execute(f"PRAGMA user_version = {DEFAULT_USERS_VERSION}")
+            conn.commit()
     
-    def _user_exists(self, username: str) -> bool:
-        """Verifica si un usuario existe"""
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM users WHERE username = ?", (username,))
-        exists = cursor.fetchone() is not None
-        conn.close()
-        return exists
+    def _migrate_timestamps(self):
+        """Convierte a segundos Unix las fechas guardadas como texto ISO (hora local)"""
+        with self._borrow() as conn:
+            cursor = conn.cursor()
+            cursor.execute("PRAGMA user_version")
+            if cursor.fetchone()[0] >= UNIX_TIMESTAMPS_VERSION:
+                return
+            
+            for table, columns in TIMESTAMP_COLUMNS.items():
+                for column in columns:
+                    cursor.execute(f"""
+                        UPDATE {table} SET {column} = CAST(strftime('%s', {column}, 'utc') AS INTEGER)
+                        WHERE typeof({column}) = 'text'
+                    """)
+            
+            cursor.execute(f"PRAGMA user_version = {UNIX_TIMESTAMPS_VERSION}")
+            conn.commit()
+    
+    def _move_security_logs(self):
+        """Mueve a logdb los eventos que versiones anteriores guardaban en la base principal"""
+        with self._borrow() as conn:
+            cursor = conn.cursor()
+            cursor.execute("PRAGMA user_version")
+            if cursor.fetchone()[0] >= LOG_DATABASE_VERSION:
+                return
+            
+            cursor.execute("SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = 'security_logs'")
+            if cursor.fetchone() is not None:
+                cursor.execute("""
+                    INSERT INTO logdb.security_logs (timestamp, user_id, action, ip_address,
+                                                     user_agent, success, details)
+                    SELECT timestamp, user_id, action, ip_address, user_agent, success, details
+                    FROM main.security_logs
+                """)
+                cursor.execute("DROP TABLE main.security_logs")
+            
+            cursor.execute(f"PRAGMA user_version = {LOG_DATABASE_VERSION}")
+            conn.commit()
     
     def _hash_password(self, password: str) -> str:
-        """Hash de contraseña con salt"""
-        salt = secrets.token_hex(32)
-        password_hash = hashlib.pbkdf2_hmac('sha256', 
-                                          password.encode('utf-8'),
-                                          salt.encode('utf-8'),
-                                          100000)
-        return f"{salt}:{password_hash.hex()}"
+        """Hash de contraseña con Argon2id (salt incluido en el hash)"""
+        return self._ph.hash(password)
+    
+    def _needs_rehash(self, password_hash: str) -> bool:
+        """True si el hash es PBKDF2 heredado o usa parámetros de Argon2 viejos"""
+        return not password_hash.startswith('$argon2') or self._ph.check_needs_rehash(password_hash)
     
     def _verify_password(self, password: str, password_hash: str) -> bool:
-        """Verifica una contraseña"""
+        """Verifica una contraseña (Argon2, o PBKDF2 para hashes heredados)"""
+        if not password_hash.startswith('$argon2'):
+            return self._verify_pbkdf2(password, password_hash)
+        try:
+            return self._ph.verify(password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    
+    def _verify_pbkdf2(self, password: str, password_hash: str) -> bool:
+        """Verifica un hash heredado 'salt:hex' (comparación en tiempo constante)"""
         try:
             salt, hash_hex = password_hash.split(':')
-            calculated_hash = hashlib.pbkdf2_hmac('sha256',
-                                                password.encode('utf-8'),
-                                                salt.encode('utf-8'),
-                                                100000)
-            return calculated_hash.hex() == hash_hex
-        except:
+            expected_hash = bytes.fromhex(hash_hex)
+        except ValueError:
             return False
+        calculated_hash = hashlib.pbkdf2_hmac('sha256',
+                                            password.encode('utf-8'),
+                                            salt.encode('utf-8'),
+                                            PBKDF2_ITERATIONS)
+        return hmac.compare_digest(calculated_hash, expected_hash)
     
     def create_user(self, username: str, password: str, role: str,
                    permissions: List[str]) -> str:
         """Crea un nuevo usuario"""
-        user_id = secrets.token_urlsafe(16)
+        user_id = _rand.token_urlsafe(16)
         password_hash = self._hash_password(password)
         
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute("""
-                INSERT INTO users (user_id, username, password_hash, role, 
-                                 permissions, is_active, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (
-                user_id, username, password_hash, role,
-                json.dumps(permissions), True, datetime.now().isoformat()
-            ))
+            with self._borrow() as conn:
+                conn.execute("""
+                    INSERT INTO users (user_id, username, password_hash, role, 
+                                     permissions, permissions_mask, is_active, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, (
+                    user_id, username, password_hash, role,
+                    json.dumps(permissions), permissions_mask(permissions),
+                    True, int(time.time())
+                ))
+                conn.commit()
             
-            conn.commit()
             self._log_security_event(user_id, 'user_created', True, 
                                    f"Usuario creado: {username}, rol: {role}")
             
@@ -209,25 +494,16 @@ class SecurityManager:
         except Exception as e:
             print(f"[SECURITY] Error creando usuario: {e}")
             return None
-        finally:
-            conn.close()
     
     def authenticate_user(self, username: str, password: str, 
                          ip_address: str = None) -> Tuple[bool, Optional[User]]:
         """Autentica un usuario"""
         
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-        
         try:
             # Buscar usuario
-            cursor.execute("""
-                SELECT user_id, username, password_hash, role, permissions, 
-                       is_active, created_at, failed_attempts
-                FROM users WHERE username = ?
-            """, (username,))
+            with self._borrow(readonly=True) as conn:
+                row = conn.execute(self._stmts['auth_select'], (username,)).fetchone()
             
-            row = cursor.fetchone()
             if not row:
                 self._log_security_event(None, 'login_failed', False, 
                                        f"Usuario no encontrado: {username}",
@@ -235,7 +511,7 @@ class SecurityManager:
                 return False, None
             
             user_id, username, password_hash, role, permissions_json, \
-            is_active, created_at, failed_attempts = row
+            perm_mask, is_active, created_at, failed_attempts = row
             
             # Verificar si la cuenta está bloqueada
             if failed_attempts >= self.max_failed_attempts:
@@ -252,23 +528,34 @@ class SecurityManager:
             
             # Verificar contraseña
             if not self._verify_password(password, password_hash):
-                # Incrementar intentos fallidos
-                cursor.execute("""
-                    UPDATE users SET failed_attempts = failed_attempts + 1
-                    WHERE user_id = ?
-                """, (user_id,))
-                conn.commit()
+                # Incrementar intentos fallidos en memoria; se escriben con el próximo
+                # lote, salvo que este intento bloquee la cuenta (bloqueo inmediato)
+                with self._fail_lock:
+                    self._fail_counter[user_id] += 1
+                    pending = self._fail_counter[user_id]
+                if failed_attempts + pending >= self.max_failed_attempts:
+                    self._flush_failed_attempts()
                 
                 self._log_security_event(user_id, 'login_failed', False,
                                        f"Contraseña incorrecta", ip_address)
                 return False, None
             
-            # Login exitoso - resetear intentos fallidos y actualizar last_login
-            cursor.execute("""
-                UPDATE users SET failed_attempts = 0, last_login = ?
-                WHERE user_id = ?
-            """, (datetime.now().isoformat(), user_id))
-            conn.commit()
+            # Hashes heredados (PBKDF2) se migran a Argon2 en el primer login exitoso
+            if self._needs_rehash(password_hash):
+                password_hash = self._hash_password(password)
+            
+            # Login exitoso - resetear intentos fallidos (también los pendientes) y actualizar last_login
+            # (un solo UPDATE y un solo commit; el evento va al lote de logs)
+            with self._fail_lock:
+                self._fail_counter.pop(user_id, None)
+            login_time = int(time.time())
+            with self._borrow() as conn, conn:
+                conn.execute("""
+                    UPDATE users SET failed_attempts = 0, last_login = ?, password_hash = ?
+                    WHERE user_id = ?
+                """, (login_time, password_hash, user_id))
+                self._log_security_event(user_id, 'login_success', True,
+                                       f"Login exitoso", ip_address)
             
             permissions = json.loads(permissions_json)
             user = User(
@@ -277,20 +564,16 @@ class SecurityManager:
                 role=role,
                 permissions=permissions,
                 is_active=is_active,
-                created_at=datetime.fromisoformat(created_at),
-                last_login=datetime.now()
+                created_at=_to_datetime(created_at),
+                last_login=datetime.fromtimestamp(login_time),
+                permissions_mask=perm_mask
             )
             
-            self._log_security_event(user_id, 'login_success', True,
-                                   f"Login exitoso", ip_address)
-            
             return True, user
         
         except Exception as e:
             print(f"[SECURITY] Error en autenticación: {e}")
             return False, None
-        finally:
-            conn.close()
     
     def create_jwt_token(self, user: User, ip_address: str = None) -> str:
         """Crea un token JWT para el usuario"""
@@ -299,6 +582,7 @@ class SecurityManager:
             'username': user.username,
             'role': user.role,
             'permissions': user.permissions,
+            'permissions_mask': user.permissions_mask,
             'iat': datetime.utcnow(),
             'exp': datetime.utcnow() + self.session_timeout
         }
@@ -306,7 +590,7 @@ class SecurityManager:
         if ip_address:
             payload['ip'] = ip_address
         
-        token = jwt.encode(payload, self.jwt_secret, algorithm='HS256')
+        token = self._jwt.encode(payload, self._jwt_secret_b, algorithm='HS256')
         
         # Crear sesión en BD
         self._create_session(user.user_id, ip_address)
@@ -314,9 +598,16 @@ class SecurityManager:
         return token
     
     def verify_jwt_token(self, token: str, ip_address: str = None) -> Tuple[bool, Optional[User]]:
-        """Verifica un token JWT"""
+        """Verifica un token JWT (los tokens válidos se cachean hasta su exp)"""
+        cache_key = hashlib.sha256(token.encode()).digest()
         try:
-            payload = jwt.decode(token, self.jwt_secret, algorithms=['HS256'])
+            payload = self._jwt_cache.get(cache_key)
+            if payload is None or payload['exp'] <= time.time():
+                self._jwt_cache.pop(cache_key, None)
+                payload = self._jwt.decode(token, self._jwt_secret_b, algorithms=self._jwt_algos)
+                if len(self._jwt_cache) >= JWT_CACHE_SIZE:
+                    self._jwt_cache.pop(next(iter(self._jwt_cache)))
+                self._jwt_cache[cache_key] = payload
             
             # Verificar IP si está en el token
             if 'ip' in payload and ip_address and payload['ip'] != ip_address:
@@ -331,7 +622,8 @@ class SecurityManager:
                 role=payload['role'],
                 permissions=payload['permissions'],
                 is_active=True,
-                created_at=datetime.now()  # Placeholder
+                created_at=datetime.now(),  # Placeholder
+                permissions_mask=payload.get('permissions_mask', 0)
             )
             
             return True, user
@@ -347,26 +639,26 @@ class SecurityManager:
                       permissions: List[str], expires_in_days: int = 365) -> str:
         """Crea una nueva clave API"""
         
-        key_id = secrets.token_urlsafe(16)
-        api_key = f"tek_{secrets.token_urlsafe(32)}"
+        key_id = _rand.token_urlsafe(16)
+        api_key = f"tek_{_rand.token_urlsafe(32)}"
         key_hash = hashlib.sha256(api_key.encode()).hexdigest()
         
-        expires_at = datetime.now() + timedelta(days=expires_in_days)
-        
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+        now = int(time.time())
+        expires_at = now + expires_in_days * 86400
         
         try:
-            cursor.execute("""
-                INSERT INTO api_keys (key_id, key_hash, user_id, name, permissions,
-                                    created_at, expires_at, is_active)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                key_id, key_hash, user_id, name, json.dumps(permissions),
-                datetime.now().isoformat(), expires_at.isoformat(), True
-            ))
+            with self._borrow() as conn:
+                conn.execute("""
+                    INSERT INTO api_keys (key_id, key_hash, user_id, name, permissions,
+                                        permissions_mask, created_at, expires_at, is_active)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (
+                    key_id, key_hash, user_id, name, json.dumps(permissions),
+                    permissions_mask(permissions),
+                    now, expires_at, True
+                ))
+                conn.commit()
             
-            conn.commit()
             self._log_security_event(user_id, 'api_key_created', True,
                                    f"API key creada: {name}")
             
@@ -375,32 +667,32 @@ class SecurityManager:
         except Exception as e:
             print(f"[SECURITY] Error creando API key: {e}")
             return None
-        finally:
-            conn.close()
     
     def verify_api_key(self, api_key: str) -> Tuple[bool, Optional[User]]:
         """Verifica una clave API"""
         key_hash = hashlib.sha256(api_key.encode()).hexdigest()
-        
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+        now = time.time()
         
         try:
-            cursor.execute("""
-                SELECT ak.user_id, ak.permissions, ak.expires_at, ak.is_active,
-                       u.username, u.role, u.is_active as user_active
-                FROM api_keys ak
-                JOIN users u ON ak.user_id = u.user_id
-                WHERE ak.key_hash = ?
-            """, (key_hash,))
+            # Fila reciente en caché (con permisos ya decodificados) o consulta a la base
+            cached = self._apikey_cache.get(key_hash)
+            if cached is not None and cached[0] > now:
+                row = cached[1]
+            else:
+                with self._borrow(readonly=True) as conn:
+                    row = conn.execute(self._stmts['apikey_select'], (key_hash,)).fetchone()
+                if row:
+                    row = (row[0], json.loads(row[1])) + row[2:]
+                    if len(self._apikey_cache) >= APIKEY_CACHE_SIZE:
+                        self._apikey_cache.pop(next(iter(self._apikey_cache)))
+                    self._apikey_cache[key_hash] = (now + APIKEY_CACHE_TTL, row)
             
-            row = cursor.fetchone()
             if not row:
                 self._log_security_event(None, 'api_key_invalid', False,
                                        "API key no encontrada")
                 return False, None
             
-            user_id, permissions_json, expires_at, is_active, \
+            user_id, permissions, perm_mask, expires_at, is_active, \
             username, role, user_active = row
             
             # Verificar si está activa
@@ -411,28 +703,24 @@ class SecurityManager:
             
             # Verificar expiración
             if expires_at:
-                expire_date = datetime.fromisoformat(expires_at)
-                if datetime.now() > expire_date:
+                if datetime.now() > _to_datetime(expires_at):
                     self._log_security_event(user_id, 'api_key_expired', False,
                                            "API key expirada")
                     return False, None
             
-            # Actualizar uso
-            cursor.execute("""
-                UPDATE api_keys SET usage_count = usage_count + 1,
-                                   last_used = ?
-                WHERE key_hash = ?
-            """, (datetime.now().isoformat(), key_hash))
-            conn.commit()
+            # Registrar uso en memoria (se escribe con el próximo lote)
+            with self._usage_lock:
+                self._usage_counter[key_hash] += 1
+                self._last_used[key_hash] = int(now)
             
-            permissions = json.loads(permissions_json)
             user = User(
                 user_id=user_id,
                 username=username,
                 role=role,
-                permissions=permissions,
+                permissions=list(permissions),
                 is_active=True,
-                created_at=datetime.now()  # Placeholder
+                created_at=datetime.now(),  # Placeholder
+                permissions_mask=perm_mask
             )
             
             return True, user
@@ -440,83 +728,120 @@ class SecurityManager:
         except Exception as e:
             print(f"[SECURITY] Error verificando API key: {e}")
             return False, None
-        finally:
-            conn.close()
     
     def _create_session(self, user_id: str, ip_address: str = None):
         """Crea una nueva sesión"""
-        session_id = secrets.token_urlsafe(32)
-        expires_at = datetime.now() + self.session_timeout
-        
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO sessions (session_id, user_id, created_at, expires_at, 
-                                is_active, ip_address)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (
-            session_id, user_id, datetime.now().isoformat(),
-            expires_at.isoformat(), True, ip_address
-        ))
-        
-        conn.commit()
-        conn.close()
+        session_id = _rand.token_urlsafe(32)
+        now = int(time.time())
+        expires_at = now + int(self.session_timeout.total_seconds())
+        
+        with self._borrow() as conn:
+            conn.execute("""
+                INSERT INTO sessions (session_id, user_id, created_at, expires_at, 
+                                    is_active, ip_address)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (
+                session_id, user_id, now,
+                expires_at, True, ip_address
+            ))
+            conn.commit()
     
     def _log_security_event(self, user_id: str, action: str, success: bool,
                            details: str, ip_address: str = None):
-        """Registra un evento de seguridad"""
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO security_logs (timestamp, user_id, action, ip_address,
-                                     success, details)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (
-            datetime.now().isoformat(), user_id, action, ip_address,
+        """Registra un evento de seguridad (se escribe en el próximo lote)"""
+        self._log_q.append((
+            int(time.time()), user_id, action, ip_address,
             success, details
         ))
-        
-        conn.commit()
-        conn.close()
+    
+    def _flush_security_logs(self):
+        """Escribe los eventos pendientes en security_logs, de a LOG_BATCH_SIZE por commit"""
+        while self._log_q:
+            batch = []
+            try:
+                while len(batch) < LOG_BATCH_SIZE:
+                    batch.append(self._log_q.popleft())
+            except IndexError:
+                pass
+            if not batch:
+                break
+            with self._borrow() as conn:
+                conn.executemany(self._stmts['log_insert'], batch)
+                conn.commit()
+    
+    def _flush_failed_attempts(self):
+        """Suma a users.failed_attempts los intentos fallidos acumulados en memoria"""
+        with self._fail_lock:
+            deltas = [(count, user_id) for user_id, count in self._fail_counter.items()]
+            self._fail_counter.clear()
+        if not deltas:
+            return
+        with self._borrow() as conn:
+            conn.executemany("""
+                UPDATE users SET failed_attempts = failed_attempts + ?
+                WHERE user_id = ?
+            """, deltas)
+            conn.commit()
+    
+    def _flush_api_key_usage(self):
+        """Suma a api_keys.usage_count los usos acumulados en memoria y actualiza last_used"""
+        with self._usage_lock:
+            updates = [(count, self._last_used[key_hash], key_hash)
+                       for key_hash, count in self._usage_counter.items()]
+            self._usage_counter.clear()
+            self._last_used.clear()
+        if not updates:
+            return
+        with self._borrow() as conn:
+            conn.executemany("""
+                UPDATE api_keys SET usage_count = usage_count + ?,
+                                   last_used = ?
+                WHERE key_hash = ?
+            """, updates)
+            conn.commit()
+    
+    def _flush_pending(self):
+        """Escribe los eventos, los intentos fallidos y los usos de API keys pendientes"""
+        self._flush_security_logs()
+        self._flush_failed_attempts()
+        self._flush_api_key_usage()
+    
+    def _log_flusher(self):
+        """Hilo de fondo que vuelca lo pendiente cada LOG_FLUSH_INTERVAL segundos"""
+        while True:
+            time.sleep(LOG_FLUSH_INTERVAL)
+            try:
+                self._flush_pending()
+            except Exception as e:
+                print(f"[SECURITY] Error guardando eventos de seguridad: {e}")
     
     def check_permission(self, user: User, required_permission: str) -> bool:
         """Verifica si un usuario tiene un permiso específico"""
-        if 'all' in user.permissions:
-            return True
-        return required_permission in user.permissions
+        bit = PERM_BITS.get(required_permission)
+        if bit is None:
+            # Permiso fuera de PERM_BITS: solo 'all' o la lista explícita lo otorgan
+            return user.permissions_mask == PERM_ALL or required_permission in user.permissions
+        return user.permissions_mask & bit == bit
     
     def get_security_stats(self) -> Dict[str, Any]:
         """Obtiene estadísticas de seguridad"""
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
-        
-        # Contadores básicos
-        cursor.execute("SELECT COUNT(*) FROM users WHERE is_active = 1")
-        active_users = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM api_keys WHERE is_active = 1")
-        active_api_keys = cursor.fetchone()[0]
+        self._flush_security_logs()  # incluir los eventos aún en memoria
         
-        cursor.execute("SELECT COUNT(*) FROM sessions WHERE is_active = 1")
-        active_sessions = cursor.fetchone()[0]
-        
-        # Eventos de seguridad recientes (última hora)
-        hour_ago = (datetime.now() - timedelta(hours=1)).isoformat()
-        cursor.execute("""
-            SELECT action, success, COUNT(*) 
-            FROM security_logs 
-            WHERE timestamp > ?
-            GROUP BY action, success
-        """, (hour_ago,))
-        
-        recent_events = {}
-        for action, success, count in cursor.fetchall():
-            key = f"{action}_{'success' if success else 'failed'}"
-            recent_events[key] = count
-        
-        conn.close()
+        with self._borrow(readonly=True) as conn:
+            cursor = conn.cursor()
+            
+            # Contadores básicos (una sola consulta)
+            cursor.execute(self._stmts['stats_counts'])
+            active_users, active_api_keys, active_sessions = cursor.fetchone()
+            
+            # Eventos de seguridad recientes (última hora)
+            hour_ago = int(time.time()) - 3600
+            cursor.execute(self._stmts['stats_events'], (hour_ago,))
+            
+            recent_events = {}
+            for action, success, count in cursor.fetchall():
+                key = f"{action}_{'success' if success else 'failed'}"
+                recent_events[key] = count
         
         return {
             'active_users': active_users,
@@ -526,9 +851,30 @@ class SecurityManager:
             'last_updated': datetime.now().isoformat()
         }
 
+# Instancia compartida por los decoradores (mismo jwt_secret para todos los requests)
+_default_mgr: Optional[SecurityManager] = None
+
+def get_security_manager() -> SecurityManager:
+    """Devuelve el SecurityManager compartido, creándolo en el primer uso"""
+    global _default_mgr
+    if _default_mgr is None:
+        _default_mgr = SecurityManager()
+    return _default_mgr
+
 # Decoradores para autenticación
+def _permission_checker(permission: Optional[str]):
+    """Arma al decorar la verificación del permiso (None si no se requiere ninguno)"""
+    if not permission:
+        return None
+    bit = PERM_BITS.get(permission)
+    if bit is None:
+        return lambda user: get_security_manager().check_permission(user, permission)
+    return lambda user: user.permissions_mask & bit == bit
+
 def require_auth(permission: str = None):
     """Decorador que requiere autenticación JWT"""
+    has_permission = _permission_checker(permission)
+    
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
@@ -538,13 +884,12 @@ def require_auth(permission: str = None):
             if not token:
                 return {'error': 'Token de autenticación requerido'}, 401
             
-            security_manager = SecurityManager()
-            valid, user = security_manager.verify_jwt_token(token)
+            valid, user = get_security_manager().verify_jwt_token(token)
             
             if not valid:
                 return {'error': 'Token inválido o expirado'}, 401
             
-            if permission and not security_manager.check_permission(user, permission):
+            if has_permission is not None and not has_permission(user):
                 return {'error': 'Permisos insuficientes'}, 403
             
             kwargs['current_user'] = user
@@ -554,6 +899,8 @@ def require_auth(permission: str = None):
 
 def require_api_key(permission: str = None):
     """Decorador que requiere clave API"""
+    has_permission = _permission_checker(permission)
+    
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
@@ -561,13 +908,12 @@ def require_api_key(permission: str = None):
             if not api_key:
                 return {'error': 'Clave API requerida'}, 401
             
-            security_manager = SecurityManager()
-            valid, user = security_manager.verify_api_key(api_key)
+            valid, user = get_security_manager().verify_api_key(api_key)
             
             if not valid:
                 return {'error': 'Clave API inválida'}, 401
             
-            if permission and not security_manager.check_permission(user, permission):
+            if has_permission is not None and not has_permission(user):
                 return {'error': 'Permisos insuficientes'}, 403
             
             kwargs['current_user'] = user
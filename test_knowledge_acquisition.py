@@ -9,7 +9,8 @@ def test_complete_knowledge_acquisition():
     print("[BRAIN] PRUEBA COMPLETA: MODULO DE ADQUISICION DE CONOCIMIENTO")
     print("="*60)
     
-    manager = RulesManager()
+    # Sin backups: la prueba no deja archivos en expert/backups
+    manager = RulesManager(backup=False)
     
     # 1. Mostrar estadísticas iniciales
     print("\n[STATS] Estadísticas iniciales:")
@@ -31,8 +32,8 @@ def test_complete_knowledge_acquisition():
         "created_by": "knowledge_acquisition_demo"
     }
     
-    success, message = manager.add_rule(test_rule)
-    if success:
+    created, message = manager.add_rule(test_rule)
+    if created:
         print(f"  [OK] {message}")
     else:
         print(f"  [ERROR] {message}")
@@ -75,13 +76,14 @@ def test_complete_knowledge_acquisition():
     rules_json = manager.load_rules()
     existing_rules = rules_json.get("rules", [])
     
-    # Probar cada validación
+    # Probar todas las validaciones en una sola pasada sobre las reglas existentes
+    results = manager.validate_rule(valid_rule, existing_rules)
     validations = [
-        ("ID único", manager.validate_rule_id(valid_rule["id"], existing_rules)),
-        ("Condición", manager.validate_condition(valid_rule["condition"])),
-        ("Acción", manager.validate_action(valid_rule["action"])),
-        ("Prioridad", manager.validate_priority(valid_rule["priority"], existing_rules)),
-        ("Severidad", manager.validate_severity(valid_rule["severity"]))
+        ("ID único", results["id"]),
+        ("Condición", results["condition"]),
+        ("Acción", results["action"]),
+        ("Prioridad", results["priority"]),
+        ("Severidad", results["severity"])
     ]
     
     for test_name, (valid, msg) in validations:
@@ -158,11 +160,14 @@ def test_complete_knowledge_acquisition():
     
     # 10. Cleanup - eliminar regla de prueba
     print("\n[CLEANUP] Limpiando regla de prueba...")
-    success, message = manager.delete_rule("demo_knowledge_acquisition")
-    if success:
-        print(f"  [OK] {message}")
+    if created:
+        success, message = manager.delete_rule("demo_knowledge_acquisition")
+        if success:
+            print(f"  [OK] {message}")
+        else:
+            print(f"  [WARN] {message}")
     else:
-        print(f"  [WARN] {message}")
+        print("  [SKIP] La regla de prueba no se creó")
     
     print("\n" + "="*60)
     print("[SUCCESS] MODULO DE ADQUISICION DE CONOCIMIENTO COMPLETADO")
@@ -1,6 +1,7 @@
 # test_save.py - Probar guardado manual
 import asyncio
-from models.database import SessionLocal, Absence
+from main import save_absence_data
+from models.database import SessionLocal, Absence, bulk_insert_absences
 
 async def test_save():
     print("Probando guardado manual...")
@@ -14,11 +15,6 @@ async def test_save():
         "certificado": "Test - No aplica"
     }
     
-    # Importar función
-    import sys
-    sys.path.append('.')
-    from main import save_absence_data
-    
     # Guardar
     await save_absence_data(chat_id=999999, data=test_data)
     
@@ -33,6 +29,24 @@ async def test_save():
             print(f"Último registro: {last_record.name} - {last_record.motivo}")
     finally:
         db.close()
+    
+    # Guardado en lote: 100 filas en un solo executemany
+    print("Probando guardado en lote...")
+    batch_chat_id = 999998
+    rows = [{**test_data, "legajo": str(i), "chat_id": batch_chat_id} for i in range(100)]
+    bulk_insert_absences(rows)
+    
+    db = SessionLocal()
+    try:
+        batch_count = db.query(Absence).filter(Absence.chat_id == batch_chat_id).count()
+        print(f"Registros del lote guardados: {batch_count}")
+        
+        # Limpiar las filas del lote
+        db.query(Absence).filter(Absence.chat_id == batch_chat_id).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
 
+# Con pytest corre en el event loop compartido (pytest.ini)
 if __name__ == "__main__":
     asyncio.run(test_save())
\ No newline at end of file
@@ -6,7 +6,8 @@ def test_knowledge_system():
     print("SISTEMA DE ADQUISICION DE CONOCIMIENTO - PRUEBA")
     print("=" * 50)
     
-    manager = RulesManager()
+    # Sin backups: la prueba no deja archivos en expert/backups
+    manager = RulesManager(backup=False)
     
     # 1. Estadisticas iniciales
     print("\n[1] ESTADISTICAS INICIALES:")
@@ -27,7 +28,7 @@ def test_knowledge_system():
         "created_by": "test_system"
     }
     
-    success, message = manager.add_rule(test_rule)
+    created, message = manager.add_rule(test_rule)
     print(f"    Resultado: {message}")
     
     # 3. Validaciones
@@ -56,8 +57,11 @@ def test_knowledge_system():
     
     # 5. Cleanup
     print("\n[5] LIMPIEZA:")
-    success, message = manager.delete_rule("test_simple_rule")
-    print(f"    {message}")
+    if created:
+        success, message = manager.delete_rule("test_simple_rule")
+        print(f"    {message}")
+    else:
+        print("    Nada que limpiar (la regla no se creó)")
     
     # 6. Estadisticas finales
     print("\n[6] ESTADISTICAS FINALES:")
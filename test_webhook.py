@@ -5,12 +5,16 @@ from telegram import Bot
 # Configura el token de tu bot
 TOKEN = "8051002066:AAHP7iOF1Sgy-POa7xQWCQyUlRByWbPRkHY"
 
-async def check_webhook():
-    # Crea una instancia del bot
-    bot = Bot(token=TOKEN)
-    
-    # Obtiene información del webhook (usa await)
-    webhook_info = await bot.get_webhook_info()
+# Una sola instancia del bot: no se reconstruye por consulta; dentro de cada
+# "async with bot" las llamadas comparten su cliente HTTP y conexiones keep-alive
+bot = Bot(token=TOKEN)
+
+async def test_check_webhook():
+    # El contexto inicializa el cliente HTTP del bot y lo cierra al terminar
+    # (también cuando pytest ejecuta la prueba)
+    async with bot:
+        # Obtiene información del webhook (usa await)
+        webhook_info = await bot.get_webhook_info()
     print(f"Webhook info: {webhook_info}")
     
     # Verifica si el webhook está configurado
@@ -20,5 +24,6 @@ async def check_webhook():
         print("❌ Webhook no configurado. Configúralo con:")
         print(f"asyncio.run(bot.set_webhook(url='http://localhost:8000/webhook'))")
 
-# Ejecuta la función asíncrona
-asyncio.run(check_webhook())
\ No newline at end of file
+# Ejecuta la función asíncrona (con pytest corre en el event loop compartido)
+if __name__ == "__main__":
+    asyncio.run(test_check_webhook())
\ No newline at end of file
@@ -1,12 +1,28 @@
 # utils.py - Utilidades del sistema experto
-import uuid
-from datetime import datetime
+import os
+import re
+import time
+from types import MappingProxyType
+
+# Nombres completos de los sectores (constante de solo lectura, se arma una vez al importar)
+_SECTOR_DISPLAY = MappingProxyType({
+    'linea1': 'Línea de Producción 1',
+    'linea2': 'Línea de Producción 2',
+    'Mantenimiento': 'Mantenimiento',
+    'RH': 'Recursos Humanos'
+})
+
+# Legajo: de 4 a 20 dígitos ASCII, el largo de la columna employees.legajo (compilado una vez)
+LEGAJO_MIN_LEN = 4
+LEGAJO_MAX_LEN = 20
+_LEGAJO_RE = re.compile(r"[0-9]+")
 
 def generate_registration_code(legajo, validated=False):
     """Genera un código único de registro"""
     prefix = "REG-" if validated else "PROV-"
-    timestamp = datetime.now().strftime("%Y%m%d%H%M")
-    unique_part = uuid.uuid4().hex[:4].upper()
+    timestamp = time.strftime("%Y%m%d%H%M")
+    # Unicidad: legajo + minuto + 16 bits aleatorios (subir a os.urandom(4) si hubiera colisiones)
+    unique_part = os.urandom(2).hex().upper()
     return f"{prefix}{legajo}-{timestamp}-{unique_part}"
 
 def format_employee_name(nombre_completo):
@@ -25,14 +41,10 @@ def format_employee_name(nombre_completo):
 
 def validate_legajo_format(legajo):
     """Valida que el legajo tenga el formato correcto"""
-    return legajo.isdigit() and len(legajo) >= 4
+    # El largo se descarta primero, sin recorrer el texto
+    return (LEGAJO_MIN_LEN <= len(legajo) <= LEGAJO_MAX_LEN
+            and _LEGAJO_RE.fullmatch(legajo) is not None)
 
 def get_sector_display_name(sector):
     """Devuelve el nombre completo del sector"""
-    sectores = {
-        'linea1': 'Línea de Producción 1',
-        'linea2': 'Línea de Producción 2', 
-        'Mantenimiento': 'Mantenimiento',
-        'RH': 'Recursos Humanos'
-    }
-    return sectores.get(sector, sector)
\ No newline at end of file
+    return _SECTOR_DISPLAY.get(sector, sector)
\ No newline at end of file
@@ -1,60 +1,100 @@
 # view_records.py
-from models.database import SessionLocal, Absence
+from models.database import ScopedSession, Absence
+import sys
 from datetime import datetime
+from itertools import groupby
+from operator import attrgetter
+
+# Historial con flechas en input() (readline no existe en Windows)
+try:
+    import readline
+except ImportError:
+    pass
+
+# Filas traídas de la base (y escritas a stdout) por bloque
+PAGE_SIZE = 200
+SEPARATOR = "-" * 80
+
+# Solo las columnas que se muestran en el listado
+RECORD_COLUMNS = (
+    Absence.id, Absence.name, Absence.legajo, Absence.motivo, Absence.duracion,
+    Absence.certificado, Absence.created_at, Absence.chat_id,
+)
+
+# Plantilla de un registro del listado (un solo format por fila)
+RECORD_TEMPLATE = (
+    "ID: {id}\n"
+    "👤 Nombre: {name}\n"
+    "🆔 Legajo: {legajo}\n"
+    "📅 Motivo: {motivo}\n"
+    "⏰ Duración: {duracion} días\n"
+    "🏥 Certificado: {certificado}\n"
+    "📆 Registrado: {created_at}\n"
+    "💬 Chat ID: {chat_id}\n"
+    + SEPARATOR + "\n"
+)
 
 def view_all_records():
     """Muestra todos los registros de ausencias"""
-    db = SessionLocal()
-    try:
-        absences = db.query(Absence).order_by(Absence.created_at.desc()).all()
-        
-        if not absences:
-            print("📝 No hay registros de ausencias.")
-            return
-        
-        print(f"\n📋 REGISTROS DE AUSENCIAS ({len(absences)} total)")
-        print("=" * 80)
-        
-        for absence in absences:
-            print(f"ID: {absence.id}")
-            print(f"👤 Nombre: {absence.name}")
-            print(f"🆔 Legajo: {absence.legajo}")
-            print(f"📅 Motivo: {absence.motivo}")
-            print(f"⏰ Duración: {absence.duracion} días")
-            print(f"🏥 Certificado: {absence.certificado}")
-            print(f"📆 Registrado: {absence.created_at}")
-            print(f"💬 Chat ID: {absence.chat_id}")
-            print("-" * 80)
+    with ScopedSession() as db:
+        try:
+            total = db.query(Absence).count()
+            
+            if not total:
+                print("📝 No hay registros de ausencias.")
+                return
+            
+            # Recorrer en bloques en lugar de cargar toda la tabla en memoria (filas, no objetos ORM)
+            absences = db.query(*RECORD_COLUMNS).order_by(Absence.created_at.desc()).yield_per(PAGE_SIZE)
             
-    except Exception as e:
-        print(f"❌ Error: {e}")
-    finally:
-        db.close()
+            print(f"\n📋 REGISTROS DE AUSENCIAS ({total} total)")
+            print("=" * 80)
+            
+            # Un solo write por bloque de registros en lugar de un print por línea
+            buf = []
+            for absence in absences:
+                buf.append(RECORD_TEMPLATE.format_map(absence._mapping))
+                if len(buf) == PAGE_SIZE:
+                    sys.stdout.write("".join(buf))
+                    buf.clear()
+            sys.stdout.write("".join(buf))
+            sys.stdout.flush()
+                
+        except Exception as e:
+            print(f"❌ Error: {e}")
 
-def search_by_legajo(legajo):
-    """Busca registros por legajo"""
-    db = SessionLocal()
-    try:
-        absences = db.query(Absence).filter(Absence.legajo == legajo).order_by(Absence.created_at.desc()).all()
-        
-        if not absences:
-            print(f"📝 No se encontraron registros para el legajo: {legajo}")
-            return
+def search_by_legajo(legajos):
+    """Busca registros por uno o varios legajos (una sola consulta con IN)"""
+    if isinstance(legajos, str):
+        legajos = [legajos]
+    
+    with ScopedSession() as db:
+        try:
+            # Ordenado por legajo y fecha: lo resuelve el índice (legajo, created_at desc)
+            query = (db.query(Absence)
+                     .filter(Absence.legajo.in_(legajos))
+                     .order_by(Absence.legajo, Absence.created_at.desc())
+                     .yield_per(PAGE_SIZE))
             
-        print(f"\n📋 REGISTROS PARA LEGAJO: {legajo}")
-        print("=" * 60)
-        
-        for absence in absences:
-            print(f"📅 {absence.created_at.strftime('%d/%m/%Y %H:%M')}")
-            print(f"👤 {absence.name}")
-            print(f"📋 {absence.motivo} - {absence.duracion} días")
-            print(f"🏥 {absence.certificado}")
-            print("-" * 60)
+            found = set()
+            for legajo, absences in groupby(query, key=attrgetter("legajo")):
+                found.add(legajo)
+                print(f"\n📋 REGISTROS PARA LEGAJO: {legajo}")
+                print("=" * 60)
+                
+                for absence in absences:
+                    print(f"📅 {absence.created_at.strftime('%d/%m/%Y %H:%M')}")
+                    print(f"👤 {absence.name}")
+                    print(f"📋 {absence.motivo} - {absence.duracion} días")
+                    print(f"🏥 {absence.certificado}")
+                    print("-" * 60)
             
-    except Exception as e:
-        print(f"❌ Error: {e}")
-    finally:
-        db.close()
+            for legajo in legajos:
+                if legajo not in found:
+                    print(f"📝 No se encontraron registros para el legajo: {legajo}")
+                
+        except Exception as e:
+            print(f"❌ Error: {e}")
 
 def main():
     while True:
@@ -68,9 +108,11 @@ def main():
         if choice == "1":
             view_all_records()
         elif choice == "2":
-            legajo = input("Ingresa el legajo a buscar: ").strip()
-            if legajo:
-                search_by_legajo(legajo)
+            # Varios legajos separados por coma se buscan en una sola consulta
+            legajos = [legajo.strip() for legajo in input("Ingresa el legajo a buscar (o varios separados por coma): ").split(",")]
+            legajos = list(dict.fromkeys(legajo for legajo in legajos if legajo))
+            if legajos:
+                search_by_legajo(legajos)
             else:
                 print("❌ Legajo no puede estar vacío")
         elif choice == "3":